@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Latency and throughput of the main endpoints under concurrent clients.
+#
+#   python benchmarks/endpoints.py [--files 5000] [--clients 8] [--duration 10]
+#                                  [--output results.json] [--compare baseline.json]
+#
+# The server runs in a subprocess with fake `scanimage`, `convert` and `lp`
+# (harness.py), in a scans folder seeded with --files scans. Scenarios run one
+# after another, each with --clients clients sending requests for --duration s:
+#   list    - GET /scans (first page)
+#   upload  - POST /upload of a JPEG page (--upload-dpi)
+#   makepdf - POST /makepdf of --pdf-pages seeded scans, waits for the job
+#   scan    - POST /scan/execute on fake devices, waits for the job
+#   print   - POST /print/execute of a seeded scan
+# For job endpoints latency is the time until the job finished.
+#
+# Results (with version, commit and parameters) are written as JSON, so runs of
+# different versions can be compared: --compare prints p50/p95 and throughput
+# relative to an earlier result file.
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import get_json, install_fakes, multipart, percentiles, request, seed, server
+
+SCENARIOS = ['list', 'upload', 'makepdf', 'scan', 'print']
+JOB_STATES = ('queued', 'running')
+
+
+def wait_job(url:str) -> bool:
+    while True:
+        job = get_json(url)
+        if job['status'] not in JOB_STATES:
+            result = job.get('result') or {}
+            return job['status'] == 'done' and not result.get('code', result.get('returncode', 0))
+        time.sleep(0.05)
+
+
+# One request (or job) of the scenario, returns False when it failed
+def scenario_requests(base:str, args) -> dict:
+    from PIL import Image
+    image = io.BytesIO()
+    dpi = args.upload_dpi
+    Image.effect_noise((int(8.27 * dpi), int(11.69 * dpi)), 64).convert('RGB').save(image, 'JPEG', quality=90)
+    upload, upload_headers = multipart('benchmark.jpg', image.getvalue())
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def seeded(index:int) -> str:
+        return f'20200101-000000_{index % args.files:05d}.jpg'
+
+    def list_scans() -> bool:
+        request(f'{base}/scans?limit=50')
+        return True
+
+    def upload_file() -> bool:
+        request(f'{base}/upload', upload, upload_headers)
+        return True
+
+    def make_pdf() -> bool:
+        with lock:
+            index = next(counter)
+        filenames = [seeded(index * args.pdf_pages + page) for page in range(args.pdf_pages)]
+        job = get_json(f'{base}/makepdf', {'filenames': filenames, 'target': f'benchmark-{index}'})
+        return wait_job(f'{base}/makepdf/jobs/{job["id"]}')
+
+    def scan() -> bool:
+        with lock:
+            index = next(counter)
+        body = {'mode': 'Color', 'resolution': str(args.scan_dpi), 'format': 'jpeg', 'device': f'fake:{index % args.devices}'}
+        job = get_json(f'{base}/scan/execute', body)
+        return wait_job(f'{base}/scan/jobs/{job["id"]}')
+
+    def print_file() -> bool:
+        with lock:
+            index = next(counter)
+        body = {'filename': seeded(index), 'quality': 'draft', 'orientation': 'portrait', 'sides': 'one-sided'}
+        result = get_json(f'{base}/print/execute', body)
+        return result.get('code') == 0
+
+    return {'list': list_scans, 'upload': upload_file, 'makepdf': make_pdf, 'scan': scan, 'print': print_file}
+
+
+# Runs func from `clients` threads for `duration` seconds
+def measure(func, clients:int, duration:float) -> dict:
+    latencies = []
+    failed = []
+    errors = []
+    end = time.perf_counter() + duration
+    def client():
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            try:
+                ok = func()
+            except (OSError, ValueError) as ex: # HTTPError is OSError
+                ok = False
+                if len(errors) < 5:
+                    errors.append(str(ex))
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failed.append(1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        for _ in range(clients):
+            pool.submit(client)
+    elapsed = time.perf_counter() - start
+    result = percentiles(latencies)
+    result.update({
+        'errors': len(failed),
+        'seconds': elapsed,
+        'throughput_rps': len(latencies) / elapsed,
+    })
+    if errors:
+        result['error_samples'] = errors
+    return result
+
+
+def environment() -> dict:
+    from swis.version import __version__
+    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'version': __version__,
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare(results:dict, baseline:dict):
+    before = {result['scenario']: result for result in baseline['results']}
+    print(f'compared with {baseline["environment"].get("version")} ({baseline["environment"].get("commit")})', file=sys.stderr)
+    for result in results['results']:
+        old = before.get(result['scenario'])
+        if not old or not old.get('requests') or not result.get('requests'):
+            continue
+        print(
+            f'{result["scenario"]:8} p50 x{result["p50_ms"] / old["p50_ms"]:5.2f}  p95 x{result["p95_ms"] / old["p95_ms"]:5.2f}  '
+            f'throughput x{result["throughput_rps"] / max(old["throughput_rps"], 1e-9):5.2f}',
+            file=sys.stderr
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Endpoint latency and throughput benchmark')
+    parser.add_argument('--files', type=int, default=5000, help='seeded scans')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--devices', type=int, default=4, help='fake scanners')
+    parser.add_argument('--scan-seconds', type=float, default=1.0, help='time of fake scan')
+    parser.add_argument('--scan-dpi', type=int, default=150)
+    parser.add_argument('--print-seconds', type=float, default=0.2, help='time of fake lp')
+    parser.add_argument('--convert-seconds', type=float, default=0.5, help='time of fake convert')
+    parser.add_argument('--upload-dpi', type=int, default=150, help='resolution of uploaded A4 page')
+    parser.add_argument('--pdf-pages', type=int, default=5)
+    parser.add_argument('--output', help='JSON results file (default: stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='earlier JSON results to compare with')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    results = {
+        'environment': environment(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': [],
+    }
+    fakes = {
+        'FAKE_DEVICES': str(args.devices),
+        'FAKE_SCAN_SECONDS': str(args.scan_seconds),
+        'FAKE_PRINT_SECONDS': str(args.print_seconds),
+        'FAKE_CONVERT_SECONDS': str(args.convert_seconds),
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        bin_folder = os.path.join(folder, 'bin')
+        scans = os.path.join(folder, 'scans')
+        os.mkdir(scans)
+        install_fakes(bin_folder)
+        start = time.perf_counter()
+        seed(scans, args.files)
+        print(f'seeded {args.files} files in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+        with server(bin_folder, scans, args.files, fakes) as base:
+            funcs = scenario_requests(base, args)
+            for scenario in scenarios:
+                result = {'scenario': scenario, 'clients': args.clients}
+                result.update(measure(funcs[scenario], args.clients, args.duration))
+                results['results'].append(result)
+                print(
+                    f'{scenario:8} {result["requests"]:6} ok {result["errors"]:4} err  '
+                    f'{result["throughput_rps"]:8.1f} req/s  p50 {result.get("p50_ms", 0):8.1f} ms  '
+                    f'p95 {result.get("p95_ms", 0):8.1f} ms  p99 {result.get("p99_ms", 0):8.1f} ms',
+                    file=sys.stderr
+                )
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Shared parts of the server benchmarks: fake `scanimage`, `convert` and `lp`,
+# seeding of the scans folder, swis server in a subprocess and HTTP helpers.
+#
+# Fakes read their settings from the environment:
+#   FAKE_SCAN_SECONDS   time of scanning one page (default 2)
+#   FAKE_SCAN_SIZE      WxH of scanned page in pixels (default: from -x/-y
+#                       and --resolution of the request, i.e. A4)
+#   FAKE_DEVICES        number of devices listed by scanimage (default 4)
+#   FAKE_CONVERT_SECONDS, FAKE_PRINT_SECONDS  (default 0.5)
+#
+#   python benchmarks/harness.py PORT FOLDER  - runs the server only
+
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+FAKE_SCANIMAGE = '''#!/usr/bin/env python3
+import os, sys, time
+args = sys.argv[1:]
+if any(arg.startswith('--formatted-device-list') for arg in args):
+    for index in range(int(os.environ.get('FAKE_DEVICES', '4'))):
+        print(f'fake:{index}\\tFake\\tScanner {index}\\tflatbed scanner')
+    sys.exit(0)
+if '--all-options' in args or '-A' in args:
+    sys.exit(0)
+def option(name, default):
+    for index, arg in enumerate(args):
+        if arg == name and index + 1 < len(args):
+            return args[index + 1]
+        if arg.startswith(name + '='):
+            return arg.split('=', 1)[1]
+    return default
+if os.environ.get('FAKE_SCAN_SIZE'):
+    width, height = map(int, os.environ['FAKE_SCAN_SIZE'].split('x'))
+else:
+    dpi = float(option('--resolution', '150'))
+    width, height = (int(float(option(name, mm)) * dpi / 25.4) for name, mm in (('-x', '210'), ('-y', '297')))
+delay = float(os.environ.get('FAKE_SCAN_SECONDS', '2'))
+gray = option('--mode', 'color').lower() in ('gray', 'grayscale', 'lineart')
+channels = 1 if gray else 3
+sys.stdout.buffer.write(f'P{5 if gray else 6}\\n{width} {height}\\n255\\n'.encode())
+row = bytes(range(256)) * (width * channels // 256) + bytes(width * channels % 256)
+for y in range(height):
+    if y % 100 == 0:
+        time.sleep(delay * 100 / height)
+        sys.stderr.write(f'Progress: {100.0 * y / height:.1f}%\\n')
+    sys.stdout.buffer.write(row)
+'''
+
+# Writes minimal pdf to the last argument (versions of swis building pdf with ImageMagick)
+FAKE_CONVERT = '''#!/usr/bin/env python3
+import os, sys, time
+time.sleep(float(os.environ.get('FAKE_CONVERT_SECONDS', '0.5')))
+with open(sys.argv[-1], 'wb') as f:
+    f.write(b'%PDF-1.4\\n1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\\n'
+            b'2 0 obj << /Type /Pages /Kids [] /Count 0 >> endobj\\n'
+            b'trailer << /Root 1 0 R >>\\n%%EOF\\n')
+'''
+
+FAKE_LP = '''#!/usr/bin/env python3
+import os, time, uuid
+time.sleep(float(os.environ.get('FAKE_PRINT_SECONDS', '0.5')))
+print(f'request id is fake-{uuid.uuid4().int % 100000} (1 file(s))')
+'''
+
+# Nothing is printing, so submitted jobs complete at the next poll
+FAKE_LPSTAT = '''#!/usr/bin/env python3
+'''
+
+FAKES = {'scanimage': FAKE_SCANIMAGE, 'convert': FAKE_CONVERT, 'lp': FAKE_LP, 'lpstat': FAKE_LPSTAT}
+
+
+def install_fakes(folder:str):
+    os.makedirs(folder, exist_ok=True)
+    for name, script in FAKES.items():
+        path = os.path.join(folder, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+
+def serve(port:int, folder:str):
+    import uvicorn
+    import swis.swis as swis
+    from swis.core.storage import ScanFiles
+    swis.settings.SCANS_FOLDER = folder
+    swis.app.mount(swis.settings.SCANS_ADDRESS, ScanFiles(swis.storage()), name='scans')
+    uvicorn.run(swis.app, host='127.0.0.1', port=port, log_level='warning')
+
+
+# Copies of one A4 page (dpi) named like scans
+def seed(folder:str, files:int, dpi:int=150):
+    from PIL import Image
+    sample = os.path.join(folder, 'seed.jpg')
+    Image.new('RGB', (int(8.27 * dpi), int(11.69 * dpi)), 'white').save(sample, quality=80)
+    for index in range(files):
+        shutil.copy(sample, os.path.join(folder, f'20200101-000000_{index:05d}.jpg'))
+    os.unlink(sample)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Server with the fakes first in PATH, yields its base url once the
+# catalog has all `files` seeded files
+@contextmanager
+def server(bin_folder:str, scans:str, files:int=0, env:dict=None):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, PATH=f'{bin_folder}{os.pathsep}{os.environ["PATH"]}', LOG_LEVEL='WARNING', **(env or {}))
+    # own process group, so worker processes of the server are stopped with it
+    process = subprocess.Popen([sys.executable, os.path.realpath(__file__), str(port), scans], env=env, start_new_session=True)
+    try:
+        for _ in range(300):
+            try:
+                request(f'{base}/scans?limit=1')
+                break
+            except OSError:
+                time.sleep(0.1)
+        while get_json(f'{base}/scans?limit=1')['total'] < files:
+            time.sleep(0.5)
+        yield base
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        finally:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+
+
+def request(url:str, data:bytes=None, headers:dict=None, method:str=None) -> float:
+    start = time.perf_counter()
+    req = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
+    with urllib.request.urlopen(req, timeout=120) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+
+def get_json(url:str, body:dict=None) -> dict:
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+    with urllib.request.urlopen(req, timeout=120) as resp:
+        return json.loads(resp.read())
+
+
+def multipart(filename:str, content:bytes) -> tuple:
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}', 'Content-Length': str(len(body))}
+
+
+def percentiles(latencies:list) -> dict:
+    if not latencies:
+        return {'requests': 0}
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+    return {
+        'requests': len(latencies),
+        'p50_ms': pick(0.50) * 1000,
+        'p95_ms': pick(0.95) * 1000,
+        'p99_ms': pick(0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]), sys.argv[2])
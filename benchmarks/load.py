@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Load test: latency of GET /scans while scans, uploads and prints run.
+#
+#   python benchmarks/load.py [--files 2000] [--clients 8] [--duration 10] [--rate 100]
+#
+# The server runs in a subprocess with fake `scanimage` and `lp` (slow
+# processes writing generated data, see harness.py), so no scanner or
+# printer is needed.
+# Phases:
+#   idle  - only /scans requests
+#   scans - /scans requests while scans run on several devices
+#   busy  - /scans requests while scans, uploads and prints are submitted
+#           continuously
+# Without --rate every client sends the next request as soon as it has the
+# response (the server is saturated, so latency shows its share of the CPU).
+# With --rate the clients send that many requests per second in total, at
+# fixed times, and latency is counted from the time the request was due.
+# Latency percentiles are printed to stderr, JSON results to stdout.
+# The event loop is not blocked by the load, but everything runs on the same
+# machine: with fewer cores than busy processes (fake scanners, thumbnail
+# workers, clients) /scans latency rises with the CPU load (see `cpus`).
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import install_fakes, multipart, percentiles, request, seed, server
+
+
+# Requests /scans from `clients` threads for `duration` seconds
+# (`rate` requests per second in total, as fast as possible when 0)
+def measure_list(base:str, clients:int, duration:float, rate:float=0) -> list:
+    latencies = []
+    start = time.perf_counter()
+    end = start + duration
+    def client(index:int):
+        for sent in itertools.count():
+            if not rate:
+                if time.perf_counter() >= end:
+                    return
+                latencies.append(request(f'{base}/scans?limit=50'))
+                continue
+            due = start + (index + sent * clients) / rate
+            if due >= end:
+                return
+            time.sleep(max(0.0, due - time.perf_counter()))
+            request(f'{base}/scans?limit=50')
+            latencies.append(time.perf_counter() - due)
+    with ThreadPoolExecutor(clients) as pool:
+        for index in range(clients):
+            pool.submit(client, index)
+    return latencies
+
+
+# Keeps scans (on `devices`), uploads and prints (from `uploads` and
+# `prints` clients) going until stopped
+def background_load(base:str, devices:int, uploads:int, prints:int, stop:threading.Event, counts:dict) -> list:
+    import io
+    from PIL import Image
+    image = io.BytesIO()
+    Image.effect_noise((2480, 3508), 64).convert('RGB').save(image, 'JPEG', quality=95) # A4 at 300 dpi
+    upload, headers = multipart('load.jpg', image.getvalue())
+
+    def scan(device:str):
+        body = json.dumps({'mode': 'color', 'resolution': '150', 'format': 'png', 'device': device}).encode()
+        job = json.loads(urllib.request.urlopen(urllib.request.Request(
+            f'{base}/scan/execute', data=body, headers={'Content-Type': 'application/json'}
+        )).read())
+        while not stop.is_set():
+            status = json.loads(urllib.request.urlopen(f'{base}/scan/jobs/{job["id"]}').read())
+            if status['status'] not in ('queued', 'running'):
+                counts['scans'] += 1
+                return
+            time.sleep(0.2)
+    def upload_file():
+        request(f'{base}/upload', upload, headers)
+        counts['uploads'] += 1
+    def print_file():
+        body = json.dumps({'filename': '20200101-000000_00000.jpg', 'quality': 'draft', 'orientation': 'portrait', 'sides': 'one-sided'}).encode()
+        request(f'{base}/print/execute', body, {'Content-Type': 'application/json'})
+        counts['prints'] += 1
+    def repeat(func, *args):
+        try:
+            while not stop.is_set():
+                func(*args)
+        except OSError:
+            if not stop.is_set():
+                raise
+
+    threads = [threading.Thread(target=repeat, args=(scan, f'fake:{index}'), daemon=True) for index in range(devices)]
+    threads += [threading.Thread(target=repeat, args=(upload_file,), daemon=True) for _ in range(uploads)]
+    threads += [threading.Thread(target=repeat, args=(print_file,), daemon=True) for _ in range(prints)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/scans latency under load')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rate', type=float, default=0, help='/scans requests per second (0: as fast as possible)')
+    parser.add_argument('--devices', type=int, default=4, help='scanners scanning in parallel')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        bin_folder = os.path.join(folder, 'bin')
+        scans = os.path.join(folder, 'scans')
+        os.mkdir(scans)
+        install_fakes(bin_folder)
+        seed(scans, args.files)
+
+        with server(bin_folder, scans, args.files, {'FAKE_SCAN_SIZE': '1240x1754'}) as base:
+            results = []
+            result = percentiles(measure_list(base, args.clients, args.duration, args.rate))
+            result.update({'phase': 'idle'})
+            results.append(result)
+
+            for phase, uploads, prints in (('scans', 0, 0), ('busy', 2, 4)):
+                stop = threading.Event()
+                counts = {'scans': 0, 'uploads': 0, 'prints': 0}
+                threads = background_load(base, args.devices, uploads, prints, stop, counts)
+                result = percentiles(measure_list(base, args.clients, args.duration, args.rate))
+                stop.set()
+                for thread in threads:
+                    thread.join()
+                result.update({'phase': phase, **counts})
+                results.append(result)
+
+    for result in results:
+        result.update({'files': args.files, 'clients': args.clients, 'rate': args.rate, 'cpus': os.cpu_count()})
+        print(
+            f'{result["phase"]:5} {result["requests"]:6} req  p50 {result["p50_ms"]:7.1f} ms  '
+            f'p95 {result["p95_ms"]:7.1f} ms  p99 {result["p99_ms"]:7.1f} ms  max {result["max_ms"]:7.1f} ms',
+            file=sys.stderr
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
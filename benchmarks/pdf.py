@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Compares PDF assembly with ImageMagick `convert` (previous /makepdf
+# implementation) and the in-process swis.core.pdf.build_pdf (time and peak RSS).
+#
+#   python benchmarks/pdf.py [--pages 20] [--dpi 300] [--format jpg]
+#
+# Every measurement runs in a fresh process (Linux keeps peak RSS across
+# fork/exec, so the parent only orchestrates). `convert` is skipped when
+# it is not installed.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+
+def make_pages(folder:str, pages:int, dpi:int, fmt:str):
+    from PIL import Image, ImageDraw
+    width, height = int(8.27 * dpi), int(11.69 * dpi) # A4
+    for page in range(pages):
+        im = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(im)
+        for y in range(page % 7, height, max(1, dpi // 6)):
+            draw.line((0, y, width, y), fill=(y % 256, page * 10 % 256, 128), width=max(1, dpi // 100))
+        im.save(os.path.join(folder, f'page{page:04d}.{fmt}'), dpi=(dpi, dpi))
+
+
+def run_swis(sources:list, target:str) -> dict:
+    from pathlib import Path
+    from swis.core.pdf import build_pdf
+    start = time.perf_counter()
+    build_pdf([Path(source) for source in sources], Path(target))
+    return {
+        'seconds': time.perf_counter() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_convert(sources:list, target:str) -> dict:
+    start = time.perf_counter()
+    subprocess.run(['convert', *sources, target], check=True, capture_output=True)
+    return {
+        'seconds': time.perf_counter() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PDF assembly benchmark')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--format', choices=['jpg', 'png'], default='jpg')
+    parser.add_argument('--run', nargs=3, metavar=('METHOD', 'FOLDER', 'TARGET'), help=argparse.SUPPRESS)
+    parser.add_argument('--make', metavar='FOLDER', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        make_pages(args.make, args.pages, args.dpi, args.format)
+        return
+    if args.run:
+        method, folder, target = args.run
+        sources = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.startswith('page'))
+        print(json.dumps((run_swis if method == 'swis' else run_convert)(sources, target)))
+        return
+
+    methods = ['swis'] + (['convert'] if shutil.which('convert') else [])
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        pages = os.path.join(folder, 'pages')
+        os.mkdir(pages)
+        subprocess.run(
+            [sys.executable, __file__, '--pages', str(args.pages), '--dpi', str(args.dpi),
+             '--format', args.format, '--make', pages],
+            check=True
+        )
+        for method in methods:
+            target = os.path.join(folder, f'{method}.pdf')
+            out = subprocess.run(
+                [sys.executable, __file__, '--run', method, pages, target],
+                capture_output=True, text=True, check=True
+            )
+            result = json.loads(out.stdout)
+            result.update({
+                'method': method,
+                'pages': args.pages,
+                'dpi': args.dpi,
+                'format': args.format,
+                'pdf_bytes': os.path.getsize(target),
+            })
+            results.append(result)
+            print(f'{method:8} {result["seconds"]:8.3f} s {result["peak_rss_kb"] / 1024:8.1f} MB {result["pdf_bytes"] / 1024 / 1024:8.1f} MB pdf', file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
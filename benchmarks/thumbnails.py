@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Compares thumbnail generation paths (time and peak RSS).
+#
+#   python benchmarks/thumbnails.py [--dpi 600] [--repeat 3]
+#
+# Samples are created and each measurement runs in a fresh process
+# (Linux keeps peak RSS across fork/exec, so the parent stays small).
+# Methods:
+#   legacy    - Image.open + thumbnail((128, 128)) as done before
+#   full      - full decode (load) + thumbnail, i.e. legacy path when the
+#               image was already decoded by the truncation check
+#   swis      - swis.core.thumbnails.save_thumbnail of opened file (draft + reducing_gap)
+#   inmemory  - thumbnail from image decoded while the scan is streamed
+#               (only the thumbnail part is measured)
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+METHODS = ['legacy', 'full', 'swis', 'inmemory']
+
+
+def run_method(method:str, source:str, target:str) -> dict:
+    from PIL import Image
+    from swis.core.thumbnails import save_thumbnail
+
+    start = time.perf_counter()
+    if method == 'legacy':
+        im = Image.open(source)
+        im.thumbnail((128, 128))
+        im.convert('RGB').save(target, 'JPEG')
+    elif method == 'full':
+        im = Image.open(source)
+        im.load()
+        im.thumbnail((128, 128))
+        im.convert('RGB').save(target, 'JPEG')
+    elif method == 'swis':
+        with Image.open(source) as im:
+            save_thumbnail(im, target)
+    elif method == 'inmemory':
+        im = Image.open(source)
+        im.load()
+        start = time.perf_counter()
+        save_thumbnail(im, target)
+    elapsed = time.perf_counter() - start
+    return {
+        'seconds': elapsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def make_sample(folder:str, fmt:str, dpi:int) -> str:
+    from PIL import Image, ImageDraw
+    width, height = int(8.27 * dpi), int(11.69 * dpi) # A4
+    im = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(im)
+    for y in range(0, height, max(1, dpi // 6)):
+        draw.line((0, y, width, y), fill=(y % 256, 64, 128), width=max(1, dpi // 100))
+    path = os.path.join(folder, f'sample.{fmt}')
+    im.save(path, 'JPEG' if fmt == 'jpg' else 'PNG', **({'quality': 90} if fmt == 'jpg' else {}))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Thumbnail generation benchmark')
+    parser.add_argument('--dpi', type=int, default=600)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--run', nargs=3, metavar=('METHOD', 'SOURCE', 'TARGET'), help=argparse.SUPPRESS)
+    parser.add_argument('--make', nargs=2, metavar=('FOLDER', 'FORMAT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_method(*args.run)))
+        return
+    if args.make:
+        print(make_sample(args.make[0], args.make[1], args.dpi))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for fmt in ['jpg', 'png']:
+            source = subprocess.run(
+                [sys.executable, __file__, '--dpi', str(args.dpi), '--make', folder, fmt],
+                capture_output=True, text=True, check=True
+            ).stdout.strip()
+            for method in METHODS:
+                runs = []
+                for _ in range(args.repeat):
+                    out = subprocess.run(
+                        [sys.executable, __file__, '--run', method, source, os.path.join(folder, 'thumb.jpg')],
+                        capture_output=True, text=True, check=True
+                    )
+                    runs.append(json.loads(out.stdout))
+                results.append({
+                    'format': fmt,
+                    'dpi': args.dpi,
+                    'method': method,
+                    'seconds': min(r['seconds'] for r in runs),
+                    'peak_rss_kb': max(r['peak_rss_kb'] for r in runs),
+                })
+                print(f'{fmt:4} {method:9} {results[-1]["seconds"]:8.3f} s {results[-1]["peak_rss_kb"] / 1024:8.1f} MB', file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import hashlib
+import io
+import os
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, List
+
+BLOBS_FOLDER = '.blobs'
+
+
+# File object that computes SHA-256 of everything written through it.
+# It has no fileno(), so Pillow writes encoded data through write() too.
+class HashingWriter(io.RawIOBase):
+    def __init__(self, f:BinaryIO):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.f.write(data)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+def hash_file(path:Path, chunk_size:int=1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Hard links `link` to `source`, replacing `link` if it exists
+def _link(source:Path, link:Path):
+    temporary = link.with_name(f'.{link.name}.{uuid.uuid4().hex}.link')
+    os.link(source, temporary)
+    os.replace(temporary, link)
+
+
+# Content-addressed storage in the scans folder: one blob per SHA-256
+# (.blobs/ab/abcd...) and files with friendly names are hard links to blobs,
+# so the number of references is the link count of the blob. Thumbnails
+# are kept per hash too (.blobs/thumbs/abcd....128.webp), so a duplicate
+# gets them by linking instead of decoding the image again.
+class BlobStore:
+    def __init__(self, folder:str):
+        self.scans = Path(folder)
+        self.folder = self.scans / BLOBS_FOLDER
+
+    def blob_path(self, digest:str) -> Path:
+        return self.folder / digest[:2] / digest
+
+    # Moves file to the store (or drops it when the same content is stored
+    # already) and links it as target. Returns True for a duplicate.
+    def store(self, source:Path, target:Path, digest:str) -> bool:
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        duplicate = blob.exists()
+        if duplicate:
+            if source.exists() and source.samefile(blob):
+                return True # stored already
+            if source != target:
+                source.unlink()
+        else:
+            os.replace(source, blob)
+        _link(blob, target)
+        return duplicate
+
+    # Number of friendly names linked to the blob
+    def references(self, digest:str) -> int:
+        try:
+            return self.blob_path(digest).stat().st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    # Called after a friendly name was removed (or replaced),
+    # removes the blob and its thumbnails when it is not used any more
+    def release(self, digest:str):
+        if self.references(digest) > 0:
+            return
+        self.blob_path(digest).unlink(missing_ok=True)
+        thumbs = self.folder / 'thumbs'
+        if thumbs.exists():
+            for thumbnail in thumbs.glob(f'{digest}.*'):
+                thumbnail.unlink(missing_ok=True)
+
+    # thumbs/2024/01/name.jpg.128.webp -> .blobs/thumbs/<digest>.128.webp
+    def _thumbnail_path(self, digest:str, filename:str, thumbnail:str) -> Path:
+        return self.folder / 'thumbs' / f'{digest}{Path(thumbnail).name[len(filename):]}'
+
+    # Links stored thumbnails of the content to the file thumbnails
+    # (names relative to the scans folder). Returns False if some are missing.
+    def link_thumbnails(self, digest:str, filename:str, thumbnails:List[str]) -> bool:
+        stored = [self._thumbnail_path(digest, filename, thumbnail) for thumbnail in thumbnails]
+        if not all(path.exists() for path in stored):
+            return False
+        for path, thumbnail in zip(stored, thumbnails):
+            (self.scans / thumbnail).parent.mkdir(parents=True, exist_ok=True)
+            _link(path, self.scans / thumbnail)
+        return True
+
+    # Keeps generated thumbnails of the file for other files with the same content
+    def keep_thumbnails(self, digest:str, filename:str, thumbnails:List[str]):
+        (self.folder / 'thumbs').mkdir(parents=True, exist_ok=True)
+        for thumbnail in thumbnails:
+            source = self.scans / thumbnail
+            if source.exists():
+                _link(source, self._thumbnail_path(digest, filename, thumbnail))
+
+
+@lru_cache()
+def get_blob_store(folder:str) -> BlobStore:
+    return BlobStore(folder)
@@ -0,0 +1,395 @@
+import base64
+import json
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from swis.core.locks import LOCKS_FOLDER, file_lock
+from swis.core.logger import get_logger
+from swis.core.storage import get_storage
+
+logger = get_logger()
+
+CATALOG_FILENAME = '.catalog.db'
+LISTED_SUFFIXES = ['.jpg', '.jpeg', '.png', '.tif', '.pdf']
+
+# sort name -> (column, descending)
+SORT_ORDERS = {
+    'newest': ('mtime', True),
+    'oldest': ('mtime', False),
+    'name': ('filename', False),
+    'name_desc': ('filename', True),
+    'largest': ('size', True),
+    'smallest': ('size', False),
+}
+
+
+# Full-text index columns and their bm25 weights
+SEARCH_COLUMNS = ('filename', 'org_filename', 'tags', 'text')
+SEARCH_WEIGHTS = (10.0, 5.0, 8.0, 1.0)
+# index row of scans matching the condition (text only of the current
+# content, stale text of a changed file is ignored)
+SEARCH_ROW = (
+    'INSERT INTO search (rowid, filename, org_filename, tags, text) '
+    'SELECT s.rowid, s.filename, m.org_filename, m.tags, t.text FROM scans s '
+    'LEFT JOIN metadata m USING (filename) '
+    'LEFT JOIN texts t ON t.filename = s.filename AND t.mtime = s.mtime AND t.size = s.size WHERE {}'
+)
+# changed with SEARCH_ROW, older index and its triggers are rebuilt (user_version of the database)
+SEARCH_VERSION = 1
+SEARCH_TRIGGERS = ['scans_search_insert', 'scans_search_delete'] + [
+    f'{table}_search_{event}' for table in ('metadata', 'texts') for event in ('insert', 'update', 'delete')
+]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# FTS5 expression for user query: every word is a prefix that must match,
+# `column:word` limits the word to one column (e.g. tags:invoice)
+def search_expression(query:str) -> str:
+    terms = []
+    for token in query.split():
+        column, separator, rest = token.partition(':')
+        if separator and column in SEARCH_COLUMNS:
+            terms.extend(f'{column} : "{word}"*' for word in re.findall(r'\w+', rest))
+        else:
+            terms.extend(f'"{word}"*' for word in re.findall(r'\w+', token))
+    return ' AND '.join(terms)
+
+
+# Cursor points at the last returned item (sort key and filename as tie breaker)
+def encode_cursor(key, filename:str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([key, filename]).encode()).decode()
+
+
+def decode_cursor(cursor:str) -> tuple:
+    try:
+        key, filename = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return key, filename
+    except Exception:
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+
+
+class CatalogItem:
+    __slots__ = ('filename', 'mtime', 'size', 'format', 'width', 'height', 'thumbnail', 'hash')
+
+    def __init__(self, filename, mtime, size, format, width, height, thumbnail, hash=None):
+        self.filename = filename
+        self.mtime = mtime
+        self.size = size
+        self.format = format
+        self.width = width
+        self.height = height
+        self.thumbnail = thumbnail
+        self.hash = hash # SHA-256 of content when it is in the content store
+
+
+# Persistent index of files in the scans folder (SQLite database inside the folder)
+# so the listing doesn't need to walk and stat the whole directory.
+# Files are found through the storage (shards and archive, see Storage).
+class Catalog:
+    def __init__(self, folder:str, archive:Optional[str]=None, sharded:bool=False):
+        self.folder = Path(folder)
+        self.storage = get_storage(folder, archive, sharded)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.folder / CATALOG_FILENAME), check_same_thread=False, timeout=30)
+        # worker processes open the catalog at the same time
+        with file_lock(self.folder / LOCKS_FOLDER / 'catalog.lock'):
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS scans (
+                    filename TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    format TEXT NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    thumbnail TEXT,
+                    hash TEXT
+                )
+            ''')
+            columns = [column[1] for column in self._db.execute('PRAGMA table_info(scans)')]
+            if 'hash' not in columns: # catalog created by older version
+                self._db.execute('ALTER TABLE scans ADD COLUMN hash TEXT')
+            # text recognized in images (mtime and size of the file it was read from)
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS texts (
+                    filename TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    words TEXT NOT NULL
+                )
+            ''')
+            # original names of uploads and user tags (JSON list)
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    filename TEXT PRIMARY KEY,
+                    org_filename TEXT,
+                    tags TEXT
+                )
+            ''')
+            self._create_search()
+            self._db.execute('CREATE INDEX IF NOT EXISTS scans_mtime ON scans (mtime)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS scans_size ON scans (size)')
+            self._db.commit()
+
+    # Full-text index (rowid is rowid of the scan) kept up to date by triggers
+    # on scans, metadata and texts, so every change of the catalog is indexed
+    def _create_search(self):
+        self._db.execute('PRAGMA recursive_triggers = ON') # INSERT OR REPLACE fires delete triggers
+        created = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'search'").fetchone() is None
+        outdated = self._db.execute('PRAGMA user_version').fetchone()[0] < SEARCH_VERSION
+        if outdated:
+            for trigger in SEARCH_TRIGGERS:
+                self._db.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        self._db.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5({", ".join(SEARCH_COLUMNS)}, '
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        self._db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS scans_search_insert AFTER INSERT ON scans BEGIN
+                {SEARCH_ROW.format('s.rowid = new.rowid')};
+            END
+        ''')
+        self._db.execute('''
+            CREATE TRIGGER IF NOT EXISTS scans_search_delete AFTER DELETE ON scans BEGIN
+                DELETE FROM search WHERE rowid = old.rowid;
+            END
+        ''')
+        for table in ('metadata', 'texts'):
+            for event, row in (('insert', 'new'), ('update', 'new'), ('delete', 'old')):
+                self._db.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_search_{event} AFTER {event.upper()} ON {table} BEGIN
+                        DELETE FROM search WHERE rowid = (SELECT rowid FROM scans WHERE filename = {row}.filename);
+                        {SEARCH_ROW.format(f's.filename = {row}.filename')};
+                    END
+                ''')
+        if created or outdated: # catalog created by older version
+            self._db.execute('DELETE FROM search')
+            self._db.execute(SEARCH_ROW.format('1'))
+            self._db.execute(f'PRAGMA user_version = {SEARCH_VERSION}')
+
+    def _execute(self, sql:str, params:tuple=()) -> list:
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+            return rows
+
+    # Stat the file and read image dimensions (header only)
+    def add(self, filename:str, thumbnail:Optional[str]=None, hash:Optional[str]=None) -> Optional[CatalogItem]:
+        path = self.storage.path(filename)
+        if Path(filename).suffix not in LISTED_SUFFIXES:
+            return None
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self.remove(filename)
+            return None
+        width = height = None
+        suffix = Path(filename).suffix.lower() # also of recompressed file
+        if suffix not in ['.pdf']:
+            try:
+                with Image.open(path) as im:
+                    width, height = im.size
+            except Exception as ex:
+                logger.warning(f'Cannot read dimensions of {filename}: {ex}')
+        item = CatalogItem(filename, st.st_mtime, st.st_size, suffix.lstrip('.'), width, height, thumbnail, hash)
+        self._execute(
+            f'INSERT OR REPLACE INTO scans ({", ".join(CatalogItem.__slots__)}) VALUES ({", ".join("?" * len(CatalogItem.__slots__))})',
+            tuple(getattr(item, field) for field in CatalogItem.__slots__)
+        )
+        return item
+
+    def remove(self, filename:str):
+        self._execute('DELETE FROM scans WHERE filename = ?', (filename,))
+        self._execute('DELETE FROM texts WHERE filename = ?', (filename,))
+        self._execute('DELETE FROM metadata WHERE filename = ?', (filename,))
+
+    def set_thumbnail(self, filename:str, thumbnail:Optional[str]):
+        self._execute('UPDATE scans SET thumbnail = ? WHERE filename = ?', (thumbnail, filename))
+
+    def hash_of(self, filename:str) -> Optional[str]:
+        rows = self._execute('SELECT hash FROM scans WHERE filename = ?', (filename,))
+        return rows[0][0] if rows else None
+
+    # (filename, thumbnail) of items with generated thumbnails
+    def thumbnails(self) -> List[Tuple[str, str]]:
+        return self._execute("SELECT filename, thumbnail FROM scans WHERE thumbnail LIKE 'thumbs/%'")
+
+    def pending_thumbnails(self) -> List[str]:
+        rows = self._execute("SELECT filename FROM scans WHERE thumbnail IS NULL AND format != 'pdf'")
+        return [filename for filename, in rows]
+
+    # words: {'width': ..., 'height': ..., 'words': [[left, top, width, height, word], ...]}
+    def set_text(self, filename:str, mtime:float, size:int, text:str, words:dict):
+        self._execute(
+            'INSERT OR REPLACE INTO texts (filename, mtime, size, text, words) VALUES (?, ?, ?, ?, ?)',
+            (filename, mtime, size, text, json.dumps(words))
+        )
+
+    # Text and words of the current file content, None if not recognized yet
+    def get_text(self, filename:str) -> Optional[Tuple[str, dict]]:
+        rows = self._execute(
+            'SELECT t.text, t.words FROM texts t JOIN scans s USING (filename) '
+            'WHERE filename = ? AND t.mtime = s.mtime AND t.size = s.size',
+            (filename,)
+        )
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    # Sets given values (None keeps the current one)
+    def set_metadata(self, filename:str, org_filename:Optional[str]=None, tags:Optional[List[str]]=None):
+        self._execute(
+            'INSERT INTO metadata (filename, org_filename, tags) VALUES (?, ?, ?) '
+            'ON CONFLICT (filename) DO UPDATE SET '
+            'org_filename = coalesce(excluded.org_filename, org_filename), tags = coalesce(excluded.tags, tags)',
+            (filename, org_filename, json.dumps(tags) if tags is not None else None)
+        )
+
+    # Original name and tags
+    def get_metadata(self, filename:str) -> Tuple[Optional[str], List[str]]:
+        rows = self._execute('SELECT org_filename, tags FROM metadata WHERE filename = ?', (filename,))
+        if not rows:
+            return None, []
+        return rows[0][0], json.loads(rows[0][1]) if rows[0][1] else []
+
+    # Ranked page of items matching the query with snippets of their text,
+    # and the number of all matching items
+    def search(self, query:str, limit:int, offset:int=0) -> Tuple[List[Tuple[CatalogItem, str]], int]:
+        expression = search_expression(query)
+        if not expression:
+            return [], 0
+        total = self._execute('SELECT COUNT(*) FROM search WHERE search MATCH ?', (expression,))[0][0]
+        rows = self._execute(
+            f"SELECT s.*, snippet(search, {SEARCH_COLUMNS.index('text')}, '[', ']', '…', 12) "
+            'FROM search JOIN scans s ON s.rowid = search.rowid WHERE search MATCH ? '
+            f'ORDER BY bm25(search, {", ".join(map(str, SEARCH_WEIGHTS))}) LIMIT ? OFFSET ?',
+            (expression, limit, offset)
+        )
+        return [(CatalogItem(*row[:-1]), row[-1] or '') for row in rows], total
+
+    # Images without text of their current content
+    def pending_texts(self) -> List[str]:
+        rows = self._execute(
+            "SELECT s.filename FROM scans s LEFT JOIN texts t USING (filename) "
+            "WHERE s.format != 'pdf' AND (t.filename IS NULL OR t.mtime != s.mtime OR t.size != s.size)"
+        )
+        return [filename for filename, in rows]
+
+    def get(self, filename:str) -> Optional[CatalogItem]:
+        rows = self._execute('SELECT * FROM scans WHERE filename = ?', (filename,))
+        return CatalogItem(*rows[0]) if rows else None
+
+    def list(self, offset:int=0, limit:int=-1) -> List[CatalogItem]:
+        rows = self._execute(
+            'SELECT * FROM scans ORDER BY mtime DESC, filename DESC LIMIT ? OFFSET ?',
+            (limit, offset)
+        )
+        return [CatalogItem(*row) for row in rows]
+
+    def count(self) -> int:
+        return self._execute('SELECT COUNT(*) FROM scans')[0][0]
+
+    # Number of items and their total size (bytes) per format
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        rows = self._execute('SELECT format, COUNT(*), SUM(size) FROM scans GROUP BY format')
+        return {fmt: (count, size) for fmt, count, size in rows}
+
+    # Returns page of filtered items, total number of matching items
+    # (first page only, None with cursor) and the cursor of the next page
+    # (None if it is the last one)
+    def query(
+        self,
+        limit:int,
+        cursor:Optional[str]=None,
+        sort:str='newest',
+        formats:Optional[List[str]]=None,
+        since:Optional[float]=None,
+        until:Optional[float]=None,
+        prefix:Optional[str]=None,
+    ) -> Tuple[List[CatalogItem], Optional[int], Optional[str]]:
+        column, descending = SORT_ORDERS[sort]
+        where, params = [], []
+        if formats:
+            where.append(f'format IN ({", ".join("?" * len(formats))})')
+            params.extend(formats)
+        if since is not None:
+            where.append('mtime >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('mtime < ?')
+            params.append(until)
+        if prefix:
+            where.append('filename >= ? AND filename < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        total = None
+        if cursor:
+            where.append(f'({column}, filename) {"<" if descending else ">"} (?, ?)')
+            params.extend(decode_cursor(cursor))
+        else:
+            filters = ' AND '.join(where) or '1'
+            total = self._execute(f'SELECT COUNT(*) FROM scans WHERE {filters}', tuple(params))[0][0]
+        direction = 'DESC' if descending else 'ASC'
+        rows = self._execute(
+            f'SELECT * FROM scans WHERE {" AND ".join(where) or "1"} '
+            f'ORDER BY {column} {direction}, filename {direction} LIMIT ?',
+            tuple(params) + (limit + 1,)
+        )
+        items = [CatalogItem(*row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(getattr(last, column), last.filename)
+        return items, total, next_cursor
+
+    # Synchronize index with the folder content.
+    # Removes missing files and returns names of new or modified ones
+    # (to be registered by the caller). With `filenames` only the given
+    # files are checked (e.g. files just moved to their shards).
+    def reconcile(self, filenames:Optional[List[str]]=None) -> List[str]:
+        if filenames is not None:
+            changed = []
+            for filename in filenames:
+                item = self.get(filename)
+                try:
+                    st = self.storage.path(filename).stat()
+                except FileNotFoundError:
+                    if item is not None:
+                        self.remove(filename)
+                    continue
+                if item is None or (item.mtime, item.size) != (st.st_mtime, st.st_size):
+                    changed.append(filename)
+            return changed
+        known = {
+            filename: (mtime, size)
+            for filename, mtime, size in self._execute('SELECT filename, mtime, size FROM scans')
+        }
+        changed = []
+        for filename, entry in self.storage.files(LISTED_SUFFIXES):
+            st = entry.stat()
+            if known.pop(filename, None) != (st.st_mtime, st.st_size):
+                changed.append(filename)
+        for filename in known:
+            self.remove(filename)
+        logger.info(f'Catalog reconciled: {len(changed)} new or modified, {len(known)} removed')
+        return changed
+
+
+_catalogs_lock = threading.Lock()
+
+@lru_cache()
+def _open_catalog(folder:str, archive:Optional[str]=None, sharded:bool=False) -> Catalog:
+    return Catalog(folder, archive, sharded)
+
+# One catalog per folder, also when first requested from several threads at once
+def get_catalog(folder:str, archive:Optional[str]=None, sharded:bool=False) -> Catalog:
+    with _catalogs_lock:
+        return _open_catalog(folder, archive, sharded)
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseSettings
 from functools import lru_cache
 
@@ -12,6 +12,35 @@ class Settings(BaseSettings):
     APP_ADDRESS: str
     LOG_LEVEL: str
     BUFFER_SIZE: int
+    DEVICES_TTL: float # seconds between scanner discoveries
+    JOBS_HISTORY: int
+    PDF_CONCURRENCY: int
+    PRINT_DEDUP_WINDOW: float # seconds, same print submitted again is ignored
+    PRINT_POLL_INTERVAL: float # seconds between lpstat checks of pending print jobs
+    FILE_WORKERS: int # threads for blocking file operations of async handlers
+    IMAGE_WORKERS: int # threads for image decoding/encoding of async handlers (at background priority)
+    CATALOG_WORKERS: int # threads for catalog queries of listing and search
+    UPLOAD_SIZE_LIMIT: int # bytes
+    UPLOAD_CHUNK_SIZE: int # bytes
+    UPLOAD_SESSION_CHUNK_SIZE: int # bytes
+    UPLOAD_SESSION_TTL: float # seconds
+    PREVIEW_INTERVAL: float
+    PREVIEW_SIZE: int
+    THUMBNAIL_WORKERS: int
+    THUMBNAIL_QUEUE_SIZE: int
+    RENDITION_SIZES: List[int] # JSON list, e.g. [512, 1600]
+    RENDITION_FORMAT: str # webp or jpeg
+    CONTENT_STORE: bool # store files once per content (hard links to .blobs)
+    OCR: bool # recognize text of images (needs tesseract)
+    OCR_LANGUAGES: str # tesseract -l, e.g. eng+deu
+    OCR_WORKERS: int # processes running tesseract at idle priority
+    WORKERS: int # server processes (main --workers), they share jobs and locks when > 1
+    JOBS_SYNC_INTERVAL: float # seconds between publishing job status to the other workers
+    STORAGE_SHARDS: bool # keep scans in dated subfolders (2024/01/...) of the scans folder, existing files are moved at startup
+    STORAGE_INTERVAL: float # seconds between storage maintenance passes
+    COMPRESS_AGE: float # days, older color PNG/TIFF scans are recompressed to lossless WebP (0 = never)
+    ARCHIVE_AGE: float # days, older scans are moved to ARCHIVE_FOLDER (0 = never)
+    ARCHIVE_FOLDER: Optional[str]
     USER: Optional[str]
     GROUP: Optional[str]
     
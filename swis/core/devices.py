@@ -0,0 +1,220 @@
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from swis.core.locks import LockBusy, Locks
+from swis.core.logger import get_logger
+from swis.core.schemas import ProcessResult
+
+logger = get_logger()
+
+# scanimage -f: one device per line, fields separated by tabs
+DEVICE_LIST_FORMAT = '%d\t%v\t%m\t%t%n'
+OPTION_PATTERN = re.compile(r'^\s+(--?[\w-]+)\s+(.*?)\s*(?:\[(.*)\])?\s*$')
+RANGE_PATTERN = re.compile(r'^(-?[\d.]+)\.\.(-?[\d.]+)')
+DEVICES_FILENAME = '.devices.json' # last discovery, shared by worker processes
+
+
+class Device:
+    def __init__(self, name:str, vendor:str='', model:str='', type:str=''):
+        self.name = name
+        self.vendor = vendor
+        self.model = model
+        self.type = type
+        self.modes: List[str] = []
+        self.resolutions: List[int] = [] # supported values, when the device has a list
+        self.resolution_range: Optional[Tuple[float, float]] = None
+        self.sources: List[str] = []
+        self.width: Optional[float] = None # mm (max -x)
+        self.height: Optional[float] = None # mm (max -y)
+        self.options_loaded = False
+
+    # Source for document feeder scanning (names differ between backends)
+    def feeder_source(self, duplex:bool) -> Optional[str]:
+        feeders = [s for s in self.sources if re.search(r'adf|feeder', s, re.I)]
+        for source in feeders:
+            if bool(re.search(r'duplex', source, re.I)) == duplex:
+                return source
+        return None
+
+    # Checks scan parameters against known options, returns problem description
+    def check(self, mode:str, resolution:str, source:Optional[str]=None) -> Optional[str]:
+        if self.modes and mode.lower() not in (m.lower() for m in self.modes):
+            return f'Mode {mode} is not supported by {self.name} ({", ".join(self.modes)})'
+        try:
+            dpi = float(resolution)
+        except ValueError:
+            return f'Invalid resolution {resolution}'
+        if self.resolutions and dpi not in self.resolutions:
+            return f'Resolution {resolution} is not supported by {self.name} ({", ".join(map(str, self.resolutions))})'
+        if self.resolution_range and not self.resolution_range[0] <= dpi <= self.resolution_range[1]:
+            return f'Resolution {resolution} is out of range {self.resolution_range[0]:g}-{self.resolution_range[1]:g} of {self.name}'
+        if source and self.sources and source.lower() not in (s.lower() for s in self.sources):
+            return f'Source {source} is not supported by {self.name} ({", ".join(self.sources)})'
+        return None
+
+
+def parse_device_list(output:str) -> List[Device]:
+    devices = []
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 4 and fields[0]:
+            devices.append(Device(*fields))
+    return devices
+
+
+def _number(value:str) -> float:
+    return float(re.match(r'-?[\d.]+', value).group())
+
+# Reads modes, resolutions, sources and scan area from `scanimage -A` output
+def parse_options(device:Device, output:str):
+    for line in output.splitlines():
+        match = OPTION_PATTERN.match(line)
+        if not match:
+            continue
+        option, values = match.group(1), match.group(2)
+        values = re.sub(r'\s*\(.*\)$', '', values) # "(in steps of 1)", "(core option)" ...
+        area = RANGE_PATTERN.match(values)
+        try:
+            if option == '--mode':
+                device.modes = [v for v in values.split('|') if v]
+            elif option == '--source':
+                device.sources = [v for v in values.split('|') if v]
+            elif option == '--resolution':
+                if area:
+                    device.resolution_range = (float(area.group(1)), float(area.group(2)))
+                else:
+                    device.resolutions = [int(_number(v)) for v in values.split('|') if v]
+            elif option == '-x' and area:
+                device.width = float(area.group(2))
+            elif option == '-y' and area:
+                device.height = float(area.group(2))
+        except (AttributeError, ValueError):
+            pass # unusual option format, keep defaults
+    device.options_loaded = True
+
+
+# Device as saved in the shared discovery result
+def device_state(device:Device) -> dict:
+    return dict(vars(device))
+
+def load_device(state:dict) -> Device:
+    device = Device(state['name'])
+    vars(device).update(state)
+    if device.resolution_range is not None:
+        device.resolution_range = tuple(device.resolution_range)
+    return device
+
+
+# Cache of SANE devices. Discovery (scanimage -L) and reading of device
+# options (scanimage -A) can take seconds with network backends, so it is
+# done in background and scans use device names from the cache.
+# One worker process discovers at a time and saves the result to the shared
+# file, the others use it while it is fresh. Options of a device are not read
+# while it scans (its device lock is held), the last known ones are kept.
+class DeviceRegistry:
+    def __init__(self, run:Callable[[list], ProcessResult], ttl:float, locks:Callable[[], Locks], shared:Callable[[], Path]):
+        self.run = run
+        self.ttl = ttl
+        self.locks = locks
+        self.shared = shared
+        self.devices: Dict[str, Device] = {}
+        self.refreshed: Optional[float] = None
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+
+    # `force` asks for a discovery started after the call (the result of
+    # another worker's discovery started later is used too)
+    def refresh(self, force:bool=False):
+        requested = time.time()
+        # only one discovery at a time, others wait for its result
+        with self._refreshing, self.locks().lock('devices'):
+            state = self._load()
+            if state is not None and state['refreshed'] >= (requested if force else requested - self.ttl):
+                self._apply(state)
+                return
+            state = self._discover(state)
+            self._apply(state)
+            self._save(state)
+
+    def _discover(self, state:Optional[dict]) -> dict:
+        known = {device['name']: load_device(device) for device in state['devices']} if state else {}
+        with self._lock:
+            known.update(self.devices)
+        p = self.run(['scanimage', f'--formatted-device-list={DEVICE_LIST_FORMAT}'])
+        if p.returncode != 0:
+            error = p.stderr.strip() or f'scanimage exited with {p.returncode}'
+            logger.warning(f'Problem with discovering scanners: {error}')
+            return {'refreshed': time.time(), 'error': error, 'devices': [device_state(d) for d in known.values()]}
+        devices = []
+        for device in parse_device_list(p.stdout):
+            previous = known.get(device.name)
+            try:
+                with self.locks().lock(f'device-{device.name}', blocking=False):
+                    p = self.run(['scanimage', '-d', device.name, '--all-options'])
+            except LockBusy:
+                logger.debug(f'Options of {device.name} not read, it is scanning')
+                p = None
+            if p is not None and p.returncode == 0:
+                parse_options(device, p.stdout)
+            else:
+                if p is not None:
+                    logger.warning(f'Problem with reading options of {device.name}: {p.stderr.strip()}')
+                if previous is not None and previous.options_loaded:
+                    device = previous
+            devices.append(device_state(device))
+        return {'refreshed': time.time(), 'error': None, 'devices': devices}
+
+    def _apply(self, state:dict):
+        devices = {device['name']: load_device(device) for device in state['devices']}
+        with self._lock:
+            self.devices = devices
+            self.error = state['error']
+            self.refreshed = state['refreshed']
+
+    def _load(self) -> Optional[dict]:
+        try:
+            return json.loads(self.shared().read_text())
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as ex:
+            logger.warning(f'Cannot read {self.shared()}: {ex}')
+            return None
+
+    def _save(self, state:dict):
+        path = self.shared()
+        partial = path.with_name(f'{path.name}.part')
+        partial.write_text(json.dumps(state))
+        os.replace(partial, path)
+
+    def list(self) -> List[Device]:
+        with self._lock:
+            return list(self.devices.values())
+
+    def get(self, name:str) -> Optional[Device]:
+        with self._lock:
+            return self.devices.get(name)
+
+    # Device used when the scan request does not name one
+    def default(self) -> Optional[Device]:
+        with self._lock:
+            return next(iter(self.devices.values()), None)
+
+    def start_refresher(self):
+        def refresh_forever():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as ex:
+                    logger.warning(f'Problem with discovering scanners: {ex}')
+                    self.error = str(ex)
+                time.sleep(self.ttl)
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=refresh_forever, name='swis-devices', daemon=True)
+            self._refresher.start()
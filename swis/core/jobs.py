@@ -0,0 +1,328 @@
+import asyncio
+import functools
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from swis.core.logger import get_logger
+
+logger = get_logger()
+
+JOBS_FILENAME = '.jobs.db'
+
+# Nice value of background work (jobs, image work of handlers),
+# so that on a busy machine request handling gets the CPU first
+BACKGROUND_NICE = 10
+
+
+# Lowers CPU priority of the calling thread (on Linux the nice value is per
+# thread) and of the processes it starts, e.g. scanimage
+def background_priority():
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, BACKGROUND_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+# Worker processes (and the processes they start, e.g. tesseract) get CPU
+# only when it is idle
+def idle_priority():
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        os.nice(19)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    _counter = itertools.count()
+
+    def __init__(self, kind:str, key:str, func:Callable, args:tuple):
+        self.id = uuid.uuid4().hex
+        self.seq = next(Job._counter)
+        self.kind = kind
+        self.key = key
+        self.func = func
+        self.args = args
+        self.status = Job.QUEUED
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result = None
+        self.error: Optional[str] = None
+        self.progress: float = 0.0 # percent, reported by the job function
+        self.steps: int = 0 # finished units of work (e.g. pages), reported by the job function
+        self.cancelled = False
+
+    @property
+    def finished_or_failed(self) -> bool:
+        return self.status in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    # Running job functions call it between steps to stop when cancelled
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def run(self):
+        self.status = Job.RUNNING
+        self.started = time.time()
+        try:
+            self.check_cancelled()
+            self.result = self.func(self, *self.args)
+            self.progress = 100.0
+            self.status = Job.DONE
+        except JobCancelled:
+            logger.info(f'Job {self.id} ({self.kind}) cancelled')
+            self.status = Job.CANCELLED
+        except Exception as ex:
+            logger.exception(f'Job {self.id} ({self.kind}) failed')
+            self.error = str(ex)
+            self.status = Job.FAILED
+        finally:
+            self.finished = time.time()
+
+
+# Runs submitted jobs in background threads (at background priority).
+# Jobs sharing the same key (e.g. SANE device) are executed one by one
+# (or by at most `concurrency` workers), jobs with different keys run in parallel.
+class JobQueue:
+    def __init__(self, kind:str, history:int=200, concurrency:int=1):
+        self.kind = kind
+        self.history = history
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = OrderedDict()
+        self._queues: Dict[str, deque] = {}
+        self._workers: Dict[str, int] = {} # key -> number of running workers
+
+    def submit(self, key:str, func:Callable, *args) -> Job:
+        job = Job(self.kind, key, func, args)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._queues.setdefault(key, deque()).append(job)
+            if self._workers.get(key, 0) < self.concurrency:
+                self._workers[key] = self._workers.get(key, 0) + 1
+                threading.Thread(
+                    target=self._work,
+                    args=(key,),
+                    name=f'swis-{self.kind}-{key}',
+                    daemon=True
+                ).start()
+            self._prune()
+        return job
+
+    def _work(self, key:str):
+        background_priority()
+        while True:
+            with self._lock:
+                queue = self._queues.get(key)
+                if not queue:
+                    self._queues.pop(key, None)
+                    self._workers[key] -= 1
+                    if not self._workers[key]:
+                        del self._workers[key]
+                    return
+                job = queue.popleft()
+            job.run()
+
+    # Forget the oldest finished jobs over the history limit
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_or_failed]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id:str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    # Number of jobs that have to finish before the given one starts
+    def position(self, job:Job) -> int:
+        if job.status != Job.QUEUED:
+            return 0
+        with self._lock:
+            queue = self._queues.get(job.key, ())
+            ahead = sum(1 for j in queue if j.seq < job.seq)
+            running = sum(1 for j in self._jobs.values() if j.key == job.key and j.status == Job.RUNNING)
+        return max(0, ahead + running - self.concurrency + 1)
+
+    # Queued job is removed at once, running one stops at its next check_cancelled
+    def cancel(self, job:Job) -> bool:
+        with self._lock:
+            if job.finished_or_failed:
+                return False
+            job.cancelled = True
+            queue = self._queues.get(job.key)
+            if job.status == Job.QUEUED and queue is not None and job in queue:
+                queue.remove(job)
+                job.status = Job.CANCELLED
+                job.finished = time.time()
+        return True
+
+    def depth(self) -> int:
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+# Thread pool for blocking work called from async handlers (file I/O,
+# image decoding). Each kind of work gets its own pool with a fixed number
+# of threads, so it cannot starve the others or the event loop.
+# Threads of a `background` pool run at background priority.
+class BoundedExecutor:
+    def __init__(self, name:str, workers:int, background:bool=False):
+        self.name = name
+        self.workers = workers
+        self.in_flight = 0 # submitted and not finished (changed on the event loop only)
+        self._executor = ThreadPoolExecutor(
+            workers,
+            thread_name_prefix=f'swis-{name}',
+            initializer=background_priority if background else None
+        )
+
+    async def run(self, func:Callable, *args, **kwargs):
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+# Status of jobs shared by worker processes (multi-worker mode). Every worker
+# publishes status of its jobs (JSON of the status schema) to SQLite database
+# and finds jobs of the other workers there. Job of another worker is
+# cancelled by a request that its owner picks up when it publishes next time.
+class JobStore:
+    def __init__(self, path:str):
+        self.owner = os.getpid()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                owner INTEGER NOT NULL,
+                created REAL NOT NULL,
+                finished INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                cancel INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_kind ON jobs (kind, created)')
+        # metric values of every worker (snapshot of swis.core.metrics)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS metrics (
+                owner INTEGER PRIMARY KEY,
+                updated REAL NOT NULL,
+                snapshot TEXT NOT NULL
+            )
+        ''')
+
+    def _execute(self, sql:str, params:tuple=()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # jobs: (id, created, finished, status JSON)
+    def publish(self, kind:str, jobs:List[tuple]):
+        if not jobs:
+            return
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany(
+                    'INSERT INTO jobs (id, kind, owner, created, finished, status) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (id) DO UPDATE SET finished = excluded.finished, status = excluded.status',
+                    [(job_id, kind, self.owner, created, int(finished), status) for job_id, created, finished, status in jobs]
+                )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def get(self, kind:str, job_id:str) -> Optional[str]:
+        rows = self._execute('SELECT status FROM jobs WHERE id = ? AND kind = ?', (job_id, kind))
+        return rows[0][0] if rows else None
+
+    # Jobs of the other workers, oldest first
+    def list(self, kind:str) -> List[str]:
+        rows = self._execute('SELECT status FROM jobs WHERE kind = ? AND owner != ? ORDER BY created', (kind, self.owner))
+        return [status for status, in rows]
+
+    # Returns False when the job is not known or has finished already
+    def request_cancel(self, kind:str, job_id:str) -> bool:
+        with self._lock:
+            cursor = self._db.execute('UPDATE jobs SET cancel = 1 WHERE id = ? AND kind = ? AND finished = 0', (job_id, kind))
+            return cursor.rowcount > 0
+
+    # Ids of own jobs other workers asked to cancel (each returned once)
+    def cancel_requests(self, kind:str) -> List[str]:
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(
+                    'SELECT id FROM jobs WHERE kind = ? AND owner = ? AND cancel = 1', (kind, self.owner)
+                ).fetchall()
+                self._db.execute('UPDATE jobs SET cancel = 0 WHERE kind = ? AND owner = ? AND cancel = 1', (kind, self.owner))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return [job_id for job_id, in rows]
+
+    def publish_metrics(self, snapshot:str):
+        self._execute(
+            'INSERT OR REPLACE INTO metrics (owner, updated, snapshot) VALUES (?, ?, ?)',
+            (self.owner, time.time(), snapshot)
+        )
+
+    # Metric snapshots of the other workers
+    def metrics(self) -> List[str]:
+        rows = self._execute('SELECT snapshot FROM metrics WHERE owner != ?', (self.owner,))
+        return [snapshot for snapshot, in rows]
+
+    # Forgets the oldest finished jobs over the history limit (per kind)
+    # and jobs and metrics of worker processes that are gone
+    def prune(self, history:int):
+        owners = self._execute('SELECT DISTINCT owner FROM jobs WHERE finished = 0 UNION SELECT owner FROM metrics')
+        for owner, in owners:
+            try:
+                os.kill(owner, 0)
+            except ProcessLookupError:
+                self._execute('DELETE FROM jobs WHERE owner = ? AND finished = 0', (owner,))
+                self._execute('DELETE FROM metrics WHERE owner = ?', (owner,))
+            except PermissionError:
+                pass # exists
+        self._execute(
+            'DELETE FROM jobs WHERE finished = 1 AND id IN (SELECT id FROM ('
+            'SELECT id, row_number() OVER (PARTITION BY kind ORDER BY created DESC) AS n FROM jobs WHERE finished = 1'
+            ') WHERE n > ?)',
+            (history,)
+        )
+
+
+@functools.lru_cache()
+def get_job_store(path:str) -> JobStore:
+    return JobStore(path)
@@ -0,0 +1,69 @@
+import fcntl
+import os
+import re
+import zlib
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+LOCKS_FOLDER = '.locks'
+STRIPES = 64 # lock files shared by many keys (e.g. one per thumbnail would never be removed)
+
+
+class LockBusy(Exception):
+    pass
+
+
+# Exclusive lock held by one thread of one process at a time (flock of lock
+# file, so it also works between worker processes and is released when the
+# process dies). Lock files are never removed, removing them would let two
+# holders lock different files of the same name.
+@contextmanager
+def file_lock(path:Path, blocking:bool=True):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            raise LockBusy(str(path))
+        try:
+            yield fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+# Named locks and sequences shared by worker processes (files in the locks folder)
+class Locks:
+    def __init__(self, folder:str):
+        self.folder = Path(folder)
+
+    def path(self, name:str) -> Path:
+        safe = re.sub(r'[^\w.-]', '_', name)
+        if safe != name:
+            # e.g. SANE device names with colons and spaces
+            safe = f'{safe}-{zlib.crc32(name.encode()):08x}'
+        return self.folder / f'{safe}.lock'
+
+    def lock(self, name:str, blocking:bool=True):
+        return file_lock(self.path(name), blocking)
+
+    # Lock for a key from a large set, shared with other keys of the same stripe
+    def striped(self, name:str, key:str, blocking:bool=True):
+        return file_lock(self.path(f'{name}-{zlib.crc32(key.encode()) % STRIPES:02d}'), blocking)
+
+    # Next number of the named sequence (1, 2, 3 ...), never the same in any process
+    def next_value(self, name:str) -> int:
+        with self.lock(name) as fd:
+            data = os.pread(fd, 32, 0)
+            value = int(data) + 1 if data.strip() else 1
+            text = f'{value:<20}'.encode() # fixed width, so the old value is overwritten
+            os.pwrite(fd, text, 0)
+        return value
+
+
+@lru_cache()
+def get_locks(folder:str) -> Locks:
+    return Locks(folder)
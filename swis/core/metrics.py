@@ -0,0 +1,254 @@
+import bisect
+import json
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Metrics in Prometheus text format (no client library needed). Values are
+# kept per tuple of label values; updates take one lock and a dict lookup.
+# With several worker processes each one publishes its values (snapshot)
+# and /metrics adds up the values of all of them (render).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROCESS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REGISTRY: List['Metric'] = []
+
+
+def _escape(value:str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(value:float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = 'untyped'
+    aggregated = True # summed over worker processes (see snapshot)
+
+    def __init__(self, name:str, help:str, labels:Tuple[str, ...]=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _labels(self, values:tuple, extra:str='') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    # Values of this process: {label values tuple: value}
+    @abstractmethod
+    def collect(self) -> Dict[tuple, object]:
+        pass
+
+    # Adds values of another process to the total
+    def merge(self, total:Dict[tuple, object], values:Dict[tuple, object]):
+        for labels, value in values.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def samples(self, values:Dict[tuple, object]) -> List[str]:
+        return [f'{self.name}{self._labels(labels)} {_format(value)}' for labels, value in values.items()]
+
+    def render(self, others:List[Dict[tuple, object]]=()) -> str:
+        values = self.collect()
+        for other in others:
+            self.merge(values, other)
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples(values))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name:str, help:str, labels:Tuple[str, ...]=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount:float=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> Dict[tuple, object]:
+        with self._lock:
+            return dict(self._values)
+
+
+# Gauge set directly (inc/dec) or read from a function when scraped.
+# The function returns a value, or {label values tuple: value}.
+# Gauges of state shared by worker processes (e.g. the catalog) are not
+# aggregated, every process reports the same value.
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(
+        self,
+        name:str,
+        help:str,
+        labels:Tuple[str, ...]=(),
+        function:Optional[Callable[[], Union[float, Dict[tuple, float]]]]=None,
+        aggregated:bool=True
+    ):
+        super().__init__(name, help, labels)
+        self.function = function
+        self.aggregated = aggregated
+
+    def dec(self, amount:float=1, *labels):
+        self.inc(-amount, *labels)
+
+    @contextmanager
+    def track(self, *labels):
+        self.inc(1, *labels)
+        try:
+            yield
+        finally:
+            self.dec(1, *labels)
+
+    def collect(self) -> Dict[tuple, object]:
+        if self.function is None:
+            return super().collect()
+        try:
+            values = self.function()
+        except Exception:
+            return {} # source not available (e.g. catalog not opened yet)
+        if not isinstance(values, dict):
+            values = {(): values}
+        return values
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name:str, help:str, labels:Tuple[str, ...]=(), buckets:Tuple[float, ...]=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[tuple, list] = {} # labels -> [count per bucket..., sum]
+
+    def observe(self, value:float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def collect(self) -> Dict[tuple, object]:
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+    def merge(self, total:Dict[tuple, object], values:Dict[tuple, object]):
+        for labels, counts in values.items():
+            if len(counts) != len(self.buckets) + 1:
+                continue # other buckets (worker of another version)
+            current = total.get(labels)
+            total[labels] = list(counts) if current is None else [a + b for a, b in zip(current, counts)]
+
+    def samples(self, values:Dict[tuple, object]) -> List[str]:
+        lines = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % _format(bucket)
+                lines.append(f'{self.name}_bucket{self._labels(labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {_format(counts[-1])}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {cumulative}')
+        return lines
+
+
+# Values of this process (JSON), published to the other worker processes
+def snapshot() -> str:
+    return json.dumps({
+        metric.name: [[list(labels), value] for labels, value in metric.collect().items()]
+        for metric in REGISTRY if metric.aggregated
+    })
+
+
+# Text of all metrics, values of other worker processes (snapshots) are added
+def render(others:List[str]=()) -> str:
+    values: Dict[str, List[Dict[tuple, object]]] = {}
+    for other in others:
+        for name, samples in json.loads(other).items():
+            values.setdefault(name, []).append({tuple(labels): value for labels, value in samples})
+    return '\n'.join(
+        metric.render(values.get(metric.name, []) if metric.aggregated else [])
+        for metric in REGISTRY
+    ) + '\n'
+
+
+HTTP_SECONDS = Histogram(
+    'swis_http_request_seconds', 'Time to handle HTTP request', ('method', 'route', 'status')
+)
+HTTP_REQUEST_BYTES = Counter(
+    'swis_http_request_bytes_total', 'Bytes of HTTP request bodies', ('route',)
+)
+
+
+# Records duration and body size of every HTTP request by route template
+# (e.g. /scans/{filename}). Start time is kept in request.state.started.
+class MetricsMiddleware:
+    def __init__(self, app:ASGIApp):
+        self.app = app
+        self._routes: Dict[object, str] = {}
+
+    def _route(self, scope:Scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        route = self._routes.get(endpoint)
+        if route is None:
+            for candidate in getattr(scope.get('app'), 'routes', []):
+                self._routes[getattr(candidate, 'endpoint', None) or getattr(candidate, 'app', None)] = candidate.path
+            route = self._routes.get(endpoint, 'unmatched')
+        return route
+
+    async def __call__(self, scope:Scope, receive:Receive, send:Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        scope.setdefault('state', {})['started'] = start
+        received = 0
+        status = 500
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+            return message
+
+        async def status_send(message:Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, status_send)
+        finally:
+            route = self._route(scope)
+            HTTP_SECONDS.observe(time.perf_counter() - start, scope['method'], route, str(status))
+            if received:
+                HTTP_REQUEST_BYTES.inc(received, route)
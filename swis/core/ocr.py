@@ -0,0 +1,69 @@
+import os
+import subprocess
+from typing import Optional
+
+from swis.core.jobs import idle_priority
+from swis.core.thumbnails import ThumbnailPool
+
+# tesseract tsv columns: level page_num block_num par_num line_num word_num left top width height conf text
+TSV_PAGE = '1'
+TSV_WORD = '5'
+
+
+class OcrError(Exception):
+    pass
+
+
+# Text (lines and paragraphs as in the page) and word boxes from tesseract tsv output
+def parse_tsv(output:str) -> dict:
+    width = height = 0
+    words = []
+    lines = []
+    last_line = last_paragraph = None
+    for row in output.splitlines()[1:]:
+        fields = row.split('\t')
+        if len(fields) < 12:
+            continue
+        if fields[0] == TSV_PAGE:
+            width, height = int(fields[8]), int(fields[9])
+            continue
+        word = fields[11].strip()
+        if fields[0] != TSV_WORD or not word:
+            continue
+        words.append([int(fields[6]), int(fields[7]), int(fields[8]), int(fields[9]), word])
+        paragraph, line = tuple(fields[1:4]), tuple(fields[1:5])
+        if line != last_line:
+            if last_paragraph is not None and paragraph != last_paragraph:
+                lines.append('')
+            lines.append(word)
+        else:
+            lines[-1] += ' ' + word
+        last_line, last_paragraph = line, paragraph
+    return {'text': '\n'.join(lines), 'width': width, 'height': height, 'words': words}
+
+
+# Executed in worker process. Recognizes text of the image with local tesseract
+# (one thread per worker). Returned dict has mtime and size of the file that was
+# read, so the result can be dropped when the file changed meanwhile.
+def recognize(source:str, languages:str) -> Optional[dict]:
+    st = os.stat(source)
+    p = subprocess.run(
+        ['tesseract', source, 'stdout', '-l', languages, 'tsv'],
+        capture_output=True,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        env=dict(os.environ, OMP_THREAD_LIMIT='1')
+    )
+    if p.returncode != 0:
+        raise OcrError(p.stderr.strip() or f'tesseract exited with {p.returncode}')
+    result = parse_tsv(p.stdout)
+    result.update(mtime=st.st_mtime, size=st.st_size)
+    return result
+
+
+# Same queue as thumbnails, tasks are recognize() at idle priority
+class OcrPool(ThumbnailPool):
+    task = staticmethod(recognize)
+    initializer = staticmethod(idle_priority)
+    name = 'swis-ocr'
@@ -0,0 +1,243 @@
+import os
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+from PIL import Image
+
+from swis.core.logger import get_logger
+from swis.core.storage import CENTIMETERS, RESOLUTION_TAGS, RESOLUTION_UNIT_TAG
+
+logger = get_logger()
+
+DEFAULT_DPI = 72 # same as ImageMagick convert when the image has no density
+JPEG_COLORSPACES = {
+    'L': '/DeviceGray',
+    'RGB': '/DeviceRGB',
+    'CMYK': '/DeviceCMYK',
+}
+
+SIXTEEN_BIT_MODES = ('I', 'I;16', 'I;16L', 'I;16B', 'I;16N') # 'I' of 16-bit PNG and TIFF files
+
+
+class PdfError(Exception):
+    pass
+
+
+def _pdf_string(text:str) -> bytes:
+    data = text.encode('cp1252', errors='replace') # WinAnsiEncoding of the standard font
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+# Invisible text (render mode 3) over the words of the page image, so the
+# page can be searched and the text selected. Words are boxes in pixels of
+# the recognized image: {'width', 'height', 'words': [[left, top, width, height, word], ...]}
+def text_layer(words:dict, page_width:float, page_height:float) -> bytes:
+    if not words.get('words') or not words.get('width') or not words.get('height'):
+        return b''
+    sx, sy = page_width / words['width'], page_height / words['height']
+    ops = [b'BT 3 Tr']
+    for left, top, width, height, word in words['words']:
+        size = max(1.0, height * sy)
+        # Helvetica is about half of the font size wide per character
+        scale = 100.0 * width * sx / (0.5 * size * len(word))
+        x, y = left * sx, page_height - (top + height * 0.8) * sy # baseline above descenders
+        ops.append(
+            f'/F0 {size:.2f} Tf {scale:.1f} Tz 1 0 0 1 {x:.2f} {y:.2f} Tm '.encode()
+            + _pdf_string(word) + b' Tj'
+        )
+    ops.append(b'ET')
+    return b'\n'.join(ops)
+
+
+# Minimal PDF writer: objects are written as soon as they are ready,
+# so only one page is kept in memory at a time
+class PdfWriter:
+    def __init__(self, f:BinaryIO):
+        self.f = f
+        self.offsets: Dict[int, int] = {}
+        self.pages: List[int] = []
+        self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        # catalog and page tree are written at the end, when all pages are known
+        self.catalog = 1
+        self.pages_tree = 2
+        self._next = 3
+        self._font: Optional[int] = None
+
+    def _take(self) -> int:
+        number = self._next
+        self._next += 1
+        return number
+
+    def _object(self, number:int, body:bytes, stream:Optional[bytes]=None):
+        self.offsets[number] = self.f.tell()
+        self.f.write(f'{number} 0 obj\n'.encode())
+        self.f.write(body)
+        if stream is not None:
+            self.f.write(b'\nstream\n')
+            self.f.write(stream)
+            self.f.write(b'\nendstream')
+        self.f.write(b'\nendobj\n')
+
+    # Standard font for text layers (not embedded), written once
+    def _text_font(self) -> int:
+        if self._font is None:
+            self._font = self._take()
+            self._object(self._font, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+        return self._font
+
+    def add_page(self, image:bytes, image_dict:str, width:int, height:int, dpi:float, words:Optional[dict]=None):
+        image_obj, content_obj, page_obj = self._take(), self._take(), self._take()
+        w, h = width * 72.0 / dpi, height * 72.0 / dpi
+        self._object(
+            image_obj,
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'{image_dict} /Length {len(image)} >>'.encode(),
+            image
+        )
+        content = f'q {w:.4f} 0 0 {h:.4f} 0 0 cm /Im0 Do Q'.encode()
+        text = text_layer(words, w, h) if words else b''
+        fonts = ''
+        if text:
+            content += b'\n' + text
+            fonts = f' /Font << /F0 {self._text_font()} 0 R >>'
+        self._object(content_obj, f'<< /Length {len(content)} >>'.encode(), content)
+        self._object(
+            page_obj,
+            f'<< /Type /Page /Parent {self.pages_tree} 0 R /MediaBox [0 0 {w:.4f} {h:.4f}] '
+            f'/Resources << /XObject << /Im0 {image_obj} 0 R >>{fonts} >> /Contents {content_obj} 0 R >>'.encode()
+        )
+        self.pages.append(page_obj)
+
+    def close(self):
+        kids = ' '.join(f'{page} 0 R' for page in self.pages)
+        self._object(self.pages_tree, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>'.encode())
+        self._object(self.catalog, f'<< /Type /Catalog /Pages {self.pages_tree} 0 R >>'.encode())
+        xref = self.f.tell()
+        size = max(self.offsets) + 1
+        self.f.write(f'xref\n0 {size}\n0000000000 65535 f \n'.encode())
+        for number in range(1, size):
+            self.f.write(f'{self.offsets.get(number, 0):010d} 00000 n \n'.encode())
+        self.f.write(f'trailer\n<< /Size {size} /Root {self.catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+
+
+def _dpi(im:Image.Image) -> float:
+    dpi = im.info.get('dpi')
+    if not dpi and im.format == 'WEBP':
+        # recompressed scans keep the resolution in EXIF
+        exif = im.getexif()
+        if exif.get(RESOLUTION_TAGS[0]):
+            unit = 2.54 if exif.get(RESOLUTION_UNIT_TAG) == CENTIMETERS else 1.0
+            dpi = (float(exif[RESOLUTION_TAGS[0]]) * unit,)
+    try:
+        return float(dpi[0]) if dpi and float(dpi[0]) > 0 else DEFAULT_DPI
+    except (TypeError, ValueError):
+        return DEFAULT_DPI
+
+
+def _is_complete_jpeg(path:Path) -> bool:
+    with open(path, 'rb') as f:
+        f.seek(max(0, os.path.getsize(path) - 32))
+        return b'\xff\xd9' in f.read()
+
+
+# CCITT G4 data of single strip bilevel TIFF, None for other TIFF files
+def _g4_strip(im:Image.Image, path:Path) -> Optional[bytes]:
+    tags = im.tag_v2
+    offsets, counts = tags.get(273), tags.get(279) # StripOffsets, StripByteCounts
+    if (
+        im.info.get('compression') != 'group4'
+        or offsets is None or counts is None or len(offsets) != 1
+        or tags.get(266, 1) != 1 # FillOrder other than msb first
+        or getattr(im, 'n_frames', 1) != 1
+    ):
+        return None
+    with open(path, 'rb') as f:
+        f.seek(offsets[0])
+        return f.read(counts[0])
+
+
+# Adds image file as a page (PDF files cannot be added). JPEG files and G4 TIFF files (single strip)
+# are embedded as they are (DCTDecode, CCITTFaxDecode), other images
+# are decoded and compressed losslessly (FlateDecode).
+# Recognized words (see text_layer) make the page searchable.
+def add_image_page(writer:PdfWriter, path:Path, words:Optional[dict]=None):
+    if path.suffix.lower() == '.pdf':
+        raise PdfError(f'{path.name} is a PDF file, only images can be added as pages')
+    with Image.open(path) as im:
+        dpi = _dpi(im)
+        strip = _g4_strip(im, path) if im.format == 'TIFF' else None
+        if strip is not None:
+            # G4 codes 0 bits as white, PhotometricInterpretation tells what 0 is
+            black_is_1 = 'true' if im.tag_v2.get(262) == 1 else 'false'
+            image_dict = (
+                f'/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /CCITTFaxDecode '
+                f'/DecodeParms << /K -1 /Columns {im.width} /Rows {im.height} /BlackIs1 {black_is_1} >>'
+            )
+            writer.add_page(strip, image_dict, im.width, im.height, dpi, words)
+            return
+        if (
+            im.format == 'JPEG'
+            and im.mode in JPEG_COLORSPACES
+            and _is_complete_jpeg(path)
+        ):
+            decode = ''
+            if im.mode == 'CMYK' and 'adobe' in im.info:
+                decode = ' /Decode [1 0 1 0 1 0 1 0]' # Adobe inverted CMYK
+            image_dict = (
+                f'/ColorSpace {JPEG_COLORSPACES[im.mode]} /BitsPerComponent 8 '
+                f'/Filter /DCTDecode{decode}'
+            )
+            writer.add_page(path.read_bytes(), image_dict, im.width, im.height, dpi, words)
+            return
+        im.load()
+        if im.mode in SIXTEEN_BIT_MODES:
+            # scaled to 8 bits, converting would clip everything above 255 to white
+            im = im.convert('I').point(lambda value: value / 256)
+        if im.mode not in ('L', 'RGB'):
+            im = im.convert('L' if im.mode in ('1', 'LA', 'I', 'F') else 'RGB')
+        image_dict = (
+            f'/ColorSpace {JPEG_COLORSPACES[im.mode]} /BitsPerComponent 8 /Filter /FlateDecode'
+        )
+        writer.add_page(zlib.compress(im.tobytes(), 6), image_dict, im.width, im.height, dpi, words)
+
+
+# Builds PDF with one page per image. Pages that cannot be read are repaired
+# (repair callback) and added again. Text layer of a page is made from
+# words returned by page_words callback. Returns names of repaired pages.
+def build_pdf(
+    sources:List[Path],
+    target:Path,
+    repair:Optional[Callable[[Path], None]]=None,
+    on_page:Optional[Callable[[int, int], None]]=None,
+    page_words:Optional[Callable[[Path], Optional[dict]]]=None,
+) -> List[str]:
+    repaired = []
+    partial = target.with_name(f'.{target.name}.part')
+    try:
+        with open(partial, 'wb') as f:
+            writer = PdfWriter(f)
+            for index, source in enumerate(sources):
+                words = page_words(source) if page_words is not None else None
+                try:
+                    add_image_page(writer, source, words)
+                except FileNotFoundError:
+                    raise PdfError(f'File not found: {source.name}')
+                except (IOError, SyntaxError, ValueError) as ex:
+                    if repair is None:
+                        raise PdfError(f'Cannot add page {source.name}: {ex}')
+                    logger.warning(f'Cannot read page {source.name} ({ex}), repairing')
+                    repair(source)
+                    try:
+                        add_image_page(writer, source, words)
+                    except Exception as ex:
+                        raise PdfError(f'Cannot add page {source.name}: {ex}')
+                    repaired.append(source.name)
+                if on_page is not None:
+                    on_page(index + 1, len(sources))
+            writer.close()
+        os.replace(partial, target)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    return repaired
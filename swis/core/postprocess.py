@@ -0,0 +1,131 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from swis.core.scanning import StageTimer
+from swis.core.schemas import PostProcess
+
+COLORS = ('gray', 'bilevel')
+# scan format used for the requested compression
+COMPRESSION_FORMATS = {
+    'jpeg': 'jpeg',
+    'g4': 'tiff', # CCITT G4 TIFF, always bilevel
+}
+WHITE_THRESHOLD = 200 # lighter pixels are paper
+CONTENT_FRACTION = 0.005 # rows/columns with less dark pixels are margin (dust, specks)
+ANALYSIS_SIZE = 1000 # margins and skew are found on a copy downscaled to this size
+MAX_SKEW = 5.0 # degrees
+MARGIN_MM = 3.0 # kept around the content when cropping
+
+
+# Dark pixels of downscaled grayscale copy (255 = dark) and the scale factor
+def _dark_mask(im:Image.Image) -> Tuple[Image.Image, int]:
+    gray = im.convert('L') if im.mode != 'L' else im
+    factor = max(1, max(im.size) // ANALYSIS_SIZE)
+    if factor > 1:
+        gray = gray.reduce(factor)
+    return gray.point(lambda v: 255 if v < WHITE_THRESHOLD else 0), factor
+
+
+# Fraction of dark pixels in each row (axis=1) or column (axis=0) of the mask
+def _profile(mask:Image.Image, axis:int) -> List[float]:
+    return (np.asarray(mask, dtype=np.float32).mean(axis=axis) / 255).tolist()
+
+
+def _content_range(profile:List[float]) -> Optional[Tuple[int, int]]:
+    content = [i for i, v in enumerate(profile) if v > CONTENT_FRACTION]
+    return (content[0], content[-1] + 1) if content else None
+
+
+# Box of the image without white margins, None for a blank page
+def content_box(im:Image.Image, dpi:float) -> Optional[Tuple[int, int, int, int]]:
+    mask, factor = _dark_mask(im)
+    rows = _content_range(_profile(mask, 1))
+    columns = _content_range(_profile(mask, 0))
+    if rows is None or columns is None:
+        return None
+    margin = int(dpi * MARGIN_MM / 25.4)
+    return (
+        max(0, columns[0] * factor - margin),
+        max(0, rows[0] * factor - margin),
+        min(im.width, columns[1] * factor + margin),
+        min(im.height, rows[1] * factor + margin),
+    )
+
+
+def autocrop(im:Image.Image, dpi:float) -> Image.Image:
+    box = content_box(im, dpi)
+    if box is None or box == (0, 0) + im.size:
+        return im
+    return im.crop(box)
+
+
+# Lines of text give sharp peaks in the row profile when they are horizontal
+def _skew_score(mask:Image.Image, angle:float) -> float:
+    rows = _profile(mask.rotate(angle, Image.BILINEAR), 1)
+    return float(np.square(np.diff(rows)).sum())
+
+
+# Angle (degrees, counterclockwise) that straightens the page:
+# coarse search in whole degrees, then refined by tenths
+def skew_angle(im:Image.Image) -> float:
+    mask, _ = _dark_mask(im)
+    best = max((float(a) for a in range(-int(MAX_SKEW), int(MAX_SKEW) + 1)), key=lambda a: _skew_score(mask, a))
+    return max((best + step / 10 for step in range(-9, 10)), key=lambda a: _skew_score(mask, a))
+
+
+def deskew(im:Image.Image) -> Image.Image:
+    angle = skew_angle(im)
+    if abs(angle) < 0.05:
+        return im
+    resample = Image.NEAREST if im.mode == '1' else Image.BICUBIC
+    return im.rotate(angle, resample, expand=True, fillcolor='white')
+
+
+# Threshold separating text from paper (Otsu's method on the histogram)
+def bilevel_threshold(gray:Image.Image) -> int:
+    histogram = gray.histogram()
+    total = sum(histogram)
+    weighted = sum(i * count for i, count in enumerate(histogram))
+    below = below_weighted = 0
+    best, threshold = -1.0, 128
+    for i, count in enumerate(histogram):
+        below += count
+        below_weighted += i * count
+        above = total - below
+        if below == 0 or above == 0:
+            continue
+        mean_below = below_weighted / below
+        mean_above = (weighted - below_weighted) / above
+        variance = below * above * (mean_below - mean_above) ** 2
+        if variance > best:
+            best, threshold = variance, i
+    return threshold
+
+
+def to_bilevel(im:Image.Image) -> Image.Image:
+    if im.mode == '1':
+        return im
+    gray = im.convert('L') if im.mode != 'L' else im
+    threshold = bilevel_threshold(gray)
+    return gray.point(lambda v: 255 if v > threshold else 0, '1')
+
+
+# Applies post-processing selected in the scan request,
+# stage durations are added to the timer
+def postprocess(im:Image.Image, options:PostProcess, dpi:float, timer:StageTimer) -> Image.Image:
+    if options.deskew:
+        with timer.stage('deskew'):
+            im = deskew(im)
+    if options.autocrop:
+        with timer.stage('autocrop'):
+            im = autocrop(im, dpi)
+    color = 'bilevel' if options.compression == 'g4' else options.color
+    if color == 'gray' and im.mode not in ('L', '1'):
+        with timer.stage('color'):
+            im = im.convert('L')
+    elif color == 'bilevel':
+        with timer.stage('color'):
+            im = to_bilevel(im)
+    return im
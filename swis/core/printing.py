@@ -0,0 +1,142 @@
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from swis.core.logger import get_logger
+from swis.core.schemas import ProcessResult
+
+logger = get_logger()
+
+LP_REQUEST_PATTERN = re.compile(r'request id is (\S+)')
+
+
+class PrintJob:
+    SUBMITTING = 'submitting' # lp is running
+    PENDING = 'pending' # in CUPS queue (waiting or printing)
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+
+    def __init__(self, filenames:List[str], args:List[str], key:tuple):
+        self.id = uuid.uuid4().hex
+        self.filenames = filenames
+        self.args = args
+        self.key = key
+        self.status = PrintJob.SUBMITTING
+        self.cups_id: Optional[str] = None
+        self.created = time.time()
+        self.updated = self.created
+        self.detail = ''
+
+    @property
+    def active(self) -> bool:
+        return self.status in (PrintJob.SUBMITTING, PrintJob.PENDING)
+
+    def set_status(self, status:str, detail:Optional[str]=None):
+        self.status = status
+        if detail is not None:
+            self.detail = detail
+        self.updated = time.time()
+
+
+# Job ids (first column) from `lpstat -o` output
+def parse_lpstat(output:str) -> Set[str]:
+    return {line.split()[0] for line in output.splitlines() if line and not line[0].isspace()}
+
+
+# Print jobs sent with lp, tracked by their CUPS ids. CUPS state is polled
+# with lpstat in background while there are pending jobs. Same files with
+# same options submitted again within `dedup_window` seconds return the
+# job of the first submission.
+class PrintQueue:
+    def __init__(self, run:Callable[[list], ProcessResult], dedup_window:float, history:int=200):
+        self.run = run
+        self.dedup_window = dedup_window
+        self.history = history
+        self._jobs: Dict[str, PrintJob] = OrderedDict()
+        self._lock = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
+
+    @staticmethod
+    def job_key(paths:List[Path], args:List[str]) -> tuple:
+        files = tuple((path.name, path.stat().st_mtime_ns, path.stat().st_size) for path in paths)
+        return files, tuple(args)
+
+    # Returns (job, True) for a new job to be submitted,
+    # (job, False) for a duplicate of a recent one.
+    # names: names of the files shown in the job (default: names of the paths)
+    def add(self, paths:List[Path], args:List[str], names:Optional[List[str]]=None) -> Tuple[PrintJob, bool]:
+        key = self.job_key(paths, args)
+        with self._lock:
+            now = time.time()
+            for job in reversed(self._jobs.values()):
+                if now - job.created > self.dedup_window:
+                    break
+                if job.key == key and job.status not in (PrintJob.CANCELLED, PrintJob.FAILED):
+                    return job, False
+            job = PrintJob(names or [path.name for path in paths], args, key)
+            self._jobs[job.id] = job
+            self._prune()
+        return job, True
+
+    # Records result of lp
+    def submitted(self, job:PrintJob, p:ProcessResult):
+        match = LP_REQUEST_PATTERN.search(p.stdout)
+        if p.returncode != 0 or match is None:
+            job.set_status(PrintJob.FAILED, p.stderr.strip() or p.stdout.strip())
+            return
+        job.cups_id = match.group(1)
+        job.set_status(PrintJob.PENDING, p.stdout.strip())
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id:str) -> Optional[PrintJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[PrintJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job:PrintJob) -> bool:
+        if job.status != PrintJob.PENDING:
+            return False
+        p = self.run(['cancel', job.cups_id])
+        if p.returncode != 0:
+            job.detail = p.stderr.strip()
+            return False
+        job.set_status(PrintJob.CANCELLED)
+        return True
+
+    # Updates pending jobs from CUPS: jobs not listed as not-completed any more
+    # have finished (jobs cancelled or aborted outside swis are reported as completed too)
+    def poll(self):
+        pending = [job for job in self.list() if job.status == PrintJob.PENDING]
+        if not pending:
+            return
+        p = self.run(['lpstat', '-W', 'not-completed', '-o'])
+        if p.returncode != 0:
+            logger.warning(f'Problem with reading print jobs: {p.stderr.strip()}')
+            return
+        not_completed = parse_lpstat(p.stdout)
+        for job in pending:
+            if job.cups_id not in not_completed and job.status == PrintJob.PENDING:
+                job.set_status(PrintJob.COMPLETED)
+
+    def start_poller(self, interval:float):
+        def poll_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.poll()
+                except Exception as ex:
+                    logger.warning(f'Problem with reading print jobs: {ex}')
+        if self._poller is None:
+            self._poller = threading.Thread(target=poll_forever, name='swis-print', daemon=True)
+            self._poller.start()
@@ -0,0 +1,110 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageFile
+
+
+class ScanStreamError(Exception):
+    pass
+
+
+# Decodes PNM image (scanimage --format=pnm) while it is being received.
+# Header tells how many bytes to expect, so the integrity check is just
+# counting them; missing rows are padded only when the stream is short.
+class ScanStream:
+    MAGIC = {b'P4': 'bits', b'P5': 'gray', b'P6': 'rgb'}
+
+    def __init__(self):
+        self._header = b''
+        self._parser: Optional[ImageFile.Parser] = None
+        self.expected: Optional[int] = None # bytes of pixel data
+        self.magic: Optional[bytes] = None
+        self.received = 0
+
+    # Returns header length, or None when it is not complete yet
+    def _parse_header(self) -> Optional[int]:
+        tokens = []
+        pos = 0
+        data = self._header
+        count = 3 if data[:2] == b'P4' else 4
+        while len(tokens) < count:
+            while pos < len(data) and (data[pos:pos + 1].isspace() or data[pos:pos + 1] == b'#'):
+                if data[pos:pos + 1] == b'#':
+                    end = data.find(b'\n', pos)
+                    if end < 0:
+                        return None
+                    pos = end
+                pos += 1
+            start = pos
+            while pos < len(data) and not data[pos:pos + 1].isspace() and data[pos:pos + 1] != b'#':
+                pos += 1
+            if pos >= len(data):
+                return None
+            tokens.append(data[start:pos])
+        if tokens[0] not in self.MAGIC:
+            raise ScanStreamError(f'Unsupported scan data format: {tokens[0][:2]!r}')
+        self.magic = tokens[0]
+        width, height = int(tokens[1]), int(tokens[2])
+        if tokens[0] == b'P4':
+            row = (width + 7) // 8
+        else:
+            sample = 1 if int(tokens[3]) < 256 else 2
+            row = width * sample * (3 if tokens[0] == b'P6' else 1)
+        self.expected = row * height
+        return pos + 1 # single whitespace after the header
+
+    def feed(self, data:bytes):
+        if self._parser is None:
+            self._header += data
+            header_length = self._parse_header()
+            if header_length is None:
+                return
+            self._parser = ImageFile.Parser()
+            data, self._header = self._header, b''
+            self.received = len(data) - header_length
+        else:
+            self.received += len(data)
+        self._parser.feed(data)
+
+    # Image decoded so far (rows not received yet are blank)
+    @property
+    def image(self) -> Optional[Image.Image]:
+        return self._parser.image if self._parser is not None else None
+
+    @property
+    def truncated(self) -> bool:
+        return self.expected is None or self.received < self.expected
+
+    # Returns decoded image and whether it had to be padded
+    def close(self) -> Tuple[Image.Image, bool]:
+        if self._parser is None:
+            raise ScanStreamError('No image data received')
+        truncated = self.truncated
+        if truncated:
+            missing = self.expected - self.received
+            blank = b'\x00' if self.magic == b'P4' else b'\xff' # in P4 1 is black
+            self._parser.feed(blank * missing) # blank (white) rows
+            self.received += missing
+        return self._parser.close(), truncated
+
+
+# Collects durations of named stages
+class StageTimer:
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def mark(self, name:str, since:Optional[float]=None):
+        self.timings[name] = time.perf_counter() - (since if since is not None else self._start)
+
+    def __str__(self):
+        return ', '.join(f'{name}: {seconds:.3f}s' for name, seconds in self.timings.items())
@@ -1,7 +1,7 @@
 # pydentic models
 from enum import Enum
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, conint, conlist
+from typing import Dict, List, Optional
 
 # class ScanModeEnum(str, Enum):
 #     color = 'color'
@@ -13,6 +13,13 @@ from typing import List, Optional
 #     jpeg = 'jpeg'
 #     pdf = 'pdf'
 
+class PostProcess(BaseModel):
+    deskew: bool = False # straighten pages scanned at an angle
+    autocrop: bool = False # remove white margins
+    color: Optional[str] = None # gray, bilevel (text pages)
+    compression: Optional[str] = None # jpeg (with quality), g4 (CCITT G4 TIFF, bilevel)
+    quality: int = 85 # jpeg quality
+
 class ScanRequest(BaseModel):
     mode: str
     #margin_left: str # l
@@ -22,16 +29,63 @@ class ScanRequest(BaseModel):
     resolution: str # dpi
     format: str
     filename: Optional[str] = None
+    device: Optional[str] = None # SANE device name (scanimage -d)
+    source: Optional[str] = None # scanimage --source (default ADF/ADF Duplex for batch)
+    batch: bool = False # scan all pages in the document feeder
+    duplex: bool = False # both sides of batch pages
+    batch_pdf: bool = False # make pdf from batch pages when done
+    postprocess: Optional[PostProcess] = None # applied before the scan is stored
+
+class DeviceInfo(BaseModel):
+    name: str # use as ScanRequest.device
+    vendor: str
+    model: str
+    type: str
+    modes: List[str] = []
+    resolutions: List[int] = []
+    resolution_min: Optional[float] = None
+    resolution_max: Optional[float] = None
+    sources: List[str] = []
+    width: Optional[float] = None # mm
+    height: Optional[float] = None # mm
+
+class DeviceList(BaseModel):
+    returncode: int
+    detail: str
+    refreshed: Optional[float] = None # time of the last discovery (None before the first one ends)
+    devices: List[DeviceInfo] = None
 
 class MakePdf(BaseModel):
     target: Optional[str] = None
-    filenames: List[str] = None
+    filenames: conlist(str, min_items=1) # pages in order
 
 
 class ScanResult(BaseModel):
     code: int
     detail: str
     filename: Optional[str] = None
+    pages: List[str] = [] # files of batch pages
+    timings: Dict[str, float] = {} # seconds per stage (wait, scan, encode, renditions, register)
+
+class JobStatus(BaseModel):
+    id: str
+    status: str # queued, running, done, failed, cancelled
+    position: int = 0 # jobs to wait for before this one starts
+    progress: float = 0.0 # percent
+    created: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    detail: Optional[str] = None
+
+class ScanJob(JobStatus):
+    device: Optional[str] = None
+    pages_done: int = 0 # batch pages stored so far
+    result: Optional[ScanResult] = None
+
+class ScanJobList(BaseModel):
+    returncode: int
+    detail: str
+    jobs: List[ScanJob] = None
 
 class ProcessResult(BaseModel):
     returncode: int
@@ -43,14 +97,79 @@ class MergeResult(BaseModel):
     detail: str
     filename: Optional[str] = None
 
+class PdfJob(JobStatus):
+    pages: int = 0
+    pages_done: int = 0
+    result: Optional[MergeResult] = None
+
+class PdfJobList(BaseModel):
+    returncode: int
+    detail: str
+    jobs: List[PdfJob] = None
+
 class ScanListItem(BaseModel):
     filename: str
     thumbnail: str
+    thumbnail_pending: bool = False # thumbnail is being generated
+    renditions: Dict[str, str] = {} # size -> URL of downscaled copy
+    mtime: Optional[float] = None
+    size: Optional[int] = None
+    format: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+class SearchHit(ScanListItem):
+    snippet: str = '' # matching part of recognized text, matches in [ ]
+
+class SearchResult(BaseModel):
+    returncode: int
+    detail: str
+    total: int # all matching files
+    hits: List[SearchHit] = [] # best matches first
+
+class TagsRequest(BaseModel):
+    tags: List[str]
+
+class ScanTags(BaseModel):
+    returncode: int
+    detail: str
+    filename: str
+    org_filename: Optional[str] = None # name of uploaded file
+    tags: List[str] = []
+
+class ScanText(BaseModel):
+    returncode: int
+    detail: str
+    filename: str
+    text: str = ''
+    pending: bool = False # not recognized yet
+
+class TransformRequest(BaseModel):
+    crop: Optional[List[int]] = None # left, top, right, bottom (pixels of the stored image)
+    rotate: int = 0 # degrees clockwise, multiple of 90
+    flip: Optional[str] = None # horizontal, vertical (after rotation)
+
+class TransformResult(BaseModel):
+    returncode: int
+    detail: str
+    lossless: bool # pixels were not re-encoded (or the format is lossless)
+    timings: Dict[str,float] = {}
+    scan: Optional[ScanListItem] = None
+
+class ScanSortEnum(str, Enum):
+    newest = 'newest'
+    oldest = 'oldest'
+    name = 'name'
+    name_desc = 'name_desc'
+    largest = 'largest'
+    smallest = 'smallest'
 
 class ScanList(BaseModel):
     returncode: int
     detail: str
     filenames: List[ScanListItem] = None
+    total: Optional[int] = None # number of items matching the filters (first page only)
+    cursor: Optional[str] = None # next page (None on the last page)
     
 class ImageUploadResult(BaseModel):
     returncode: int
@@ -58,6 +177,21 @@ class ImageUploadResult(BaseModel):
     filename: Optional[str] = None
     org_filename: Optional[str] = None
 
+class UploadSessionRequest(BaseModel):
+    filename: str # original filename
+    size: conint(ge=0) # bytes
+    sha256: Optional[str] = None # checksum of the whole file (verified on finalize)
+
+class UploadSessionStatus(BaseModel):
+    id: str
+    filename: str
+    size: int
+    chunk_size: int
+    chunks: int
+    received: List[int]
+    missing: List[int]
+    expires: float # removed when not updated until then
+
 class PrintRequest(BaseModel):
     filename: str
     quality: str
@@ -65,5 +199,27 @@ class PrintRequest(BaseModel):
     sides: str
     pages: Optional[str] = None
 
+class PrintBatchRequest(BaseModel):
+    filenames: List[str]
+    quality: str
+    orientation: str
+    sides: str
+    pages: Optional[str] = None
+    separate: bool = False # one print job per file (default: all files in one job)
+
 class PrintResult(ScanResult):
-    pass
+    job: Optional[str] = None # id of print job (/print/jobs/{id})
+
+class PrintJobStatus(BaseModel):
+    id: str
+    status: str # submitting, pending, completed, cancelled, failed
+    cups_id: Optional[str] = None
+    filenames: List[str]
+    created: float
+    updated: float
+    detail: str = ''
+
+class PrintJobList(BaseModel):
+    returncode: int
+    detail: str
+    jobs: List[PrintJobStatus] = None
@@ -0,0 +1,223 @@
+import errno
+import os
+import re
+import shutil
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from PIL import Image
+from starlette.staticfiles import StaticFiles
+
+DATED = re.compile(r'^(\d{4})(\d{2})\d{2}-') # generated names: 20240131-101500_7.jpg
+UNDATED_SHARDS = 256
+COMPRESSED_SUFFIX = '.webp'
+LOSSLESS_SUFFIXES = ['.png', '.tif'] # recompressed without loss, JPEG would only lose quality
+COMPRESSED_MODES = ['RGB', 'RGBA'] # WebP has no grayscale, 16-bit or 1-bit images
+WEBP_MAX_SIZE = 16383
+RESOLUTION_TAGS = (282, 283) # EXIF XResolution, YResolution
+RESOLUTION_UNIT_TAG = 296
+INCHES = 2
+CENTIMETERS = 3
+
+
+class NotCompressible(ValueError):
+    pass
+
+
+# Where files of the scans folder are kept. The API and the catalog use flat
+# names. When sharded (STORAGE_SHARDS), the files are in subfolders of the
+# scans folder by the date in the name (2024/01/20240131-101500_7.jpg, other
+# names in other/xx by hash of the name without its suffix), so no folder
+# gets too many entries. Old files may be moved to the same shard of the
+# archive folder and recompressed (X.png is stored as X.png.webp under the
+# same name). Files of older versions (directly in the scans folder) are
+# found too until they are moved to their shard.
+class Storage:
+    def __init__(self, folder:str, archive:Optional[str]=None, sharded:bool=False):
+        self.folder = Path(folder)
+        self.archive = Path(archive) if archive else None
+        self.sharded = sharded
+
+    def shard(self, filename:str) -> str:
+        if not self.sharded:
+            return ''
+        match = DATED.match(filename)
+        if match:
+            return f'{match[1]}/{match[2]}'
+        return f'other/{zlib.crc32(Path(filename).stem.encode()) % UNDATED_SHARDS:02x}'
+
+    # Place of new files
+    def target(self, filename:str) -> Path:
+        return self.folder / self.shard(filename) / filename
+
+    def _locations(self, filename:str) -> Iterator[Path]:
+        folders = [self.folder / self.shard(filename)]
+        if self.archive is not None:
+            folders.append(self.archive / self.shard(filename))
+        if self.sharded:
+            folders.append(self.folder)
+        compressible = Path(filename).suffix in LOSSLESS_SUFFIXES
+        for folder in folders:
+            yield folder / filename
+            if compressible:
+                yield folder / compressed_name(filename)
+
+    # Current path of the file, target for a missing one
+    # (with its folder created when `create` is set, so it can be written)
+    def path(self, filename:str, create:bool=False) -> Path:
+        for path in self._locations(filename):
+            if path.exists():
+                return path
+        target = self.target(filename)
+        if create:
+            target.parent.mkdir(parents=True, exist_ok=True)
+        return target
+
+    def archived(self, path:Path) -> bool:
+        return self.archive is not None and self.archive in path.parents
+
+    # All stored files as (name, directory entry), a name found in more places
+    # (e.g. copied to the archive and not removed yet) is returned once
+    def files(self, suffixes:list) -> Iterator[Tuple[str, os.DirEntry]]:
+        seen = set()
+        roots = [self.folder] + ([self.archive] if self.archive is not None else [])
+        for root in roots:
+            for entry in self._entries(root, 0):
+                filename = public_name(entry.name)
+                if filename not in seen and Path(filename).suffix in suffixes:
+                    seen.add(filename)
+                    yield filename, entry
+
+    # Files of the folder and of shard folders below it (2024/01, other/ab),
+    # other folders (thumbs, .blobs ...) are not walked
+    def _entries(self, folder:Path, depth:int) -> Iterator[os.DirEntry]:
+        try:
+            with os.scandir(folder) as scanned:
+                entries = list(scanned)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_file():
+                yield entry
+            elif entry.is_dir() and depth < 2 and self._is_shard(entry.name, depth):
+                yield from self._entries(Path(entry.path), depth + 1)
+
+    @staticmethod
+    def _is_shard(name:str, depth:int) -> bool:
+        if depth == 0:
+            return name == 'other' or (len(name) == 4 and name.isdigit())
+        return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+    # Moves file of older version (or file copied into the scans folder)
+    # to its shard. Returns False when it is where it should be.
+    def place(self, filename:str) -> bool:
+        flat = self.folder / filename
+        target = self.target(filename)
+        if flat == target or not flat.is_file() or target.exists():
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(flat, target) # keeps mtime and hard links of the content store
+        return True
+
+    # Moves files in the scans folder itself to their shards, returns their names
+    def place_all(self, suffixes:list) -> List[str]:
+        placed = []
+        if self.sharded:
+            with os.scandir(self.folder) as entries:
+                names = [entry.name for entry in entries if entry.is_file() and Path(entry.name).suffix in suffixes]
+            placed = [filename for filename in names if self.place(filename)]
+        return placed
+
+    # Moves file to the archive folder (copied and removed, when the archive
+    # is on another file system). Returns the new path.
+    def move_to_archive(self, filename:str) -> Optional[Path]:
+        source = self.path(filename)
+        if self.archive is None or not source.exists() or self.archived(source):
+            return None
+        target = self.archive / self.shard(filename) / source.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            partial = target.with_name(f'.{source.name}.part')
+            shutil.copy2(source, partial)
+            os.replace(partial, target)
+            source.unlink()
+        return target
+
+
+# Name of the file recompressed by `compress`
+def compressed_name(filename:str) -> str:
+    return filename + COMPRESSED_SUFFIX
+
+
+# Name of the stored file in the API and the catalog
+def public_name(name:str) -> str:
+    if name.endswith(COMPRESSED_SUFFIX) and Path(name[:-len(COMPRESSED_SUFFIX)]).suffix in LOSSLESS_SUFFIXES:
+        return name[:-len(COMPRESSED_SUFFIX)]
+    return name
+
+
+# Resolution (WebP has it in EXIF only, see pdf._dpi) and color profile
+def webp_info(im:Image.Image) -> dict:
+    exif = im.getexif()
+    dpi = im.info.get('dpi')
+    if dpi:
+        exif[RESOLUTION_TAGS[0]], exif[RESOLUTION_TAGS[1]] = float(dpi[0]), float(dpi[1])
+        exif[RESOLUTION_UNIT_TAG] = INCHES
+    info = {'exif': exif.tobytes()}
+    if im.info.get('icc_profile'):
+        info['icc_profile'] = im.info['icc_profile']
+    return info
+
+
+# Writes lossless WebP of RGB image next to it, with the same resolution and
+# modification time (it is still the same scan). Returns the new path.
+def compress(source:Path) -> Path:
+    target = source.with_name(compressed_name(source.name))
+    if target.exists():
+        raise NotCompressible(f'{target.name} exists')
+    partial = target.with_name(f'.{target.name}.part')
+    try:
+        with Image.open(source) as im:
+            if im.mode not in COMPRESSED_MODES or getattr(im, 'n_frames', 1) > 1 or max(im.size) > WEBP_MAX_SIZE:
+                raise NotCompressible(f'{source.name} ({im.mode}, {im.size[0]}x{im.size[1]}, {getattr(im, "n_frames", 1)} pages)')
+            if 'transparency' in im.info:
+                raise NotCompressible(f'{source.name} (transparent color)')
+            im.save(partial, 'WEBP', lossless=True, quality=100, method=6, exact=True, **webp_info(im))
+        st = source.stat()
+        os.utime(partial, (st.st_atime, st.st_mtime))
+        os.replace(partial, target)
+    finally:
+        partial.unlink(missing_ok=True)
+    return target
+
+
+# Static files of the scans folder (mount of SCANS_ADDRESS), scans are found
+# by flat name wherever the storage keeps them. Other paths (thumbs/...) are
+# served from the folder. Hidden files and folders (catalog, job store,
+# upload sessions, content store, partial files ...) are never served.
+class ScanFiles(StaticFiles):
+    def __init__(self, storage:Storage, **kwargs):
+        super().__init__(directory=str(storage.folder), **kwargs)
+        self.storage = storage
+
+    def lookup_path(self, path:str) -> Tuple[str, Optional[os.stat_result]]:
+        if any(part.startswith('.') for part in path.split(os.sep)):
+            return '', None
+        if path and os.sep not in path:
+            found = self.storage.path(path)
+            try:
+                return str(found), found.stat()
+            except FileNotFoundError:
+                pass
+        return super().lookup_path(path)
+
+
+@lru_cache()
+def get_storage(folder:str, archive:Optional[str]=None, sharded:bool=False) -> Storage:
+    return Storage(folder, archive, sharded)
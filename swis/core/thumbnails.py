@@ -0,0 +1,249 @@
+import heapq
+import multiprocessing
+import os
+import itertools
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image, ImageFile
+
+from swis.core.jobs import idle_priority
+from swis.core.locks import LOCKS_FOLDER, Locks
+from swis.core.logger import get_logger
+from swis.core.metrics import PROCESS_BUCKETS, Histogram
+
+logger = get_logger()
+
+TASK_SECONDS = Histogram(
+    'swis_background_task_seconds', 'Time of background task in worker process (thumbnails, ocr)', ('task',), PROCESS_BUCKETS
+)
+
+THUMBNAIL_SIZE = (128, 128)
+RENDITION_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+WORKER_START_METHOD = 'forkserver'
+
+# Priorities (lower is served first)
+VIEWED = 0      # requested by a client listing the scans
+NEW = 1         # just scanned or uploaded
+BACKGROUND = 2  # found by the catalog reconcile pass
+
+
+# Thumbnails are kept in the same shard of the thumbs folder as their scan
+# (thumbs/2024/01/..., see Storage.shard), so no folder gets too many entries
+def thumbnails_folder(shard:str='') -> str:
+    return f'thumbs/{shard}' if shard else 'thumbs'
+
+
+def thumbnail_name(filename:str, shard:str='') -> str:
+    return f'{thumbnails_folder(shard)}/{filename}.thumb.jpg'
+
+
+def rendition_name(filename:str, size:int, fmt:str, shard:str='') -> str:
+    return f'{thumbnails_folder(shard)}/{filename}.{size}.{RENDITION_EXTENSIONS[fmt]}'
+
+
+# All files derived from the given image (relative to the scans folder)
+def thumbnail_files(filename:str, sizes:List[int], fmt:str, shard:str='') -> List[str]:
+    return [thumbnail_name(filename, shard)] + [rendition_name(filename, size, fmt, shard) for size in sizes]
+
+
+# Changes whenever the source image changes (used in URLs and ETags)
+def rendition_version(mtime:float, filesize:int) -> str:
+    return f'{int(mtime * 1000000):x}{filesize:x}'
+
+
+# Written under temporary name and renamed, so a file being written
+# (possibly by another worker) is never served
+def _save_replace(im:Image.Image, target:Path, fmt:str, **options):
+    partial = target.with_name(f'.{target.name}.{os.getpid()}.part')
+    try:
+        im.save(partial, fmt, **options)
+        os.replace(partial, target)
+    finally:
+        if partial.exists():
+            partial.unlink()
+
+
+# Shrinks the image and saves it as JPEG thumbnail.
+# For image that is not loaded yet, JPEG is decoded at reduced scale
+# (DCT scaling, 1/2 - 1/8) and other formats are reduced by box filter
+# before resampling, so the full resolution is never resampled.
+def save_thumbnail(im:Image.Image, target:str):
+    Path(target).parent.mkdir(parents=True, exist_ok=True)
+    im.draft(None, THUMBNAIL_SIZE)
+    im.thumbnail(THUMBNAIL_SIZE, reducing_gap=2.0)
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    _save_replace(im, Path(target), 'JPEG')
+
+
+# Saves the pyramid of renditions and the thumbnail in one pass.
+# Image is decoded once (at reduced scale for JPEG), the largest rendition
+# is made first and every next one is resized from the previous.
+def save_renditions(im:Image.Image, folder:str, filename:str, sizes:List[int], fmt:str, shard:str=''):
+    folder = Path(folder)
+    (folder / thumbnails_folder(shard)).mkdir(parents=True, exist_ok=True)
+    sizes = sorted(sizes, reverse=True)
+    if sizes:
+        im.draft(None, (sizes[0], sizes[0]))
+    for size in sizes:
+        im.thumbnail((size, size), reducing_gap=2.0)
+        out = im if im.mode in ('RGB', 'L') else im.convert('RGB')
+        _save_replace(out, folder / rendition_name(filename, size, fmt, shard), fmt.upper(), quality=85)
+    save_thumbnail(im, str(folder / thumbnail_name(filename, shard)))
+
+
+# Thumbnails were rendered (e.g. by another worker) from the current source
+# (render_thumbnails gives them mtime of the source it read)
+def _up_to_date(source:str, folder:str, thumbnails:List[str]) -> bool:
+    try:
+        mtime = os.stat(source).st_mtime
+        return all(os.stat(Path(folder) / thumbnail).st_mtime >= mtime for thumbnail in thumbnails)
+    except FileNotFoundError:
+        return False
+
+
+# Executed in worker process
+def render_thumbnails(source:str, folder:str, filename:str, sizes:List[int], fmt:str, shard:str='') -> bool:
+    try:
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        # another worker process may be rendering the same file
+        with Locks(str(Path(folder) / LOCKS_FOLDER)).striped('thumbnails', filename):
+            files = thumbnail_files(filename, sizes, fmt, shard)
+            if _up_to_date(source, folder, files):
+                return True
+            # source written while rendering is newer than the thumbnails, so they are rendered again
+            mtime = os.stat(source).st_mtime
+            with Image.open(source) as im:
+                save_renditions(im, folder, filename, sizes, fmt, shard)
+            for thumbnail in files:
+                os.utime(Path(folder) / thumbnail, (mtime, mtime))
+        return True
+    except Exception as ex:
+        logger.warning(f'Problem with generating thumbnails for {source}: {ex}')
+        return False
+
+
+# Generates thumbnails (render_thumbnails) in a process pool at idle priority,
+# off the request path.
+# Requests wait in a bounded priority queue; requesting the same file again
+# with a higher priority (e.g. when it is displayed) moves it forward.
+# Refresh of a file that is being rendered (its content changed) runs the
+# task again when the current run finishes, its result is not reported.
+# Subclasses run other per-file tasks the same way (on_done gets task result).
+class ThumbnailPool:
+    task = staticmethod(render_thumbnails)
+    initializer: Optional[Callable[[], None]] = staticmethod(idle_priority) # run in each worker process
+    name = 'swis-thumbnails'
+
+    def __init__(
+        self,
+        workers:int,
+        queue_size:int,
+        on_done:Callable[[str, bool], None]
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.on_done = on_done
+        self._cond = threading.Condition()
+        self._heap = []
+        self._pending: Dict[str, tuple] = {} # filename -> (priority, task args)
+        self._running = set()
+        self._refresh: Dict[str, tuple] = {} # running file -> (priority, task args) of the next run
+        self._counter = itertools.count()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _start(self):
+        if self._dispatcher is None:
+            # workers are not forked from the server, whose threads (logging,
+            # sqlite, locks) may hold a lock at the moment of the fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                initializer=self.initializer
+            )
+            self._dispatcher = threading.Thread(target=self._dispatch, name=self.name, daemon=True)
+            self._dispatcher.start()
+
+    # Returns False when the request was dropped because the queue is full
+    # (the thumbnail stays pending and is requested again once displayed)
+    def submit(self, filename:str, args:tuple, priority:int=NEW, refresh:bool=False) -> bool:
+        with self._cond:
+            if self._closed:
+                return False
+            if filename in self._running:
+                if refresh:
+                    self._refresh[filename] = (priority, args)
+                return True
+            queued = self._pending.get(filename)
+            if queued is not None and queued[0] <= priority:
+                return True
+            if queued is None and priority != VIEWED and len(self._pending) >= self.queue_size:
+                return False
+            self._start()
+            self._pending[filename] = (priority, args)
+            heapq.heappush(self._heap, (priority, next(self._counter), filename))
+            self._cond.notify()
+            return True
+
+    # Whether the file is running or waiting with the same or higher priority
+    # (submitting it again would change nothing)
+    def queued(self, filename:str, priority:int=NEW) -> bool:
+        with self._cond:
+            queued = self._pending.get(filename)
+            return filename in self._running or (queued is not None and queued[0] <= priority)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    while self._heap and self._heap[0][2] not in self._pending:
+                        heapq.heappop(self._heap)
+                    if self._heap and len(self._running) < self.workers:
+                        break
+                    self._cond.wait()
+                priority, _, filename = heapq.heappop(self._heap)
+                queued = self._pending[filename]
+                if queued[0] != priority:
+                    continue # outdated entry, file was moved forward
+                del self._pending[filename]
+                self._running.add(filename)
+            started = time.perf_counter()
+            future = self._executor.submit(self.task, *queued[1])
+            future.add_done_callback(lambda f, filename=filename: self._finished(filename, f, started))
+
+    def _finished(self, filename:str, future, started:float):
+        TASK_SECONDS.observe(time.perf_counter() - started, self.name.replace('swis-', ''))
+        try:
+            ok = future.result()
+        except Exception as ex:
+            logger.error(f'Worker of {self.name} failed for {filename}: {ex}')
+            ok = False
+        with self._cond:
+            self._running.discard(filename)
+            self._cond.notify()
+            again = self._refresh.pop(filename, None)
+        if again is not None:
+            # result of the previous content
+            self.submit(filename, again[1], again[0])
+            return
+        self.on_done(filename, ok)
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
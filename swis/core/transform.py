@@ -0,0 +1,127 @@
+import mmap
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from PIL import Image, JpegImagePlugin
+
+from swis.core.schemas import TransformRequest
+
+# rotation clockwise (degrees) -> Pillow transposition
+ROTATIONS = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+FLIPS = {
+    'horizontal': Image.Transpose.FLIP_LEFT_RIGHT,
+    'vertical': Image.Transpose.FLIP_TOP_BOTTOM,
+}
+# JPEG subsampling (JpegImagePlugin.get_sampling) -> MCU size
+MCU_SIZES = {0: (8, 8), 1: (16, 8), 2: (16, 16)}
+
+
+class TransformError(Exception):
+    pass
+
+
+# Crop box clamped to the image, None when it covers the whole image
+def crop_box(req:TransformRequest, size:Tuple[int, int]) -> Optional[Tuple[int, int, int, int]]:
+    if req.crop is None:
+        return None
+    if len(req.crop) != 4:
+        raise TransformError('Crop box must be [left, top, right, bottom]')
+    left, top = max(0, req.crop[0]), max(0, req.crop[1])
+    right, bottom = min(size[0], req.crop[2]), min(size[1], req.crop[3])
+    if right <= left or bottom <= top:
+        raise TransformError(f'Crop box {req.crop} is outside of the image {size[0]}x{size[1]}')
+    box = (left, top, right, bottom)
+    return None if box == (0, 0) + size else box
+
+
+def check_transform(req:TransformRequest):
+    if req.rotate % 360 not in (0, *ROTATIONS):
+        raise TransformError('Rotation must be a multiple of 90 degrees')
+    if req.flip is not None and req.flip not in FLIPS:
+        raise TransformError(f'Unknown flip {req.flip} ({", ".join(FLIPS)})')
+
+
+# Transform which leaves the image as it is (no crop, rotation or flip)
+def is_identity(req:TransformRequest, box:Optional[Tuple[int, int, int, int]]) -> bool:
+    return box is None and req.rotate % 360 == 0 and not req.flip
+
+
+# Crop, then rotate (clockwise), then flip
+def apply_transform(im:Image.Image, req:TransformRequest, box:Optional[Tuple[int, int, int, int]]) -> Image.Image:
+    if box is not None:
+        im = im.crop(box)
+    if req.rotate % 360:
+        im = im.transpose(ROTATIONS[req.rotate % 360])
+    if req.flip:
+        im = im.transpose(FLIPS[req.flip])
+    return im
+
+
+# Rows box[1]..box[3] of uncompressed image (single raw tile) read from
+# memory-mapped file, so only pages with these rows are read from disk.
+# Returns None for other images.
+def open_mapped(path:Path, box:Optional[Tuple[int, int, int, int]]) -> Optional[Image.Image]:
+    with Image.open(path) as im:
+        if len(im.tile) != 1 or im.tile[0][0] != 'raw':
+            return None
+        _, extents, offset, args = im.tile[0]
+        rawmode, stride, ystep = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        if extents != (0, 0) + im.size:
+            return None
+        mode, size, info, fmt = im.mode, im.size, dict(im.info), im.format
+    if not stride:
+        stride = len(Image.new(mode, (size[0], 1)).tobytes('raw', rawmode))
+    left, top, right, bottom = box or (0, 0) + size
+    if ystep < 0:
+        # bottom-up rows (BMP)
+        first, last = size[1] - bottom, size[1] - top
+    else:
+        first, last = top, bottom
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        rows = m[offset + first * stride:offset + last * stride]
+    im = Image.frombuffer(mode, (size[0], last - first), rows, 'raw', rawmode, stride, ystep)
+    if left or right != size[0]:
+        im = im.crop((left, 0, right, im.height))
+    im.info, im.format = info, fmt
+    return im
+
+
+# Options that keep the file format and properties of the source
+def save_options(im:Image.Image, fmt:str) -> dict:
+    options = {key: im.info[key] for key in ('dpi', 'icc_profile', 'exif') if key in im.info}
+    if fmt == 'JPEG':
+        # same quantization and subsampling as the source, so the quality stays
+        options.update(qtables=im.quantization, subsampling=JpegImagePlugin.get_sampling(im))
+    elif fmt == 'TIFF':
+        options.pop('exif', None)
+        options['compression'] = im.info.get('compression', 'raw')
+    elif fmt == 'WEBP':
+        options.update(lossless=True, quality=100, exact=True) # recompressed scans (storage.compress)
+    return options
+
+
+# jpegtran commands (run one after another, intermediate files are
+# target.0, target.1 ...) transforming JPEG without decoding it, None when
+# it cannot be done losslessly (crop box corner not on MCU boundary;
+# edge blocks of rotated/flipped image are checked by jpegtran -perfect)
+def jpegtran_commands(im:Image.Image, req:TransformRequest, box:Optional[Tuple[int, int, int, int]], source:Path, target:Path) -> Optional[List[List[str]]]:
+    steps = []
+    if box is not None:
+        mcu = MCU_SIZES.get(JpegImagePlugin.get_sampling(im), (8, 8))
+        if box[0] % mcu[0] or box[1] % mcu[1]:
+            return None
+        steps.append(['-crop', f'{box[2] - box[0]}x{box[3] - box[1]}+{box[0]}+{box[1]}'])
+    if req.rotate % 360:
+        steps.append(['-perfect', '-rotate', str(req.rotate % 360)])
+    if req.flip:
+        steps.append(['-perfect', '-flip', req.flip])
+    commands = []
+    for index, step in enumerate(steps):
+        output = target if index == len(steps) - 1 else target.with_name(f'{target.name}.{index}')
+        commands.append(['jpegtran', '-copy', 'all', *step, '-outfile', str(output), str(source)])
+        source = output
+    return commands
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, List, Optional
+
+from starlette.exceptions import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from swis.core.jobs import BoundedExecutor
+from swis.core.locks import file_lock
+from swis.core.logger import get_logger
+
+logger = get_logger()
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, size:int):
+        super().__init__(f'File size is too large ({size})')
+        self.size = size
+
+
+class UploadSessionNotFound(Exception):
+    pass
+
+
+class UploadChunkError(ValueError):
+    pass
+
+
+# Copies uploaded file to target in chunks, so only one chunk is kept in memory.
+# Data goes to a temporary name which is renamed when the whole file is written.
+# Blocking reads and writes are done by the executor, the event loop only waits for them.
+# Optional digest (hashlib object) is updated with the data as it is written.
+async def save_upload(src:BinaryIO, target:Path, limit:int, chunk_size:int, executor:BoundedExecutor, digest=None) -> int:
+    partial = target.with_name(f'.{target.name}.part')
+    size = 0
+    f = await executor.run(open, partial, 'wb')
+    try:
+        while True:
+            chunk = await executor.run(src.read, chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit:
+                raise UploadTooLarge(size)
+            if digest is not None:
+                digest.update(chunk)
+            await executor.run(f.write, chunk)
+        await executor.run(f.close)
+        await executor.run(os.replace, partial, target)
+    finally:
+        f.close()
+        if partial.exists():
+            partial.unlink()
+    return size
+
+
+# Rejects request bodies over the limit while they are received
+# (Content-Length may be missing or false)
+class BodySizeLimitMiddleware:
+    def __init__(self, app:ASGIApp, limit:int):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope:Scope, receive:Receive, send:Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.limit:
+                    raise HTTPException(413, detail=f'Request body is too large (over {self.limit})')
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class UploadSession:
+    def __init__(
+        self,
+        id:str,
+        filename:str,
+        size:int,
+        chunk_size:int,
+        sha256:Optional[str]=None,
+        received:Optional[List[int]]=None,
+        created:Optional[float]=None,
+        updated:Optional[float]=None,
+    ):
+        self.id = id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256
+        self.received = received or []
+        self.created = created or time.time()
+        self.updated = updated or self.created
+
+    @property
+    def chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def missing(self) -> List[int]:
+        received = set(self.received)
+        return [index for index in range(self.chunks) if index not in received]
+
+    def chunk_length(self, index:int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+# Resumable uploads: file is sent in numbered chunks (in any order, possibly
+# repeated), which are written straight into a partial file of the session.
+# State is kept on disk, so uploads survive restarts. Sessions that were not
+# touched for `ttl` seconds are removed by collect().
+class UploadSessions:
+    def __init__(self, folder:str, ttl:float):
+        self.folder = Path(folder)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._collector: Optional[threading.Thread] = None
+
+    def _path(self, session_id:str) -> Path:
+        if not session_id.isalnum():
+            raise UploadSessionNotFound(session_id)
+        return self.folder / session_id
+
+    def _save(self, session:UploadSession):
+        state = self._path(session.id) / 'session.json'
+        state.with_suffix('.tmp').write_text(json.dumps(session.__dict__))
+        os.replace(state.with_suffix('.tmp'), state)
+
+    def create(self, filename:str, size:int, chunk_size:int, sha256:Optional[str]=None) -> UploadSession:
+        session = UploadSession(uuid.uuid4().hex, filename, size, chunk_size, sha256)
+        path = self._path(session.id)
+        path.mkdir(parents=True)
+        with open(path / 'data.part', 'wb') as f:
+            f.truncate(size)
+        self._save(session)
+        return session
+
+    def get(self, session_id:str) -> UploadSession:
+        try:
+            return UploadSession(**json.loads((self._path(session_id) / 'session.json').read_text()))
+        except FileNotFoundError:
+            raise UploadSessionNotFound(session_id)
+
+    def write_chunk(self, session_id:str, index:int, data:bytes, sha256:Optional[str]=None) -> UploadSession:
+        session = self.get(session_id)
+        if not 0 <= index < session.chunks:
+            raise UploadChunkError(f'Chunk index out of range (0-{session.chunks - 1})')
+        if len(data) != session.chunk_length(index):
+            raise UploadChunkError(f'Chunk {index} should have {session.chunk_length(index)} bytes, got {len(data)}')
+        if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256.lower():
+            raise UploadChunkError(f'Chunk {index} checksum mismatch')
+        fd = os.open(self._path(session_id) / 'data.part', os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, index * session.chunk_size)
+        finally:
+            os.close(fd)
+        # state may be updated by another worker process at the same time
+        with self._lock, file_lock(self._path(session_id) / 'session.lock'):
+            session = self.get(session_id)
+            if index not in session.received:
+                session.received.append(index)
+            session.updated = time.time()
+            self._save(session)
+        return session
+
+    # Moves complete file to target and removes the session
+    def finalize(self, session_id:str, target:Path) -> UploadSession:
+        session = self.get(session_id)
+        if session.missing:
+            raise UploadChunkError(f'Missing chunks: {session.missing}')
+        data = self._path(session_id) / 'data.part'
+        try:
+            if session.sha256 is not None:
+                digest = hashlib.sha256()
+                with open(data, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != session.sha256.lower():
+                    raise UploadChunkError('File checksum mismatch')
+            os.replace(data, target)
+        except FileNotFoundError:
+            # finalized by another request at the same time
+            raise UploadSessionNotFound(session_id)
+        self.remove(session_id)
+        return session
+
+    def remove(self, session_id:str):
+        shutil.rmtree(self._path(session_id), ignore_errors=True)
+
+    # Removes sessions not updated for ttl seconds
+    def collect(self) -> int:
+        removed = 0
+        if not self.folder.exists():
+            return removed
+        for path in self.folder.iterdir():
+            try:
+                session = self.get(path.name)
+                expired = time.time() - session.updated > self.ttl
+            except (UploadSessionNotFound, ValueError):
+                expired = time.time() - path.stat().st_mtime > self.ttl
+            if expired:
+                self.remove(path.name)
+                removed += 1
+        return removed
+
+    def start_collector(self, interval:float):
+        def collect_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.collect()
+                except Exception as ex:
+                    logger.warning(f'Problem with removing expired upload sessions: {ex}')
+        if self._collector is None:
+            self._collector = threading.Thread(target=collect_forever, name='swis-uploads-gc', daemon=True)
+            self._collector.start()
+
+
+@lru_cache()
+def get_upload_sessions(folder:str, ttl:float) -> UploadSessions:
+    return UploadSessions(folder, ttl)
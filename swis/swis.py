@@ -10,21 +10,32 @@ if sys.version_info[0] !=3 or sys.version_info.minor < 8:
     sys.exit(1)
 
 import getpass
+import hashlib
 import errno
 import pwd
 import grp
 import argparse
+import asyncio
+import base64
 import datetime
+import io
 import os
-import random
+import re
+import shutil
 import subprocess
-from pathlib import Path
+import tempfile
+from pathlib import Path, PurePosixPath
+from urllib.parse import quote
 import json
-from typing import List
+import logging.config
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
 from PIL import Image, ImageFile
 
-from fastapi.responses import RedirectResponse
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile, status
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, UploadFile, WebSocket, WebSocketDisconnect, status
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
 
@@ -32,8 +43,27 @@ import uvicorn
 from uvicorn.config import TRACE_LOG_LEVEL, LOGGING_CONFIG
 
 from swis.core import schemas
+from swis.core import thumbnails
+from swis.core.blobs import BlobStore, HashingWriter, get_blob_store, hash_file
+from swis.core.catalog import LISTED_SUFFIXES, Catalog, CatalogItem, InvalidCursor, get_catalog
 from swis.core.config import Settings, get_settings
+from swis.core.devices import DEVICES_FILENAME, Device, DeviceRegistry
+from swis.core.jobs import JOBS_FILENAME, BoundedExecutor, Job, JobQueue, JobStore, background_priority, get_job_store
+from swis.core.locks import LOCKS_FOLDER, LockBusy, Locks, get_locks
 from swis.core.logger import get_logger
+from swis.core.metrics import PROCESS_BUCKETS, Counter, Gauge, Histogram, MetricsMiddleware, render as render_metrics, snapshot as metrics_snapshot
+from swis.core.ocr import OcrError, OcrPool, recognize
+from swis.core.pdf import PdfError, build_pdf
+from swis.core.postprocess import COLORS, COMPRESSION_FORMATS, postprocess
+from swis.core.printing import PrintJob, PrintQueue
+from swis.core.scanning import ScanStream, ScanStreamError, StageTimer
+from swis.core.storage import COMPRESSED_SUFFIX, LOSSLESS_SUFFIXES, NotCompressible, ScanFiles, Storage, compress, get_storage, public_name
+from swis.core.transform import TransformError, apply_transform, check_transform, crop_box, is_identity, jpegtran_commands, open_mapped, save_options
+from swis.core.thumbnails import ThumbnailPool, rendition_name, rendition_version, save_renditions, thumbnail_files, thumbnail_name
+from swis.core.uploads import (
+    BodySizeLimitMiddleware, UploadChunkError, UploadSession, UploadSessionNotFound,
+    UploadSessions, UploadTooLarge, get_upload_sessions, save_upload
+)
 from swis.version import __version__
 
 
@@ -41,6 +71,20 @@ root_folder = os.path.dirname(os.path.realpath(__file__))
 settings = get_settings(_env_file=f'{root_folder}/assets/defaults.env')
 settings.ROOT_FOLDER = root_folder
 logger = get_logger()
+scan_queue = JobQueue('scan', settings.JOBS_HISTORY)
+pdf_queue = JobQueue('pdf', settings.JOBS_HISTORY, settings.PDF_CONCURRENCY)
+file_executor = BoundedExecutor('files', settings.FILE_WORKERS)
+image_executor = BoundedExecutor('images', settings.IMAGE_WORKERS, background=True)
+catalog_executor = BoundedExecutor('catalog', settings.CATALOG_WORKERS)
+
+PROCESS_SECONDS = Histogram('swis_process_seconds', 'Run time of external command', ('command',), PROCESS_BUCKETS)
+PROCESSES_IN_FLIGHT = Gauge('swis_processes_in_flight', 'Running external commands', ('command',))
+SCAN_SECONDS = Histogram('swis_scan_seconds', 'Time of scanning one page', ('device', 'mode'), PROCESS_BUCKETS)
+PDF_SECONDS = Histogram('swis_pdf_seconds', 'Time of building pdf', (), PROCESS_BUCKETS)
+UPLOAD_BYTES = Counter('swis_upload_bytes_total', 'Bytes of uploaded files', ('kind',))
+UPLOAD_THROUGHPUT = Histogram(
+    'swis_upload_bytes_per_second', 'Throughput of upload requests', ('kind',), tuple(2 ** n for n in range(16, 31, 2))
+)
 
 def restricted(f):
     def inner(*args, **kwargs):
@@ -82,9 +126,28 @@ def mount_folders(app: FastAPI, settings: Settings):
     create_folder(scans_folder, settings.USER, settings.GROUP)
     create_folder(app_folder)
 
-    app.mount(settings.SCANS_ADDRESS, StaticFiles(directory=scans_folder), name="scans")
+    app.mount(settings.SCANS_ADDRESS, ScanFiles(get_storage(scans_folder, settings.ARCHIVE_FOLDER, settings.STORAGE_SHARDS)), name="scans")
     app.mount(settings.APP_ADDRESS, StaticFiles(directory=app_folder, html=True), name="root")
 
+def configure_app(app: FastAPI, settings: Settings) -> FastAPI:
+    origins = [
+        f'http://{settings.IP_ADDRESS}:{settings.PORT}',
+        # The below entries can be removed (if not used on server)
+        f'http://127.0.0.1:{settings.PORT}',
+        f'http://localhost:{settings.PORT}',
+        # The below can be removed (only for debug/dev purpose)
+        f'http://127.0.0.1:8080',
+        f'http://localhost:8080'
+    ]
+
+    add_cors_middleware(app, origins)
+    mount_folders(app, settings)
+    return app
+
+# App factory of worker processes (main with --workers)
+def create_app() -> FastAPI:
+    return configure_app(app, settings)
+
 @restricted
 def read_file(path:str) -> str:
     with open(path, 'rt') as f:
@@ -100,45 +163,125 @@ def replace(d:dict, t:str) -> str:
         t = t.replace(f'{{{{{k}}}}}', v)
     return t
 
+# Run time and number of running processes per command (sudo is skipped)
+@contextmanager
+def process_metrics(params:list):
+    command = os.path.basename(params[1] if params[0] == 'sudo' and len(params) > 1 else params[0])
+    with PROCESSES_IN_FLIGHT.track(command), PROCESS_SECONDS.time(command):
+        yield
+
 @restricted
 def _run_pocess(params:list) -> schemas.ProcessResult:
     logger.info('Executing: ' + ' '.join(params))
-    p = subprocess.run(
-        params, 
-        capture_output=True, 
-        text=True, 
-        universal_newlines=True, 
-        encoding='utf-8', 
-        errors='ignore'
-    )
+    with process_metrics(params):
+        p = subprocess.run(
+            params, 
+            capture_output=True, 
+            text=True, 
+            universal_newlines=True, 
+            encoding='utf-8', 
+            errors='ignore'
+        )
     return schemas.ProcessResult(
         stdout = p.stdout,
         stderr = p.stderr,
         returncode = p.returncode
     )
 
+# Same as _run_pocess, without blocking the event loop (and a thread) while the process runs
+async def _run_pocess_async(params:list) -> schemas.ProcessResult:
+    logger.info('Executing: ' + ' '.join(params))
+    with process_metrics(params):
+        p = await asyncio.create_subprocess_exec(
+            *params,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await p.communicate()
+    return schemas.ProcessResult(
+        stdout = stdout.decode('utf-8', errors='ignore'),
+        stderr = stderr.decode('utf-8', errors='ignore'),
+        returncode = p.returncode
+    )
+
+PROGRESS_PATTERN = re.compile(r'Progress:\s*([\d.]+)%')
+
+# Runs process with binary stdout passed to the callback in chunks as it is read.
+# stderr is read in parallel and `Progress: xx.x%` lines (scanimage --progress)
+# are reported to the other callback.
+@restricted
+def _run_pocess_stream(
+    params:list,
+    on_data:Callable[[bytes], None],
+    on_progress:Callable[[float], None],
+    chunk_size:int=256 * 1024
+) -> schemas.ProcessResult:
+    logger.info('Executing: ' + ' '.join(params))
+    p = subprocess.Popen(
+        params,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    stderr = []
+    def read_stderr():
+        # text mode translates '\r' of progress updates to line breaks
+        for line in io.TextIOWrapper(p.stderr, encoding='utf-8', errors='ignore'):
+            match = PROGRESS_PATTERN.search(line)
+            if match:
+                on_progress(float(match.group(1)))
+            elif line.strip():
+                stderr.append(line)
+    reader = threading.Thread(target=read_stderr, daemon=True)
+    reader.start()
+    try:
+        with process_metrics(params):
+            try:
+                while True:
+                    data = p.stdout.read1(chunk_size)
+                    if not data:
+                        break
+                    on_data(data)
+            except BaseException:
+                p.kill()
+                raise
+            finally:
+                p.wait()
+    finally:
+        reader.join()
+    return schemas.ProcessResult(
+        stdout = '',
+        stderr = ''.join(stderr),
+        returncode = p.returncode
+    )
+
+# locks and the shared file are in the scans folder, which is set after import
+device_registry = DeviceRegistry(_run_pocess, settings.DEVICES_TTL, lambda: locks(), lambda: Path(settings.SCANS_FOLDER) / DEVICES_FILENAME)
+print_queue = PrintQueue(_run_pocess, settings.PRINT_DEDUP_WINDOW, settings.JOBS_HISTORY)
+
 def run_pocess(cmd:str, params:list) -> schemas.ProcessResult:
     return _run_pocess([cmd] + params)
 
 def run_sudo_pocess(cmd:str, params:list) -> schemas.ProcessResult:
     return _run_pocess(['sudo', cmd] + params)
 
-def is_image_truncated(image_path):
-    try:
-        with Image.open(image_path) as img:
-            img.load()
-            return False
-    except (IOError, SyntaxError, ValueError) as e:
-        return True
+async def run_pocess_async(cmd:str, params:list) -> schemas.ProcessResult:
+    return await _run_pocess_async([cmd] + params)
 
+# Repaired image is written under temporary name and renamed, so the blob of
+# the content store the file was linked to (and its duplicates) is not changed
 def repair_truncated_image(filename):
+    path = Path(filename)
+    partial = path.with_name(f'.{path.name}.part')
     try:
         ImageFile.LOAD_TRUNCATED_IMAGES = True
-        im = Image.open(filename)
-        im.save(filename)
+        with Image.open(path) as im:
+            im.save(partial, im.format)
+        os.replace(partial, path)
     except Exception as ex:
-        print(f'Problem with repairing the image: {filename}')
-        print(ex)
+        partial.unlink(missing_ok=True)
+        logger.warning(f'Problem with repairing the image {filename}: {ex}')
+        return
+    register_file(scan_name(path), refresh_thumbnail=True, digest=store_content(path))
 
 def service_install(
     settings:Settings,
@@ -181,7 +324,7 @@ def service_uninstall(
     out = run_pocess('rm', ['/etc/systemd/system/swis.service'])
     if out.returncode != 0:
         sys.exit(out.stderr)
-    if out.stdout: print(out.stdout)
+    if out.stdout: logger.debug(out.stdout)
     return out
 
 
@@ -191,7 +334,7 @@ def service_start(
     out = run_pocess('systemctl', ['start', 'swis'])
     if out.returncode != 0:
         sys.exit(out.stderr)
-    if out.stdout: print(out.stdout)
+    if out.stdout: logger.debug(out.stdout)
     return out
 
 
@@ -201,7 +344,7 @@ def service_stop(
     out = run_pocess('systemctl', ['stop', 'swis'])
     if out.returncode != 0:
         sys.exit(out.stderr)
-    if out.stdout: print(out.stdout)
+    if out.stdout: logger.debug(out.stdout)
     return out
 
 def service_status(
@@ -210,200 +353,1455 @@ def service_status(
     out = run_pocess('systemctl', ['status', 'swis'])
     if out.returncode != 0:
         sys.exit(out.stderr or out.stdout)
-    if out.stdout: print(out.stdout)
+    if out.stdout: logger.debug(out.stdout)
     return out
     
 app = FastAPI()
+app.add_middleware(BodySizeLimitMiddleware, limit=settings.UPLOAD_SIZE_LIMIT)
+app.add_middleware(MetricsMiddleware)
 
 @app.get('/')
-def root_get():
+async def root_get():
     return RedirectResponse('/app')
 
-@app.post('/scan/execute')
-def scan_execute(
-    req: schemas.ScanRequest
-):
+# Pillow format and save options for the requested scan format
+SCAN_SAVE_FORMATS = {
+    'png': ('PNG', {}),
+    'jpeg': ('JPEG', {'quality': 90}),
+    'jpg': ('JPEG', {'quality': 90}), # the web app sends jpg
+    'pdf': ('PDF', {}),
+    'tiff': ('TIFF', {'compression': 'tiff_lzw'}), # group4 for bilevel images, see save_scan
+}
+
+# Streams being received by running scan jobs (job id -> stream), for previews
+scan_streams: Dict[str, ScanStream] = {}
+
+# Encodes decoded scan to the target file (written under temporary name first).
+# Returns hash of the encoded data when the content store is enabled.
+def save_scan(img:Image.Image, req:schemas.ScanRequest, target:Path) -> Optional[str]:
+    fmt, options = SCAN_SAVE_FORMATS[req.format]
+    if fmt == 'JPEG' and img.mode not in ('L', 'RGB'):
+        img = img.convert('L' if img.mode == '1' else 'RGB')
+    if fmt == 'TIFF' and img.mode == '1':
+        options = dict(options, compression='group4') # G4 is for bilevel images only
+    if fmt == 'JPEG' and req.postprocess:
+        options = dict(options, quality=req.postprocess.quality)
+    resolution = float(req.resolution)
+    if fmt == 'PDF':
+        options = {'resolution': resolution}
+    elif fmt == 'TIFF' and options['compression'] == 'group4':
+        # single strip, so the G4 data can be embedded in pdf as it is
+        options = dict(options, dpi=(resolution, resolution), tiffinfo={278: img.height})
+    else:
+        options = dict(options, dpi=(resolution, resolution))
+    partial = target.with_name(f'.{target.name}.part')
+    digest = None
+    try:
+        if settings.CONTENT_STORE and fmt != 'PDF':
+            with open(partial, 'wb') as f:
+                writer = HashingWriter(f)
+                img.save(writer, fmt, **options)
+            digest = writer.hexdigest()
+        else:
+            img.save(partial, fmt, **options)
+            if settings.CONTENT_STORE:
+                digest = hash_file(partial) # pdf writer seeks back, so it is hashed when written
+        os.replace(partial, target)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    return digest
+
+def scan_params(req:schemas.ScanRequest) -> List[str]:
+    # A4, or less when the device cannot scan it
+    device = device_registry.get(req.device) if req.device else None
+    width = min(211, device.width) if device and device.width else 211
+    height = min(297, device.height) if device and device.height else 297
     params = [
         '--mode', req.mode,
         '-l', '0',
         '-t', '0',
-        '-x', '211',
-        '-y', '297',
+        '-x', f'{width:g}',
+        '-y', f'{height:g}',
         f'--resolution={req.resolution}',
-        f'--format={req.format}',
+        '--format=pnm',
         f'--buffer-size={settings.BUFFER_SIZE}'
     ]
-
-    map_format_ext = {
-        'png': 'png',
-        'jpeg': 'jpg',
-        'pdf': 'pdf'
-    }
-    file_ext = map_format_ext[req.format]
-
-    filename = datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + '_' + str(random.randint(10, 99)) + f'.{file_ext}'
-    if req.filename:
-        filename = req.filename
-    params.append(f'-o{settings.SCANS_FOLDER}/{filename}')
+    if req.device:
+        params.extend(['-d', req.device])
+    if req.batch:
+        params.extend(['--source', req.source or ('ADF Duplex' if req.duplex else 'ADF')])
+    elif req.source:
+        params.extend(['--source', req.source])
+    params.append('--progress')
+    return params
+
+# Encodes received scan to the target format and downscales it to renditions
+# from the same decoded image. Missing data is padded only when the stream is short.
+# Returns error message when the scan could not be saved.
+def store_scan(stream:ScanStream, req:schemas.ScanRequest, filename:str, timer:StageTimer) -> Optional[str]:
+    if stream.truncated:
+        logger.warning(f'Scan {filename} is short by {stream.expected - stream.received} bytes, padding')
+    try:
+        img, _ = stream.close()
+        if req.postprocess:
+            img = postprocess(img, req.postprocess, float(req.resolution), timer)
+        with timer.stage('encode'):
+            digest = save_scan(img, req, scan_path(filename, create=True))
+            digest = store_content(scan_path(filename), digest)
+    except Exception as ex:
+        logger.exception(f'Problem with saving scan {filename}')
+        return str(ex)
+    if req.format != 'pdf':
+        with timer.stage('renditions'):
+            files = scan_thumbnail_files(filename)
+            if digest is None or not blob_store().link_thumbnails(digest, filename, files):
+                try:
+                    save_renditions(img, settings.SCANS_FOLDER, filename, settings.RENDITION_SIZES, settings.RENDITION_FORMAT, storage().shard(filename))
+                    if digest is not None:
+                        blob_store().keep_thumbnails(digest, filename, files)
+                except Exception as ex:
+                    logger.warning(f'Problem with generating thumbnail for {filename}: {ex}')
+    img.close()
+    with timer.stage('register'):
+        register_file(filename, digest=digest)
+    return None
+
+# Scanned image is read from scanimage stdout (PNM) and decoded while it
+# is received, then stored (see store_scan)
+def scan_image(
+    job: Job,
+    req: schemas.ScanRequest,
+    filename: str
+) -> schemas.ScanResult:
+    params = scan_params(req)
     create_folder(settings.SCANS_FOLDER, settings.USER,settings.GROUP)
-    
-    p = run_pocess('scanimage', params)
 
-    if is_image_truncated(f'{settings.SCANS_FOLDER}/{filename}'):
-        repair_truncated_image(f'{settings.SCANS_FOLDER}/{filename}')
-    
+    timer = StageTimer()
+    stream = ScanStream()
+    first_data = None
+    def on_data(data:bytes):
+        nonlocal first_data
+        if first_data is None:
+            first_data = time.perf_counter()
+            timer.mark('wait')
+        stream.feed(data)
+    def on_progress(progress:float):
+        job.progress = progress
+
+    scan_streams[job.id] = stream
+    try:
+        try:
+            # the device may be used by a job of another worker process
+            with locks().lock(f'device-{req.device or "default"}'):
+                timer.mark('device')
+                job.check_cancelled() # while waiting for the device
+                p = _run_pocess_stream(['scanimage'] + params, on_data, on_progress)
+        except ScanStreamError as ex:
+            p = schemas.ProcessResult(returncode=1, stdout='', stderr=str(ex))
+        if first_data is not None:
+            timer.mark('scan', first_data)
+            SCAN_SECONDS.observe(timer.timings['wait'] - timer.timings['device'] + timer.timings['scan'], req.device or 'default', req.mode)
+    finally:
+        del scan_streams[job.id]
+
     out = p.stdout
     err = p.stderr
     code = p.returncode
     logger.info(out + err)
     logger.info(code)
-    
+
+    if stream.image is not None:
+        error = store_scan(stream, req, filename, timer)
+        if error is not None:
+            return schemas.ScanResult(
+                code = code or 1,
+                detail = f'{err}{error}',
+                timings = timer.timings
+            )
+    logger.info(f'Scan {filename} timings: {timer}')
+
     return schemas.ScanResult(
         code = code,
         detail = out if code==0 else err,
-        filename = filename
+        filename = filename,
+        timings = timer.timings
     )
 
 
+# Name of batch page: 20240101-120000_42.png -> 20240101-120000_42-p001.png
+def batch_page_name(filename:str, page:int) -> str:
+    path = Path(filename)
+    return f'{path.stem}-p{page:03d}{path.suffix}'
+
+# ADF scanning: single scanimage run for the whole stack (--batch). scanimage
+# writes PNM page files to a temporary folder and prints their names when they
+# are complete, so every page is stored (and thumbnailed) as soon as it lands.
+# Pages can be assembled to PDF when the feeder is empty.
+def scan_batch(
+    job: Job,
+    req: schemas.ScanRequest,
+    filename: str
+) -> schemas.ScanResult:
+    create_folder(settings.SCANS_FOLDER, settings.USER,settings.GROUP)
+    batch_folder = Path(settings.SCANS_FOLDER) / f'.batch-{job.id}'
+    batch_folder.mkdir()
+    params = scan_params(req) + [
+        f'--batch={batch_folder}/page%04d.pnm',
+        '--batch-print',
+    ]
+
+    timer = StageTimer()
+    pages: List[str] = []
+    errors: List[str] = []
+    page_started = time.perf_counter()
+    lines = b''
+    def on_page(path:Path):
+        nonlocal page_started
+        page_seconds = time.perf_counter() - page_started
+        timer.timings['scan'] = timer.timings.get('scan', 0.0) + page_seconds
+        SCAN_SECONDS.observe(page_seconds, req.device or 'default', req.mode)
+        page = batch_page_name(filename, len(pages) + 1)
+        stream = ScanStream()
+        with timer.stage('decode'):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    stream.feed(block)
+        path.unlink()
+        scan_streams[job.id] = stream
+        error = store_scan(stream, req, page, timer)
+        if error is None:
+            pages.append(page)
+            job.steps = len(pages)
+        else:
+            errors.append(f'{page}: {error}')
+        page_started = time.perf_counter()
+        job.check_cancelled()
+    def on_data(data:bytes):
+        nonlocal lines
+        lines += data
+        *complete, lines = lines.split(b'\n')
+        for line in complete:
+            if line.strip():
+                on_page(Path(line.strip().decode()))
+    def on_progress(progress:float):
+        job.progress = progress
+
+    try:
+        try:
+            with locks().lock(f'device-{req.device or "default"}'):
+                job.check_cancelled() # while waiting for the device
+                page_started = time.perf_counter()
+                p = _run_pocess_stream(['scanimage'] + params, on_data, on_progress)
+        except ScanStreamError as ex:
+            p = schemas.ProcessResult(returncode=1, stdout='', stderr=str(ex))
+    finally:
+        scan_streams.pop(job.id, None)
+        shutil.rmtree(batch_folder, ignore_errors=True)
+
+    err = p.stderr + ''.join(f'{error}\n' for error in errors)
+    code = p.returncode
+    # scanimage reports empty feeder as an error, even when it was expected
+    if code != 0 and pages and 'out of documents' in p.stderr.lower():
+        code = 0
+    logger.info(err)
+    logger.info(code)
+
+    pdf = None
+    if req.batch_pdf and pages:
+        pdf = Path(filename).stem + '.pdf'
+        try:
+            with timer.stage('pdf'), PDF_SECONDS.time():
+                build_pdf([scan_path(page) for page in pages], scan_path(pdf, create=True))
+            register_file(pdf, digest=store_content(scan_path(pdf)))
+        except (PdfError, OSError) as ex:
+            logger.warning(f'Problem with making pdf of {filename}: {ex}')
+            err += f'{ex}\n'
+            pdf = None
+    logger.info(f'Batch {filename} ({len(pages)} pages) timings: {timer}')
+
+    return schemas.ScanResult(
+        code = code if not errors else code or 1,
+        detail = err if code != 0 or errors else f'{len(pages)} pages scanned',
+        filename = pdf or (pages[0] if pages else None),
+        pages = pages,
+        timings = timer.timings
+    )
+
+
+def scan_job_status(job: Job) -> schemas.ScanJob:
+    return schemas.ScanJob(
+        id = job.id,
+        status = job.status,
+        device = job.args[0].device,
+        position = scan_queue.position(job),
+        progress = job.progress,
+        created = job.created,
+        started = job.started,
+        finished = job.finished,
+        detail = job.error,
+        pages_done = job.steps,
+        result = job.result
+    )
+
+
+# Scans are queued and executed in background (one at a time per device)
+@app.post('/scan/execute')
+async def scan_execute(
+    req: schemas.ScanRequest
+):
+    map_format_ext = {
+        'png': 'png',
+        'jpeg': 'jpg',
+        'jpg': 'jpg',
+        'pdf': 'pdf',
+        'tiff': 'tif'
+    }
+    if req.format not in map_format_ext:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Unknown format {req.format} ({", ".join(map_format_ext)})'
+        )
+    if req.postprocess:
+        options = req.postprocess
+        if options.color is not None and options.color not in COLORS:
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f'Unknown color {options.color} ({", ".join(COLORS)})'
+            )
+        if options.compression is not None:
+            if options.compression not in COMPRESSION_FORMATS:
+                raise HTTPException(
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f'Unknown compression {options.compression} ({", ".join(COMPRESSION_FORMATS)})'
+                )
+            # compression selects the stored format
+            req = req.copy(update={'format': COMPRESSION_FORMATS[options.compression]})
+    file_ext = map_format_ext[req.format]
+    if req.batch and req.format == 'pdf':
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='Batch pages cannot be saved as pdf, use png or jpeg with batch_pdf'
+        )
+
+    # devices are known from background discovery, so scanimage does not search for them
+    device = device_registry.get(req.device) if req.device else device_registry.default()
+    if device is not None:
+        req = req.copy(update={'device': device.name})
+        if req.batch and not req.source:
+            req.source = device.feeder_source(req.duplex)
+        problem = device.check(req.mode, req.resolution, req.source)
+        if problem:
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=problem
+            )
+
+    filename = req.filename or await file_executor.run(get_image_filename, f'.{file_ext}')
+
+    job = scan_queue.submit(req.device or 'default', scan_batch if req.batch else scan_image, req, filename)
+    logger.info(f'Scan job {job.id} queued ({filename})')
+    await file_executor.run(publish_job, 'scan', job)
+    return scan_job_status(job)
+
+
+# Low resolution preview of (partially) scanned image as data URL.
+# Uses image being decoded by the scan job, rows not scanned yet are blank.
+def scan_preview(job:Job) -> Optional[str]:
+    stream = scan_streams.get(job.id)
+    im = stream.image if stream is not None else None
+    if im is None:
+        return None # nothing received yet
+    try:
+        factor = max(1, max(im.size) // settings.PREVIEW_SIZE)
+        if im.mode == '1':
+            im = im.resize((im.width // factor, im.height // factor), Image.NEAREST)
+        else:
+            im = im.reduce(factor)
+        buf = io.BytesIO()
+        im.convert('RGB').save(buf, 'JPEG', quality=70)
+    except Exception:
+        return None
+    return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode()
+
+
+# Streaming scan: client sends ScanRequest (JSON) and receives
+# job status updates with progress and periodic previews until the scan ends
+@app.websocket('/scan/ws')
+async def scan_websocket(
+    websocket: WebSocket
+):
+    await websocket.accept()
+    try:
+        req = schemas.ScanRequest(**await websocket.receive_json())
+        job_status = await scan_execute(req)
+        job = scan_queue.get(job_status.id)
+        last = None
+        last_preview = 0.0
+        while True:
+            job_status = scan_job_status(job)
+            state = (job_status.status, job_status.position, job_status.progress)
+            if state != last:
+                await websocket.send_json({'type': 'status', 'job': json.loads(job_status.json())})
+                last = state
+            if job.finished_or_failed:
+                break
+            now = asyncio.get_running_loop().time()
+            if job.status == Job.RUNNING and now - last_preview >= settings.PREVIEW_INTERVAL:
+                last_preview = now
+                preview = await image_executor.run(scan_preview, job)
+                if preview:
+                    await websocket.send_json({'type': 'preview', 'image': preview})
+            await asyncio.sleep(0.25)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass # scan continues, result available at /scan/jobs/{id}
+    except HTTPException as ex:
+        await websocket_error(websocket, ex.detail)
+    except ValueError as ex: # invalid JSON or ScanRequest
+        await websocket_error(websocket, str(ex))
+
+
+# Tells the client why the scan was not started and closes the connection
+async def websocket_error(websocket:WebSocket, detail:str):
+    logger.warning(f'Scan not started: {detail}')
+    try:
+        await websocket.send_json({'type': 'error', 'status': 'error', 'detail': detail})
+        await websocket.close(code=1008) # policy violation, the request was invalid
+    except WebSocketDisconnect:
+        pass
+
+
+def device_info(device:Device) -> schemas.DeviceInfo:
+    return schemas.DeviceInfo(
+        name = device.name,
+        vendor = device.vendor,
+        model = device.model,
+        type = device.type,
+        modes = device.modes,
+        resolutions = device.resolutions,
+        resolution_min = device.resolution_range[0] if device.resolution_range else None,
+        resolution_max = device.resolution_range[1] if device.resolution_range else None,
+        sources = device.sources,
+        width = device.width,
+        height = device.height
+    )
+
+
+# Scanners found by the last discovery (refresh=true waits for a new one)
+@app.get('/devices')
+async def devices_get(
+    refresh: bool = False
+):
+    if refresh:
+        await file_executor.run(device_registry.refresh, force=True)
+    return schemas.DeviceList(
+        returncode = 0 if device_registry.error is None else 1,
+        detail = device_registry.error or '',
+        refreshed = device_registry.refreshed,
+        devices = [device_info(device) for device in device_registry.list()]
+    )
+
+
+@app.get('/scan/jobs')
+async def scan_jobs_get():
+    shared = await file_executor.run(shared_jobs, 'scan', schemas.ScanJob)
+    return schemas.ScanJobList(
+        returncode = 0,
+        detail = '',
+        jobs = [scan_job_status(job) for job in scan_queue.list()] + shared
+    )
+
+
+@app.get('/scan/jobs/{job_id}')
+async def scan_job_get(
+    job_id: str
+):
+    job = scan_queue.get(job_id)
+    if job is None:
+        return await file_executor.run(shared_job, 'scan', job_id, schemas.ScanJob, 'Scan job not found')
+    return scan_job_status(job)
+
+
+# Queued scans are removed, batch scans stop after the current page
+@app.delete('/scan/jobs/{job_id}')
+async def scan_job_delete(
+    job_id: str
+):
+    job = scan_queue.get(job_id)
+    if job is None:
+        return await file_executor.run(cancel_shared_job, 'scan', job_id, schemas.ScanJob, 'Scan job not found')
+    scan_queue.cancel(job)
+    return scan_job_status(job)
+
 
 @app.post('/scan/update')
-def endpoint_images_update_post(
+async def endpoint_images_update_post(
     request: Request,
     file: UploadFile = File(...),
 ):
     target_folder = Path(settings.SCANS_FOLDER)
-    create_folder(target_folder, settings.USER,settings.GROUP)
+    await file_executor.run(create_folder, target_folder, settings.USER,settings.GROUP)
 
-    target_filepath = target_folder / file.filename
-    with open(target_filepath, 'wb+') as file_object:
-        filesize = file_object.write(file.file.read())
+    target_filepath = await file_executor.run(scan_path, file.filename, True)
+    digest = hashlib.sha256() if settings.CONTENT_STORE else None
+    try:
+        filesize = await save_upload(file.file, target_filepath, settings.UPLOAD_SIZE_LIMIT, settings.UPLOAD_CHUNK_SIZE, file_executor, digest)
+    except UploadTooLarge as ex:
+        logger.error(f'{request.client.host} | {file.filename} | {ex}')
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=str(ex)
+        )
     if settings.USER is not None and settings.GROUP is not None:
-        os.chown(
+        await file_executor.run(
+            os.chown,
             target_filepath, 
             pwd.getpwnam(settings.USER).pw_uid, 
             grp.getgrnam(settings.GROUP).gr_gid
         )
+    record_upload(request, 'update', filesize)
+    digest = await file_executor.run(store_content, target_filepath, digest and digest.hexdigest())
+    await file_executor.run(register_file, file.filename, refresh_thumbnail=True, digest=digest)
 
     return True
 
 
-# make pdf from selected filenames
+def make_pdf(
+    job: Job,
+    sources: List[Path],
+    target_filepath: Path
+) -> schemas.MergeResult:
+    def on_page(done:int, total:int):
+        job.steps = done
+        job.progress = 100.0 * done / total
+        job.check_cancelled()
+
+    logger.info(f'Building pdf {target_filepath} from: {[scan_name(source) for source in sources]}')
+    try:
+        with PDF_SECONDS.time():
+            repaired = build_pdf(
+                sources,
+                target_filepath,
+                repair=lambda path: repair_truncated_image(str(path)),
+                on_page=on_page,
+                page_words=pdf_page_words
+            )
+    except (PdfError, OSError) as ex:
+        logger.error(f'Problem with building pdf {target_filepath}: {ex}')
+        return schemas.MergeResult(
+            returncode = 1,
+            detail = str(ex),
+            filename = target_filepath.name
+        )
+    if settings.USER is not None and settings.GROUP is not None:
+        os.chown(
+            target_filepath, 
+            pwd.getpwnam(settings.USER).pw_uid, 
+            grp.getgrnam(settings.GROUP).gr_gid
+        )
+    register_file(target_filepath.name, digest=store_content(target_filepath))
+    # recognized text of the pages makes the pdf searchable
+    texts = [scans_catalog().get_text(scan_name(source)) for source in sources]
+    if any(texts):
+        st = target_filepath.stat()
+        text = '\n\n'.join(text for text, _ in filter(None, texts))
+        scans_catalog().set_text(target_filepath.name, st.st_mtime, st.st_size, text, {})
+
+    return schemas.MergeResult(
+        returncode = 0,
+        detail = f'Repaired pages: {", ".join(map(public_name, repaired))}' if repaired else '',
+        filename = target_filepath.name
+    )
+
+
+def pdf_job_status(job: Job) -> schemas.PdfJob:
+    return schemas.PdfJob(
+        id = job.id,
+        status = job.status,
+        position = pdf_queue.position(job),
+        progress = job.progress,
+        pages = len(job.args[0]),
+        pages_done = job.steps,
+        created = job.created,
+        started = job.started,
+        finished = job.finished,
+        detail = job.error,
+        result = job.result
+    )
+
+
+def get_pdf_job(job_id: str) -> Job:
+    job = pdf_queue.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='PDF job not found'
+        )
+    return job
+
+
+# make pdf from selected filenames (queued, at most PDF_CONCURRENCY built at once)
 @app.post('/makepdf')
-def endpoint_images_makepdf_post(
+async def endpoint_images_makepdf_post(
     request: Request,
     scan_request: schemas.MakePdf
 ):
+    pdfs = [filename for filename in scan_request.filenames if Path(filename).suffix.lower() == '.pdf']
+    if pdfs:
+        # pages are images, PDF files are not merged
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'PDF files cannot be added to pdf, select images only: {", ".join(pdfs)}'
+        )
     target_folder = Path(settings.SCANS_FOLDER)
-    create_folder(target_folder, settings.USER,settings.GROUP)
+    await file_executor.run(create_folder, target_folder, settings.USER,settings.GROUP)
 
     if scan_request.target:
         if scan_request.target.endswith('.pdf'):
-            target_filepath = target_folder / scan_request.target
+            target = scan_request.target
         else:
-            target_filepath = target_folder / (scan_request.target + '.pdf')
+            target = scan_request.target + '.pdf'
     else:
-        target_filepath = target_folder / (datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + '_' + str(random.randint(100, 999)) + '.pdf')
-    cmd = []
-    cmd.extend([str(target_folder / filename) for filename in scan_request.filenames])
-    cmd.append(str(target_filepath))
-    logger.info(f'Running pdf convert: {cmd}')
-    p = run_pocess('convert', cmd)
-    if 'Not enough image data' in p.stdout or 'Not enough image data' in p.stderr or p.returncode != 0:
-        for imgfilename in scan_request.filenames:
-            repair_truncated_image(str(target_folder / imgfilename))  # TODO: Add Exception support
-        p = run_pocess('convert', cmd)
-    if settings.USER is not None and settings.GROUP is not None:
-        os.chown(
-            target_filepath, 
-            pwd.getpwnam(settings.USER).pw_uid, 
-            grp.getgrnam(settings.GROUP).gr_gid
-        )
+        target = await file_executor.run(get_image_filename, '.pdf')
+    target_filepath = await file_executor.run(scan_path, target, True)
+    sources = [await file_executor.run(scan_path, filename) for filename in scan_request.filenames]
 
-    return schemas.MergeResult(
-        returncode = p.returncode,
-        detail = p.stdout if p.returncode==0 else p.stderr,
-        filename = target_filepath.name
+    job = pdf_queue.submit('pdf', make_pdf, sources, target_filepath)
+    logger.info(f'PDF job {job.id} queued ({target_filepath.name})')
+    await file_executor.run(publish_job, 'pdf', job)
+    return pdf_job_status(job)
+
+
+@app.get('/makepdf/jobs')
+async def pdf_jobs_get():
+    shared = await file_executor.run(shared_jobs, 'pdf', schemas.PdfJob)
+    return schemas.PdfJobList(
+        returncode = 0,
+        detail = '',
+        jobs = [pdf_job_status(job) for job in pdf_queue.list()] + shared
     )
 
 
-# Function creates thumbnails for given image
-def create_thumbnail(filename):
-    thumb_filename = f'thumbs/{filename}.thumb.jpg'
-    thumb_filename_path = Path(settings.SCANS_FOLDER) / thumb_filename
-    if not thumb_filename_path.exists():
-        thumb_filename_path.parent.mkdir(parents=True, exist_ok=True)
+@app.get('/makepdf/jobs/{job_id}')
+async def pdf_job_get(
+    job_id: str
+):
+    if pdf_queue.get(job_id) is None:
+        return await file_executor.run(shared_job, 'pdf', job_id, schemas.PdfJob, 'PDF job not found')
+    return pdf_job_status(get_pdf_job(job_id))
+
+
+@app.delete('/makepdf/jobs/{job_id}')
+async def pdf_job_delete(
+    job_id: str
+):
+    if pdf_queue.get(job_id) is None:
+        return await file_executor.run(cancel_shared_job, 'pdf', job_id, schemas.PdfJob, 'PDF job not found')
+    job = get_pdf_job(job_id)
+    pdf_queue.cancel(job)
+    return pdf_job_status(job)
+
+
+def scans_catalog() -> Catalog:
+    return get_catalog(settings.SCANS_FOLDER, settings.ARCHIVE_FOLDER, settings.STORAGE_SHARDS)
+
+
+def storage() -> Storage:
+    return get_storage(settings.SCANS_FOLDER, settings.ARCHIVE_FOLDER, settings.STORAGE_SHARDS)
+
+
+# Path of the scan of given (flat) name: in its shard, in the archive
+# or in the scans folder itself (see Storage)
+def scan_path(filename:str, create:bool=False) -> Path:
+    return storage().path(filename, create)
+
+
+# Name of the scan stored in the path (reverse of scan_path)
+def scan_name(path:Path) -> str:
+    return public_name(path.name)
+
+
+# Thumbnail and renditions of the scan (in the thumbs shard of the scan)
+def scan_thumbnail(filename:str) -> str:
+    return thumbnail_name(filename, storage().shard(filename))
+
+
+def scan_thumbnail_files(filename:str) -> List[str]:
+    return thumbnail_files(filename, settings.RENDITION_SIZES, settings.RENDITION_FORMAT, storage().shard(filename))
+
+
+def blob_store() -> BlobStore:
+    return get_blob_store(settings.SCANS_FOLDER)
+
+
+# Locks shared by worker processes (files in the scans folder)
+def locks() -> Locks:
+    return get_locks(str(Path(settings.SCANS_FOLDER) / LOCKS_FOLDER))
+
+
+# Status of jobs shared by worker processes, None with one worker
+def job_store() -> Optional[JobStore]:
+    if settings.WORKERS <= 1:
+        return None
+    return get_job_store(str(Path(settings.SCANS_FOLDER) / JOBS_FILENAME))
+
+
+# kind -> (queue, status schema of its job)
+def shared_queues() -> dict:
+    return {
+        'scan': (scan_queue, scan_job_status),
+        'pdf': (pdf_queue, pdf_job_status),
+        'print': (print_queue, print_job_status),
+    }
+
+
+# (id, created, finished, status JSON) of the job for the job store
+def job_snapshot(kind:str, job) -> tuple:
+    finished = not job.active if isinstance(job, PrintJob) else job.finished_or_failed
+    _, job_status = shared_queues()[kind]
+    return job.id, job.created, finished, job_status(job).json()
+
+
+# Makes new job visible to the other workers at once (not at the next sync)
+def publish_job(kind:str, job):
+    store = job_store()
+    if store is not None:
+        store.publish(kind, [job_snapshot(kind, job)])
+
+
+# Publishes status of jobs and metrics of this worker and cancels jobs the
+# other workers were asked to cancel (multi-worker mode)
+def sync_jobs():
+    published: Dict[str, set] = {} # kind -> finished jobs already published
+    while True:
+        time.sleep(settings.JOBS_SYNC_INTERVAL)
         try:
-            from PIL import Image, ImageFile
-            ImageFile.LOAD_TRUNCATED_IMAGES = True
-            im = Image.open(Path(settings.SCANS_FOLDER) / filename)
-            im.thumbnail((128, 128))
-            im.save(thumb_filename_path, "JPEG")
+            store = job_store()
+            for kind, (queue, _) in shared_queues().items():
+                jobs = queue.list()
+                done = published.setdefault(kind, set())
+                done.intersection_update(job.id for job in jobs)
+                snapshots = [job_snapshot(kind, job) for job in jobs if job.id not in done]
+                store.publish(kind, snapshots)
+                done.update(job_id for job_id, _, finished, _ in snapshots if finished)
+                for job_id in store.cancel_requests(kind):
+                    job = queue.get(job_id)
+                    if job is not None:
+                        queue.cancel(job)
+            store.publish_metrics(metrics_snapshot())
+            store.prune(settings.JOBS_HISTORY)
         except Exception as ex:
-            print(f'Problem with generating thumbnail for {filename}')
-            print(ex)
-            thumb_filename = filename # cannot create thumbnail, use original
-    return thumb_filename
+            logger.warning(f'Problem with sharing jobs: {ex}')
 
 
-@app.get('/scans')
-def endpoint_images_get():
-    filenames = list(filter(lambda x: Path(x).suffix in ['.jpg', '.jpeg', '.png', '.pdf'], os.listdir(settings.SCANS_FOLDER)))
-    filenames.sort(key=lambda x: os.path.getmtime(Path(settings.SCANS_FOLDER) / x), reverse=True)
-    thumbnails = []
+# Status of job run by another worker, 404 when no worker has it
+def shared_job(kind:str, job_id:str, model, detail:str):
+    store = job_store()
+    status_json = store.get(kind, job_id) if store is not None else None
+    if status_json is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail=detail
+        )
+    return model.parse_raw(status_json)
+
+
+# Jobs run by the other workers
+def shared_jobs(kind:str, model) -> list:
+    store = job_store()
+    return [model.parse_raw(status_json) for status_json in store.list(kind)] if store is not None else []
+
+
+# Asks the worker running the job to cancel it, returns its last known status
+def cancel_shared_job(kind:str, job_id:str, model, detail:str):
+    job = shared_job(kind, job_id, model, detail)
+    job_store().request_cancel(kind, job_id)
+    return job
+
+
+# With CONTENT_STORE enabled, moves written file to the content store (file
+# becomes hard link to the blob of its content) and releases the content it
+# replaced. Returns hash of the content (None when the store is disabled).
+def store_content(path:Path, digest:Optional[str]=None) -> Optional[str]:
+    if not settings.CONTENT_STORE:
+        return None
+    digest = (digest or hash_file(path)).lower()
+    previous = scans_catalog().hash_of(scan_name(path))
+    if blob_store().store(path, path, digest):
+        logger.info(f'{scan_name(path)} has the same content as stored {digest}')
+    if previous and previous != digest:
+        blob_store().release(previous)
+    return digest
+
+
+def thumbnail_done(filename:str, ok:bool):
+    # cannot create thumbnail, use original
+    scans_catalog().set_thumbnail(filename, scan_thumbnail(filename) if ok else filename)
+    digest = scans_catalog().hash_of(filename) if ok else None
+    if digest:
+        blob_store().keep_thumbnails(digest, filename, scan_thumbnail_files(filename))
+
+
+thumbnail_pool = ThumbnailPool(
+    settings.THUMBNAIL_WORKERS,
+    settings.THUMBNAIL_QUEUE_SIZE,
+    thumbnail_done
+)
+
+
+def ocr_done(filename:str, result:Optional[dict]):
+    if not result:
+        return
+    words = {key: result[key] for key in ('width', 'height', 'words')}
+    scans_catalog().set_text(filename, result['mtime'], result['size'], result['text'], words)
+
+
+ocr_pool = OcrPool(
+    settings.OCR_WORKERS,
+    settings.THUMBNAIL_QUEUE_SIZE,
+    ocr_done
+)
+
+
+# Text of images is recognized in background at idle priority
+def queue_ocr(filename:str, priority:int=thumbnails.NEW) -> bool:
+    if not settings.OCR or Path(filename).suffix in ['.pdf']:
+        return False
+    return ocr_pool.submit(
+        filename,
+        (str(scan_path(filename)), settings.OCR_LANGUAGES),
+        priority
+    )
+
+
+# Words for the text layer of a pdf page. Pages not recognized
+# in background yet are recognized by the pdf job.
+def pdf_page_words(path:Path) -> Optional[dict]:
+    if not settings.OCR:
+        return None
+    text = scans_catalog().get_text(scan_name(path))
+    if text is not None:
+        return text[1]
+    try:
+        result = recognize(str(path), settings.OCR_LANGUAGES)
+    except (OcrError, OSError) as ex:
+        logger.warning(f'Problem with recognizing text of {scan_name(path)}: {ex}')
+        return None
+    ocr_done(scan_name(path), result)
+    return result
+
+
+# `refresh` when the file content changed (renders it again if it is being rendered)
+def queue_thumbnail(filename:str, priority:int=thumbnails.NEW, refresh:bool=False) -> bool:
+    # listings request pending thumbnails again, skip looking the file up then
+    if not refresh and thumbnail_pool.queued(filename, priority):
+        return True
+    return thumbnail_pool.submit(
+        filename,
+        (
+            str(scan_path(filename)),
+            settings.SCANS_FOLDER,
+            filename,
+            settings.RENDITION_SIZES,
+            settings.RENDITION_FORMAT,
+            storage().shard(filename)
+        ),
+        priority,
+        refresh
+    )
+
+
+def remove_thumbnails(filename:str):
+    for thumbnail in scan_thumbnail_files(filename):
+        (Path(settings.SCANS_FOLDER) / thumbnail).unlink(missing_ok=True)
+
+
+# Adds (or updates) file in the catalog, thumbnails of images are
+# generated in background (catalog thumbnail is None until ready),
+# unless the same content (digest) has them already
+def register_file(filename:str, refresh_thumbnail:bool=False, priority:int=thumbnails.NEW, digest:Optional[str]=None):
+    thumbnail = ''
+    if Path(filename).suffix not in ['.pdf']:
+        thumbnail_path = Path(settings.SCANS_FOLDER) / scan_thumbnail(filename)
+        if refresh_thumbnail:
+            remove_thumbnails(filename)
+        files = scan_thumbnail_files(filename)
+        if thumbnail_path.exists():
+            thumbnail = scan_thumbnail(filename)
+        elif digest and blob_store().link_thumbnails(digest, filename, files):
+            thumbnail = scan_thumbnail(filename)
+        else:
+            thumbnail = None
+    item = scans_catalog().add(filename, thumbnail, digest)
+    if item and thumbnail is None:
+        queue_thumbnail(filename, priority, refresh_thumbnail)
+    if item:
+        queue_ocr(filename, priority)
+
+
+# Registers files found in the folder (not added through the API)
+def register_found(filenames:List[str]):
     for filename in filenames:
-        if Path(filename).suffix in ['.pdf']:
-            thumbnails.append('')
+        try:
+            digest = store_content(scan_path(filename))
+        except OSError as ex:
+            logger.warning(f'Problem with storing {filename}: {ex}')
+            digest = None
+        register_file(filename, priority=thumbnails.BACKGROUND, digest=digest)
+
+
+# Thumbnails made before STORAGE_SHARDS was changed are moved
+# to the thumbs shard of their scan
+def place_thumbnails():
+    catalog = scans_catalog()
+    for filename, thumbnail in catalog.thumbnails():
+        if thumbnail == scan_thumbnail(filename):
             continue
-        thumb_filename = f'thumbs/{filename}.thumb.jpg'
-        thumb_filename_path = Path(settings.SCANS_FOLDER) / thumb_filename
-        if not thumb_filename_path.exists():
-            thumb_filename_path.parent.mkdir(parents=True, exist_ok=True)
-            try:
-                from PIL import Image, ImageFile
-                ImageFile.LOAD_TRUNCATED_IMAGES = True
-                im = Image.open(Path(settings.SCANS_FOLDER) / filename)
-                im.thumbnail((128, 128))
-                im.save(thumb_filename_path, "JPEG")
-            except Exception as ex:
-                print(f'Problem with generating thumbnail for {filename}')
-                print(ex)
-                thumb_filename = filename # cannot create thumbnail, use original
-        thumbnails.append(thumb_filename)
+        folder = PurePosixPath(thumbnail).parent
+        shard = str(folder.relative_to('thumbs')) if folder != PurePosixPath('thumbs') else ''
+        previous = thumbnail_files(filename, settings.RENDITION_SIZES, settings.RENDITION_FORMAT, shard)
+        for source, target in zip(previous, scan_thumbnail_files(filename)):
+            source, target = Path(settings.SCANS_FOLDER) / source, Path(settings.SCANS_FOLDER) / target
+            if source.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(source, target)
+        moved = (Path(settings.SCANS_FOLDER) / scan_thumbnail(filename)).exists()
+        catalog.set_thumbnail(filename, scan_thumbnail(filename) if moved else None) # None is generated again
+
+
+# With several workers one of them reconciles, the others skip it instead of
+# finding the same files and queueing the same thumbnails (the lock is shared
+# with storage maintenance, which moves the files)
+def reconcile_catalog():
+    try:
+        with locks().lock('storage', blocking=False):
+            storage().place_all(LISTED_SUFFIXES) # before the paths are used by thumbnail jobs
+            catalog = scans_catalog()
+            register_found(catalog.reconcile())
+            place_thumbnails()
+            for filename in catalog.pending_thumbnails():
+                queue_thumbnail(filename, thumbnails.BACKGROUND)
+            if settings.OCR:
+                for filename in catalog.pending_texts():
+                    queue_ocr(filename, thumbnails.BACKGROUND)
+    except LockBusy:
+        logger.debug('Catalog is reconciled by another worker')
+
+
+# Replaces old color PNG/TIFF scan with lossless WebP stored under the same
+# name (see Storage), keeps its thumbnails, metadata and text. Returns False
+# when the scan is not compressed.
+def compress_scan(filename:str) -> bool:
+    catalog = scans_catalog()
+    with locks().striped('files', filename):
+        source = scan_path(filename)
+        item = catalog.get(filename)
+        if item is None or source.name != filename or not source.is_file():
+            return False # compressed already
+        try:
+            target = compress(source)
+        except NotCompressible as ex:
+            logger.debug(f'Not compressed: {ex}')
+            return False
+        text = catalog.get_text(filename)
+        # the previous blob is released by store_content only when no file links to it
+        source.unlink()
+        digest = store_content(target)
+        item = catalog.add(filename, item.thumbnail, digest)
+        if item is not None and text is not None:
+            catalog.set_text(filename, item.mtime, item.size, *text)
+        if digest and item is not None and item.thumbnail:
+            blob_store().keep_thumbnails(digest, filename, scan_thumbnail_files(filename))
+    logger.info(f'Compressed {filename}')
+    return True
+
+
+def archive_scan(filename:str) -> bool:
+    with locks().striped('files', filename):
+        archived = storage().move_to_archive(filename)
+        # content copied to another file system is not a link to its blob any more
+        digest = scans_catalog().hash_of(filename)
+        if archived is not None and digest:
+            blob_store().release(digest)
+    return archived is not None
+
 
-    return schemas.ScanList(
+# Catalog items older than `days` of given formats (all when None), oldest first
+def scans_older_than(days:float, formats:Optional[List[str]]=None):
+    cursor = None
+    until = time.time() - days * 24 * 3600
+    while True:
+        items, _, cursor = scans_catalog().query(500, cursor, sort='oldest', formats=formats, until=until)
+        yield from items
+        if cursor is None:
+            return
+
+
+# Moves scans to their shards, recompresses old lossless ones (COMPRESS_AGE)
+# and moves old ones to ARCHIVE_FOLDER (ARCHIVE_AGE), by one worker at a time
+def maintain_storage():
+    try:
+        with locks().lock('storage', blocking=False):
+            placed = storage().place_all(LISTED_SUFFIXES)
+            # files copied into the scans folder while the server runs
+            register_found(scans_catalog().reconcile(placed))
+            compressed = archived = 0
+            if settings.COMPRESS_AGE > 0:
+                formats = [suffix.lstrip('.') for suffix in LOSSLESS_SUFFIXES]
+                for item in list(scans_older_than(settings.COMPRESS_AGE, formats)):
+                    try:
+                        compressed += compress_scan(item.filename)
+                    except OSError as ex:
+                        logger.warning(f'Problem with compressing {item.filename}: {ex}')
+            if settings.ARCHIVE_FOLDER and settings.ARCHIVE_AGE > 0:
+                for item in list(scans_older_than(settings.ARCHIVE_AGE)):
+                    try:
+                        archived += archive_scan(item.filename)
+                    except OSError as ex:
+                        logger.warning(f'Problem with archiving {item.filename}: {ex}')
+            if placed or compressed or archived:
+                logger.info(f'Storage: {len(placed)} moved to shards, {compressed} compressed, {archived} archived')
+    except LockBusy:
+        logger.debug('Storage is maintained by another worker')
+
+
+def maintain_storage_forever():
+    background_priority()
+    reconcile_catalog()
+    while True:
+        try:
+            maintain_storage()
+        except Exception as ex:
+            logger.warning(f'Problem with storage maintenance: {ex}')
+        time.sleep(settings.STORAGE_INTERVAL)
+
+
+Gauge('swis_queue_depth', 'Requests waiting in queue', ('queue',), lambda: {
+    ('scan',): scan_queue.depth(),
+    ('pdf',): pdf_queue.depth(),
+    ('thumbnails',): thumbnail_pool.depth(),
+    ('ocr',): ocr_pool.depth(),
+    ('print',): sum(1 for job in print_queue.list() if job.active),
+})
+Gauge('swis_executor_in_flight', 'Calls submitted to executor and not finished', ('executor',), lambda: {
+    (file_executor.name,): file_executor.in_flight,
+    (image_executor.name,): image_executor.in_flight,
+    (catalog_executor.name,): catalog_executor.in_flight,
+})
+Gauge('swis_catalog_files', 'Files in the catalog', ('format',), lambda: {
+    (fmt,): count for fmt, (count, _) in scans_catalog().stats().items()
+}, aggregated=False)
+Gauge('swis_catalog_bytes', 'Size of files in the catalog', ('format',), lambda: {
+    (fmt,): size for fmt, (_, size) in scans_catalog().stats().items()
+}, aggregated=False)
+
+
+# Metrics in Prometheus text format. With several workers the values of
+# all of them are added up (the others' as of their last sync_jobs pass).
+def metrics_text() -> str:
+    store = job_store()
+    others = store.metrics() if store is not None else []
+    return render_metrics(others)
+
+
+@app.get('/metrics')
+async def endpoint_metrics_get():
+    return Response(await file_executor.run(metrics_text), media_type='text/plain; version=0.0.4')
+
+
+@app.on_event('startup')
+def startup():
+    if settings.OCR and shutil.which('tesseract') is None:
+        logger.warning('OCR is enabled, but tesseract is not installed')
+        settings.OCR = False
+    # files are moved only after the catalog has found them
+    threading.Thread(target=maintain_storage_forever, name='swis-storage', daemon=True).start()
+    device_registry.start_refresher()
+    print_queue.start_poller(settings.PRINT_POLL_INTERVAL)
+    upload_sessions().start_collector(settings.UPLOAD_SESSION_TTL / 10)
+    if job_store() is not None:
+        threading.Thread(target=sync_jobs, name='swis-jobs', daemon=True).start()
+
+
+@app.on_event('shutdown')
+def shutdown():
+    thumbnail_pool.shutdown()
+    ocr_pool.shutdown()
+    file_executor.shutdown()
+    image_executor.shutdown()
+    catalog_executor.shutdown()
+
+
+def scan_list_item(item:CatalogItem) -> schemas.ScanListItem:
+    pending = item.thumbnail is None
+    if pending:
+        queue_thumbnail(item.filename, thumbnails.VIEWED)
+    renditions = {}
+    if item.thumbnail == scan_thumbnail(item.filename):
+        address = f'/scans/{quote(item.filename)}/renditions'
+        version = rendition_version(item.mtime, item.size)
+        renditions = {
+            str(size): f'{address}/{size}?v={version}'
+            for size in settings.RENDITION_SIZES
+        }
+    # catalog values have the schema types, listings skip validating them
+    return schemas.ScanListItem.construct(
+        filename=item.filename, 
+        thumbnail=item.thumbnail or '',
+        thumbnail_pending=pending,
+        renditions=renditions,
+        mtime=item.mtime,
+        size=item.size,
+        format=item.format,
+        width=item.width,
+        height=item.height
+    )
+
+
+def list_scans(
+    limit:int,
+    cursor:Optional[str],
+    sort:str,
+    formats:Optional[List[str]],
+    since:Optional[float],
+    until:Optional[float],
+    prefix:Optional[str]
+) -> str:
+    items, total, next_cursor = scans_catalog().query(
+        limit,
+        cursor=cursor,
+        sort=sort,
+        formats=formats,
+        since=since,
+        until=until,
+        prefix=prefix
+    )
+    return schemas.ScanList.construct(
         returncode = 0,
         detail = '',
-        filenames = [
-            schemas.ScanListItem(
-                filename=filename, 
-                thumbnail=thumbnail
-            ) 
-        for filename, thumbnail in zip(filenames, thumbnails)]
+        total = total,
+        cursor = next_cursor,
+        filenames = [scan_list_item(item) for item in items]
+    ).json()
+
+
+# Listing and search are built and encoded on their own executor, so they
+# are not queued behind other requests and do not block the event loop
+@app.get('/scans')
+async def endpoint_images_get(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    sort: schemas.ScanSortEnum = schemas.ScanSortEnum.newest,
+    type: Optional[List[str]] = Query(None), # file formats, e.g. png, jpg, pdf
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    prefix: Optional[str] = None,
+):
+    try:
+        content = await catalog_executor.run(
+            list_scans,
+            limit,
+            cursor,
+            sort.value,
+            [t.lower().lstrip('.') for t in type] if type else None,
+            since.timestamp() if since else None,
+            until.timestamp() if until else None,
+            prefix
+        )
+    except InvalidCursor as ex:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(ex)
+        )
+    return Response(content, media_type='application/json')
+
+
+def search_scans(q:str, limit:int, offset:int) -> str:
+    hits, total = scans_catalog().search(q, limit, offset)
+    return schemas.SearchResult(
+        returncode = 0,
+        detail = '',
+        total = total,
+        hits = [
+            schemas.SearchHit(**scan_list_item(item).dict(), snippet=snippet)
+            for item, snippet in hits
+        ]
+    ).json()
+
+
+# Full-text search in file names, original names of uploads, tags
+# and recognized text. Words are prefixes, `tags:word` searches one column.
+@app.get('/search')
+async def endpoint_search_get(
+    q: str,
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    content = await catalog_executor.run(search_scans, q, limit, offset)
+    return Response(content, media_type='application/json')
+
+
+def scan_tags(filename:str) -> schemas.ScanTags:
+    org_filename, tags = scans_catalog().get_metadata(filename)
+    return schemas.ScanTags(
+        returncode = 0,
+        detail = '',
+        filename = filename,
+        org_filename = org_filename,
+        tags = tags
     )
 
 
-@app.delete('/scans/{filename}')
-def endpoint_images_delete(
+@app.get('/scans/{filename}/tags')
+async def endpoint_image_tags_get(
+    filename: str
+):
+    if await catalog_executor.run(scans_catalog().get, filename) is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='File not found'
+        )
+    return await catalog_executor.run(scan_tags, filename)
+
+
+@app.put('/scans/{filename}/tags')
+async def endpoint_image_tags_put(
+    filename: str,
+    req: schemas.TagsRequest
+):
+    if await catalog_executor.run(scans_catalog().get, filename) is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='File not found'
+        )
+    tags = list(dict.fromkeys(tag.strip() for tag in req.tags if tag.strip()))
+    await file_executor.run(scans_catalog().set_metadata, filename, tags=tags)
+    return await catalog_executor.run(scan_tags, filename)
+
+
+@app.get('/scans/{filename}')
+async def endpoint_image_get(
+    filename: str
+):
+    item = await catalog_executor.run(scans_catalog().get, filename)
+    if item is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='File not found'
+        )
+    return await catalog_executor.run(scan_list_item, item)
+
+
+# Path of the rendition (None while it is not generated yet) and version
+# of the file, None when the file is missing
+def find_rendition(filename:str, size:int) -> Optional[Tuple[Optional[Path], str]]:
+    source = scan_path(filename)
+    if not source.is_file():
+        return None
+    st = source.stat()
+    version = rendition_version(st.st_mtime, st.st_size)
+    rendition = Path(settings.SCANS_FOLDER) / rendition_name(filename, size, settings.RENDITION_FORMAT, storage().shard(filename))
+    if not rendition.exists() or rendition.stat().st_mtime < st.st_mtime:
+        return None, version
+    return rendition, version
+
+
+# Downscaled copy of the image. Requests with current version (v) are
+# cacheable forever, other ones are revalidated with ETag.
+@app.get('/scans/{filename}/renditions/{size}')
+async def endpoint_image_rendition_get(
     request: Request,
+    filename: str,
+    size: int,
+    v: Optional[str] = None
+):
+    found = await file_executor.run(find_rendition, filename, size) if size in settings.RENDITION_SIZES else None
+    if found is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='Rendition not found'
+        )
+    rendition, version = found
+    if rendition is None:
+        # not generated yet, serve the original meanwhile
+        await file_executor.run(queue_thumbnail, filename, thumbnails.VIEWED)
+        return RedirectResponse(
+            f'{settings.SCANS_ADDRESS}/{quote(filename)}',
+            headers={'Cache-Control': 'no-store'}
+        )
+
+    etag = f'"{version}-{size}-{settings.RENDITION_FORMAT}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable' if v == version else 'no-cache',
+    }
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(rendition, media_type=f'image/{settings.RENDITION_FORMAT}', headers=headers)
+
+
+# Crops, rotates and flips the stored image and updates its renditions.
+# JPEG is transformed without decoding (jpegtran) when the crop box and
+# the image size allow it, otherwise it is encoded again with the same
+# quantization tables. Uncompressed images are read from memory-mapped file.
+def transform_scan(filename:str, req:schemas.TransformRequest) -> schemas.TransformResult:
+    # transforms of the same file (also by other worker processes) run one by one
+    with locks().striped('files', filename):
+        source = scan_path(filename)
+        partial = source.with_name(f'.{source.name}.part')
+        timer = StageTimer()
+        try:
+            with Image.open(source) as im:
+                fmt = im.format
+                if fmt not in Image.SAVE or getattr(im, 'n_frames', 1) > 1:
+                    raise TransformError(f'{fmt} images cannot be transformed')
+                box = crop_box(req, im.size)
+                if is_identity(req, box):
+                    # the file is left as it is, not re-encoded
+                    item = scans_catalog().get(filename)
+                    return schemas.TransformResult(
+                        returncode = 0,
+                        detail = 'Nothing to transform',
+                        lossless = True,
+                        timings = timer.timings,
+                        scan = scan_list_item(item) if item is not None else None
+                    )
+                commands = None
+                if fmt == 'JPEG' and shutil.which('jpegtran'):
+                    commands = jpegtran_commands(im, req, box, source, partial)
+            transformed = False
+            if commands:
+                with timer.stage('jpegtran'):
+                    for params in commands:
+                        p = _run_pocess(params)
+                        if p.returncode != 0:
+                            logger.info(f'Lossless transform of {filename} is not possible: {p.stderr.strip()}')
+                            break
+                    else:
+                        transformed = True
+            out = None
+            if not transformed:
+                with timer.stage('decode'):
+                    im = open_mapped(source, box)
+                    if im is None:
+                        im = Image.open(source)
+                        im.load()
+                    else:
+                        box = None # only the box was read
+                with timer.stage('transform'):
+                    out = apply_transform(im, req, box)
+                with timer.stage('encode'):
+                    options = save_options(im, fmt)
+                    if options.get('compression') == 'group4':
+                        options['tiffinfo'] = {278: out.height} # single strip
+                    out.save(partial, fmt, **options)
+                im.close()
+            os.replace(partial, source)
+        except OSError as ex:
+            logger.error(f'Problem with transforming {filename}: {ex}')
+            return schemas.TransformResult(returncode=1, detail=str(ex), lossless=False, timings=timer.timings)
+        finally:
+            for temporary in source.parent.glob(f'{partial.name}*'):
+                temporary.unlink(missing_ok=True)
+
+        digest = store_content(source)
+        with timer.stage('renditions'), locks().striped('thumbnails', filename):
+            # previous ones may be linked to the stored content, so they are not overwritten
+            remove_thumbnails(filename)
+            try:
+                if out is None:
+                    with Image.open(source) as im:
+                        save_renditions(im, settings.SCANS_FOLDER, filename, settings.RENDITION_SIZES, settings.RENDITION_FORMAT, storage().shard(filename))
+                else:
+                    save_renditions(out, settings.SCANS_FOLDER, filename, settings.RENDITION_SIZES, settings.RENDITION_FORMAT, storage().shard(filename))
+                if digest is not None:
+                    blob_store().keep_thumbnails(digest, filename, scan_thumbnail_files(filename))
+            except Exception as ex:
+                logger.warning(f'Problem with generating thumbnail for {filename}: {ex}')
+        with timer.stage('register'):
+            register_file(filename, digest=digest)
+        logger.info(f'Transformed {filename} ({timer})')
+        item = scans_catalog().get(filename)
+        return schemas.TransformResult(
+            returncode = 0,
+            detail = '',
+            lossless = transformed or fmt != 'JPEG',
+            timings = timer.timings,
+            scan = scan_list_item(item) if item is not None else None
+        )
+
+
+# Crop, rotate and flip on the server, so the client sends only the crop box
+@app.post('/scans/{filename}/transform')
+async def endpoint_image_transform(
+    filename: str,
+    req: schemas.TransformRequest
+):
+    source = await file_executor.run(scan_path, filename)
+    if not await file_executor.run(source.is_file):
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='File not found'
+        )
+    try:
+        if source.suffix.lower() in ['.pdf']:
+            raise TransformError('PDF files cannot be transformed')
+        check_transform(req)
+        return await image_executor.run(transform_scan, filename, req)
+    except TransformError as ex:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(ex)
+        )
+
+
+# Text recognized in the image (pending while OCR has not processed it yet)
+@app.get('/scans/{filename}/text')
+async def endpoint_image_text_get(
     filename: str
 ):
-    target_filepath = Path(settings.SCANS_FOLDER) / filename
+    if await catalog_executor.run(scans_catalog().get, filename) is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='File not found'
+        )
+    text = await catalog_executor.run(scans_catalog().get_text, filename)
+    return schemas.ScanText(
+        returncode = 0,
+        detail = '' if settings.OCR else 'OCR is disabled',
+        filename = filename,
+        text = text[0] if text is not None else '',
+        pending = text is None and settings.OCR and Path(filename).suffix not in ['.pdf']
+    )
+
+
+def delete_scan(filename:str) -> bool:
+    target_filepath = scan_path(filename)
     if target_filepath.exists():
+        digest = scans_catalog().hash_of(filename)
         os.remove(target_filepath)
+        scans_catalog().remove(filename)
         if Path(filename).suffix in ['.pdf']:
             pass
-        elif (Path(settings.SCANS_FOLDER) / 'thumbs' / f'{filename}.thumb.jpg').exists():
-            os.remove(Path(settings.SCANS_FOLDER) / 'thumbs' / f'{filename}.thumb.jpg')
+        else:
+            remove_thumbnails(filename)
+        # content is removed with its last file
+        if digest:
+            blob_store().release(digest)
         return True
     return False
 
 
-# Endpoint for printing given image file
-@app.post('/print/execute')
-def endpoint_print_post(
-    # request: Request,
-    print_request: schemas.PrintRequest
+@app.delete('/scans/{filename}')
+async def endpoint_images_delete(
+    request: Request,
+    filename: str
 ):
+    return await file_executor.run(delete_scan, filename)
+
+
+def print_args(print_request) -> List[str]:
     args = []
     if print_request.quality in ['draft', 'normal', 'best']:
         args.append(f'-o print-quality={print_request.quality}')
@@ -415,33 +1813,197 @@ def endpoint_print_post(
         x.isdigit() for x in print_request.pages.replace(' ', '').replace(';', ',').split(',')
     ]):
         args.append(f'-P {print_request.pages}')
-    
-    target_filepath = Path(settings.SCANS_FOLDER) / print_request.filename
-    if target_filepath.exists():
-        p = run_pocess('lp', [str(target_filepath), *args])
+    return args
+
+
+def print_job_status(job: PrintJob) -> schemas.PrintJobStatus:
+    return schemas.PrintJobStatus(
+        id = job.id,
+        status = job.status,
+        cups_id = job.cups_id,
+        filenames = job.filenames,
+        created = job.created,
+        updated = job.updated,
+        detail = job.detail
+    )
+
+
+# CUPS filters do not read WebP (scans recompressed by the storage
+# maintenance), such images are printed from PNG copies in the folder
+def printable_files(paths: List[Path], folder: Path) -> List[Path]:
+    printable = []
+    for path in paths:
+        if path.suffix.lower() == COMPRESSED_SUFFIX:
+            copy = folder / f'{path.name}.png'
+            with Image.open(path) as im:
+                im.save(copy, 'PNG', compress_level=1)
+            path = copy
+        printable.append(path)
+    return printable
+
+
+# Sends files to CUPS as one job (lp with many files), unless the same
+# files with the same options were submitted a moment ago
+async def submit_print(paths: List[Path], args: List[str]) -> PrintJob:
+    job, new = await file_executor.run(print_queue.add, paths, args, [scan_name(path) for path in paths])
+    if new:
+        # lp sends the files to the spooler, the copies are not needed after it returns
+        folder = Path(await file_executor.run(tempfile.mkdtemp, '', 'swis-print-'))
+        try:
+            printable = await image_executor.run(printable_files, paths, folder)
+            p = await run_pocess_async('lp', [*map(str, printable), *args])
+        finally:
+            await file_executor.run(shutil.rmtree, folder, True)
+        print_queue.submitted(job, p)
+    else:
+        logger.info(f'Print of {job.filenames} already submitted as {job.id}')
+    await file_executor.run(publish_job, 'print', job)
+    return job
+
+
+# Endpoint for printing given image file
+@app.post('/print/execute')
+async def endpoint_print_post(
+    # request: Request,
+    print_request: schemas.PrintRequest
+):
+    target_filepath = await file_executor.run(scan_path, print_request.filename)
+    if await file_executor.run(target_filepath.exists):
+        job = await submit_print([target_filepath], print_args(print_request))
+        code = 1 if job.status == PrintJob.FAILED else 0
         return schemas.PrintResult(
-            code = p.returncode,
-            detail = p.stdout if p.returncode==0 else p.stderr,
-            filename = target_filepath.name
+            code = code,
+            detail = job.detail,
+            filename = scan_name(target_filepath),
+            job = job.id
         )
     return schemas.PrintResult(
         code = 999,
         detail = 'File not found',
-        filename = target_filepath.name
+        filename = scan_name(target_filepath)
     )
 
 
+# Prints many files with one request: as one CUPS job or a job per file
+@app.post('/print/batch')
+async def print_batch_post(
+    print_request: schemas.PrintBatchRequest
+):
+    paths = [await file_executor.run(scan_path, Path(filename).name) for filename in print_request.filenames]
+    missing = [scan_name(path) for path in paths if not await file_executor.run(path.exists)]
+    if not paths or missing:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail=f'Files not found: {missing}' if missing else 'No files to print'
+        )
+    args = print_args(print_request)
+    if print_request.separate:
+        jobs = [await submit_print([path], args) for path in paths]
+    else:
+        jobs = [await submit_print(paths, args)]
+    return schemas.PrintJobList(
+        returncode = 1 if any(job.status == PrintJob.FAILED for job in jobs) else 0,
+        detail = '',
+        jobs = [print_job_status(job) for job in jobs]
+    )
+
+
+@app.get('/print/jobs')
+async def print_jobs_get():
+    shared = await file_executor.run(shared_jobs, 'print', schemas.PrintJobStatus)
+    return schemas.PrintJobList(
+        returncode = 0,
+        detail = '',
+        jobs = [print_job_status(job) for job in print_queue.list()] + shared
+    )
+
+
+def get_print_job(job_id: str) -> PrintJob:
+    job = print_queue.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='Print job not found'
+        )
+    return job
+
+
+@app.get('/print/jobs/{job_id}')
+async def print_job_get(
+    job_id: str
+):
+    if print_queue.get(job_id) is None:
+        return await file_executor.run(shared_job, 'print', job_id, schemas.PrintJobStatus, 'Print job not found')
+    return print_job_status(get_print_job(job_id))
+
+
+@app.delete('/print/jobs/{job_id}')
+async def print_job_delete(
+    job_id: str
+):
+    if print_queue.get(job_id) is None:
+        return await file_executor.run(cancel_shared_job, 'print', job_id, schemas.PrintJobStatus, 'Print job not found')
+    job = get_print_job(job_id)
+    if not await file_executor.run(print_queue.cancel, job) and job.status != PrintJob.CANCELLED:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT,
+            detail=f'Print job cannot be cancelled ({job.status}) {job.detail}'.strip()
+        )
+    return print_job_status(job)
+
+
+# Time and number of the sequence shared by worker processes, so names never collide
 def get_image_filename(suffix:str) -> str:
-    return f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}_{random.randint(100, 999)}{suffix}'
+    return f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}_{locks().next_value("filenames")}{suffix}'
+
+
+UPLOAD_SUFFIXES = [
+    '.ico',
+    '.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi', 
+    '.png', 
+    '.gif', 
+    '.webp', 
+    '.tiff', '.tif', 
+    '.psd', 
+    '.raw', '.arw', '.cr2', '.nrw', '.k25', 
+    '.bmp', '.dib', 
+    '.heif', '.heic', 
+    '.ind', '.indd', '.indt', 
+    '.jp2', '.j2k', '.jpf', '.jpx', '.jpm', '.mj2', 
+    '.svg', '.svgz', 
+    '.ai', 
+    '.eps', 
+    '.pdf'
+]
+
+
+def check_upload_suffix(org_filename:str) -> str:
+    suffix = Path(org_filename).suffix
+    if suffix not in UPLOAD_SUFFIXES:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='This file extension is not allowed'
+        )
+    return suffix
+
+
+# Target path for uploaded file (new unique name in scans folder)
+def upload_target(suffix:str) -> Path:
+    target_folder = Path(settings.SCANS_FOLDER)
+    if not os.path.isdir(target_folder):
+        os.mkdir(target_folder)
+    filename = get_image_filename(suffix)
+    while scan_path(filename).exists():
+        filename = get_image_filename(suffix)
+    return scan_path(filename, create=True)
 
 
 @app.post('/upload')
-def upload_image(
+async def upload_image(
     request: Request,
     file: UploadFile = File(...),
 ):
-    FILE_SIZE_LIMIT = 1024 * 1024 * 100 # 100MB
-    if 'content-length' not in request.headers or int(request.headers['content-length']) > FILE_SIZE_LIMIT:
+    if 'content-length' not in request.headers or int(request.headers['content-length']) > settings.UPLOAD_SIZE_LIMIT:
         logger.error(f'{request.client.host} | {file.filename} | Content length is not provided or file is too large')
         raise HTTPException(
             # Importing status from fastapi
@@ -449,54 +2011,26 @@ def upload_image(
             detail='Content length is not provided or file is too large'
         )
 
-    suffix = Path(file.filename).suffix
-    if suffix not in [
-        '.ico',
-        '.jpg', '.jpeg', '.jpe', '.jif', '.jfif', '.jfi', 
-        '.png', 
-        '.gif', 
-        '.webp', 
-        '.tiff', '.tif', 
-        '.psd', 
-        '.raw', '.arw', '.cr2', '.nrw', '.k25', 
-        '.bmp', '.dib', 
-        '.heif', '.heic', 
-        '.ind', '.indd', '.indt', 
-        '.jp2', '.j2k', '.jpf', '.jpx', '.jpm', '.mj2', 
-        '.svg', '.svgz', 
-        '.ai', 
-        '.eps', 
-        '.pdf']:
-        raise HTTPException(
-            status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f'This file extension is not allowed'
-        )
-    filename = get_image_filename(suffix)
-    while os.path.isfile(filename):
-        filename = get_image_filename(suffix)
+    suffix = check_upload_suffix(file.filename)
     
     # Save image
-    target_folder = Path(settings.SCANS_FOLDER)
-    if not os.path.isdir(target_folder):
-        os.mkdir(target_folder)
-
-    target_filepath = target_folder / filename
-    with open(target_filepath, 'wb+') as file_object:
-        filesize = file_object.write(file.file.read())
-
-    if filesize > FILE_SIZE_LIMIT: # To nigdy nie powinno się wykonać, jedynie jak ktoś ręcznie zanizy content-length
-        logger.error(f'{request.client.host} | {file.filename} | File size is too large ({filesize})')
-        os.remove(target_filepath)
+    target_filepath = await file_executor.run(upload_target, suffix)
+    filename = target_filepath.name
+    digest = hashlib.sha256() if settings.CONTENT_STORE else None
+    try:
+        filesize = await save_upload(file.file, target_filepath, settings.UPLOAD_SIZE_LIMIT, settings.UPLOAD_CHUNK_SIZE, file_executor, digest)
+    except UploadTooLarge as ex: # To nigdy nie powinno się wykonać, jedynie jak ktoś ręcznie zanizy content-length
+        logger.error(f'{request.client.host} | {file.filename} | {ex}')
         raise HTTPException(
             status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail=f'File size is too large ({filesize})'
+            detail=str(ex)
         )
     
-    # Create thumbnail
-    if suffix in ['.pdf']:
-        pass
-    else:
-        create_thumbnail(filename)
+    record_upload(request, 'upload', filesize)
+    # Create thumbnail and add to catalog
+    digest = await file_executor.run(store_content, target_filepath, digest and digest.hexdigest())
+    await file_executor.run(register_file, filename, digest=digest)
+    await file_executor.run(scans_catalog().set_metadata, filename, file.filename)
 
 
     return schemas.ImageUploadResult(
@@ -508,6 +2042,133 @@ def upload_image(
     )
 
 
+# Uploaded bytes and throughput since the request started (MetricsMiddleware)
+def record_upload(request: Request, kind: str, size: int):
+    UPLOAD_BYTES.inc(size, kind)
+    started = getattr(request.state, 'started', None)
+    if started is not None and size:
+        UPLOAD_THROUGHPUT.observe(size / max(time.perf_counter() - started, 1e-6), kind)
+
+
+# Resumable upload: create session, PUT chunks (in any order, retried when
+# needed), check which chunks are missing and finalize
+def upload_sessions() -> UploadSessions:
+    return get_upload_sessions(str(Path(settings.SCANS_FOLDER) / '.uploads'), settings.UPLOAD_SESSION_TTL)
+
+
+def upload_session_status(session: UploadSession) -> schemas.UploadSessionStatus:
+    return schemas.UploadSessionStatus(
+        id = session.id,
+        filename = session.filename,
+        size = session.size,
+        chunk_size = session.chunk_size,
+        chunks = session.chunks,
+        received = sorted(session.received),
+        missing = session.missing,
+        expires = session.updated + settings.UPLOAD_SESSION_TTL
+    )
+
+
+def get_upload_session(session_id: str) -> UploadSession:
+    try:
+        return upload_sessions().get(session_id)
+    except UploadSessionNotFound:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='Upload session not found'
+        )
+
+
+@app.post('/upload/sessions')
+async def upload_session_create(
+    req: schemas.UploadSessionRequest
+):
+    check_upload_suffix(req.filename)
+    if req.size > settings.UPLOAD_SIZE_LIMIT:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'File size is too large ({req.size})'
+        )
+    session = await file_executor.run(upload_sessions().create, req.filename, req.size, settings.UPLOAD_SESSION_CHUNK_SIZE, req.sha256)
+    logger.info(f'Upload session {session.id} created ({req.filename}, {req.size} bytes)')
+    return upload_session_status(session)
+
+
+@app.get('/upload/sessions/{session_id}')
+async def upload_session_get(
+    session_id: str
+):
+    return upload_session_status(await file_executor.run(get_upload_session, session_id))
+
+
+# Chunk is sent as raw body, optional X-Chunk-SHA256 header holds its checksum
+@app.put('/upload/sessions/{session_id}/chunks/{index}')
+async def upload_session_chunk_put(
+    request: Request,
+    session_id: str,
+    index: int,
+    x_chunk_sha256: Optional[str] = Header(None)
+):
+    await file_executor.run(get_upload_session, session_id)
+    data = await request.body()
+    try:
+        session = await file_executor.run(upload_sessions().write_chunk, session_id, index, data, x_chunk_sha256)
+    except UploadSessionNotFound:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='Upload session not found'
+        )
+    except UploadChunkError as ex:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(ex)
+        )
+    record_upload(request, 'chunk', len(data))
+    return upload_session_status(session)
+
+
+@app.post('/upload/sessions/{session_id}/finalize')
+async def upload_session_finalize(
+    session_id: str
+):
+    session = await file_executor.run(get_upload_session, session_id)
+    target_filepath = await file_executor.run(upload_target, Path(session.filename).suffix)
+    try:
+        await file_executor.run(upload_sessions().finalize, session_id, target_filepath)
+    except UploadSessionNotFound:
+        raise HTTPException(
+            status.HTTP_404_NOT_FOUND,
+            detail='Upload session not found'
+        )
+    except UploadChunkError as ex:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(ex)
+        )
+
+    # Create thumbnail and add to catalog
+    digest = await file_executor.run(store_content, target_filepath, session.sha256)
+    await file_executor.run(register_file, target_filepath.name, digest=digest)
+    await file_executor.run(scans_catalog().set_metadata, target_filepath.name, session.filename)
+
+    return schemas.ImageUploadResult(
+        filename = target_filepath.name,
+        filesize = session.size,
+        org_filename = session.filename,
+        returncode = 0,
+        detail = 'OK'
+    )
+
+
+@app.delete('/upload/sessions/{session_id}')
+async def upload_session_delete(
+    session_id: str
+):
+    await file_executor.run(get_upload_session, session_id)
+    await file_executor.run(upload_sessions().remove, session_id)
+    return True
+
+
 def write_conf(settings:Settings):
     front_config = {
         'COMMENT': '!!!DO NOT EDIT MANUALLY!!!',
@@ -530,6 +2191,7 @@ def main():
     parser.add_argument('-d', '--destination', dest='destination', type=str, default='scans', help='destination for scanned documents')
     parser.add_argument('-u', '--user', dest='user', type=str, default=None, help='user (default: current)')
     parser.add_argument('-g', '--group', dest='group', type=str, default=None, help='group (default: current)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=None, help='server processes (share jobs and locks)')
     parser.add_argument('--nocfg', default=False, action=argparse.BooleanOptionalAction, help='Do not replace front config (for dev purposes)')
 
     subparsers = parser.add_subparsers(help='Option', dest='option', required=False)
@@ -559,8 +2221,22 @@ def main():
     if args.group:
         settings.GROUP = args.group
 
+    if args.workers:
+        settings.WORKERS = args.workers
+
     settings.APP_FOLDER = f'{settings.ROOT_FOLDER}/{settings.APP_FOLDER}'
 
+    LOGGING_CONFIG['formatters']['default']['fmt'] = '%(levelprefix)s %(asctime)s [%(filename)s:%(lineno)d] %(message)s'
+    LOGGING_CONFIG['formatters']['access']['fmt']  = '%(levelprefix)s %(asctime)s (%(client_addr)s) [%(name)s] %(message)s'
+    for logger_ in LOGGING_CONFIG['loggers']:
+        LOGGING_CONFIG['loggers'][logger_]['level'] = settings.LOG_LEVEL
+    for formatter in LOGGING_CONFIG['formatters']:
+        LOGGING_CONFIG['formatters'][formatter]['datefmt'] = '%Y-%m-%d %H:%M:%S'
+
+    if args.option == 'service':
+        # output of systemctl is logged (uvicorn configures logging of the server itself)
+        logging.config.dictConfig(LOGGING_CONFIG)
+
     if args.option == 'service' and args.action == 'install':
         write_conf(settings)
         if service_install(
@@ -596,35 +2272,41 @@ def main():
         ):
             sys.exit(0)
 
-    LOGGING_CONFIG['formatters']['default']['fmt'] = '%(levelprefix)s %(asctime)s [%(filename)s:%(lineno)d] %(message)s'
-    LOGGING_CONFIG['formatters']['access']['fmt']  = '%(levelprefix)s %(asctime)s (%(client_addr)s) [%(name)s] %(message)s'
-    for logger_ in LOGGING_CONFIG['loggers']:
-        LOGGING_CONFIG['loggers'][logger_]['level'] = settings.LOG_LEVEL
-    for formatter in LOGGING_CONFIG['formatters']:
-        LOGGING_CONFIG['formatters'][formatter]['datefmt'] = '%Y-%m-%d %H:%M:%S'
-
-    origins = [
-        f'http://{settings.IP_ADDRESS}:{settings.PORT}',
-        # The below entries can be removed (if not used on server)
-        f'http://127.0.0.1:{settings.PORT}',
-        f'http://localhost:{settings.PORT}',
-        # The below can be removed (only for debug/dev purpose)
-        f'http://127.0.0.1:8080',
-        f'http://localhost:8080'
-    ]
-
-    add_cors_middleware(app, origins)
-    mount_folders(app, settings)
     if not args.nocfg:
         write_conf(settings)
-    
-    uvicorn.run(
-        app, 
-        host='0.0.0.0',
-        port=int(settings.PORT),
-        access_log=True,
-        use_colors=True
-    )
+
+    if settings.WORKERS > 1:
+        # worker processes import the app and read the settings from environment
+        os.environ.update({
+            'IP_ADDRESS': settings.IP_ADDRESS,
+            'PORT': settings.PORT,
+            'SCANS_FOLDER': settings.SCANS_FOLDER,
+            'APP_FOLDER': str(Path(settings.APP_FOLDER).absolute()),
+            'LOG_LEVEL': settings.LOG_LEVEL,
+            'WORKERS': str(settings.WORKERS),
+        })
+        if settings.USER:
+            os.environ['USER'] = settings.USER
+        if settings.GROUP:
+            os.environ['GROUP'] = settings.GROUP
+        create_folder(settings.SCANS_FOLDER, settings.USER, settings.GROUP)
+        uvicorn.run(
+            'swis.swis:create_app',
+            factory=True,
+            workers=settings.WORKERS,
+            host='0.0.0.0',
+            port=int(settings.PORT),
+            access_log=True,
+            use_colors=True
+        )
+    else:
+        uvicorn.run(
+            configure_app(app, settings),
+            host='0.0.0.0',
+            port=int(settings.PORT),
+            access_log=True,
+            use_colors=True
+        )
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import swis.swis as swis
+from swis.core.catalog import Catalog, search_expression
+
+
+@pytest.fixture
+def scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'STORAGE_SHARDS', True)
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    return tmp_path
+
+
+# File copied into the scans folder while the server runs is moved to its
+# shard and listed after the next maintenance pass (not the next restart)
+def test_maintenance_registers_copied_files(scans):
+    Image.new('RGB', (40, 30)).save(scans / '20240101-000000_1.png')
+
+    swis.maintain_storage()
+
+    assert (scans / '2024' / '01' / '20240101-000000_1.png').is_file()
+    item = swis.scans_catalog().get('20240101-000000_1.png')
+    assert item is not None and (item.width, item.height) == (40, 30)
+
+
+# Pages follow each other without gaps or repeats, also for equal sort keys
+# (filename breaks the tie)
+def test_scans_cursor_pagination(scans):
+    for index in range(7):
+        path = scans / f'20240101-000000_{index}.png'
+        Image.new('RGB', (4, 4)).save(path)
+        os.utime(path, (1700000000 + index // 3, 1700000000 + index // 3))
+        swis.scans_catalog().add(path.name)
+    client = TestClient(swis.app)
+
+    filenames, cursor = [], None
+    while True:
+        page = client.get('/scans', params={'limit': 3, 'sort': 'oldest', **({'cursor': cursor} if cursor else {})}).json()
+        assert page['total'] == (None if cursor else 7) # counted for the first page only
+        filenames += [item['filename'] for item in page['filenames']]
+        cursor = page['cursor']
+        if cursor is None:
+            break
+
+    assert filenames == [f'20240101-000000_{index}.png' for index in range(7)]
+
+
+def test_scans_invalid_cursor(scans):
+    response = TestClient(swis.app).get('/scans', params={'cursor': 'not-a-cursor'})
+    assert response.status_code == 422
+    assert 'not-a-cursor' in response.json()['detail']
+
+
+@pytest.mark.parametrize('query, expression', [
+    ('invoice', '"invoice"*'),
+    ('Invoice  2024', '"Invoice"* AND "2024"*'),
+    ('tags:tax', 'tags : "tax"*'),
+    ('tags:tax-2024', 'tags : "tax"* AND tags : "2024"*'),
+    ('author:smith', '"author"* AND "smith"*'), # not a column
+    ('"a" OR b*', '"a"* AND "OR"* AND "b"*'), # FTS syntax is not passed through
+    ('- ; *', ''),
+])
+def test_search_expression(query, expression):
+    assert search_expression(query) == expression
+
+
+# Words are found in the original name, tags and recognized text (of the
+# current file content), best matches (of the name and tags) first
+def test_search(scans):
+    for index in range(3):
+        Image.new('RGB', (4, 4)).save(scans / f'20240101-000000_{index}.png')
+        swis.scans_catalog().add(f'20240101-000000_{index}.png')
+    catalog = swis.scans_catalog()
+    catalog.set_metadata('20240101-000000_0.png', 'invoice-march.pdf')
+    catalog.set_metadata('20240101-000000_1.png', tags=['tax', 'invoices'])
+    item = catalog.get('20240101-000000_2.png')
+    catalog.set_text(item.filename, item.mtime, item.size, 'Invoice no. 7 for the march rent', {})
+    client = TestClient(swis.app)
+
+    result = client.get('/search', params={'q': 'invoice'}).json()
+    assert result['total'] == 3
+    assert result['hits'][-1]['filename'] == '20240101-000000_2.png'
+    assert '[Invoice]' in result['hits'][-1]['snippet']
+
+    result = client.get('/search', params={'q': 'tags:invoice'}).json()
+    assert [hit['filename'] for hit in result['hits']] == ['20240101-000000_1.png']
+    result = client.get('/search', params={'q': 'march inv'}).json()
+    assert sorted(hit['filename'] for hit in result['hits']) == ['20240101-000000_0.png', '20240101-000000_2.png']
+    assert client.get('/search', params={'q': '*'}).json()['total'] == 0
+
+    # text of the previous file content is not searched
+    Image.new('RGB', (8, 8)).save(scans / item.filename)
+    os.utime(scans / item.filename, (item.mtime + 10, item.mtime + 10))
+    catalog.add(item.filename)
+    assert client.get('/search', params={'q': 'rent'}).json()['total'] == 0
+    assert client.get('/search', params={'q': '20240101 000000_2'}).json()['total'] == 1
+
+
+# Index of older catalog (text of any file content) is rebuilt
+def test_search_index_is_rebuilt(scans):
+    filename = '20240101-000000_1.png'
+    Image.new('RGB', (4, 4)).save(scans / filename)
+    catalog = Catalog(str(scans))
+    item = catalog.add(filename)
+    catalog.set_text(filename, item.mtime - 1, item.size, 'stale', {})
+    catalog._execute('PRAGMA user_version = 0')
+    catalog._execute('DELETE FROM search')
+    catalog._execute("INSERT INTO search (rowid, filename, text) SELECT rowid, filename, 'stale' FROM scans")
+
+    assert Catalog(str(scans)).search('stale', 10) == ([], 0)
@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+import swis.swis as swis
+from swis.core import schemas
+from swis.core.blobs import hash_file
+
+
+@pytest.fixture
+def content_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'CONTENT_STORE', True)
+    return tmp_path
+
+
+# Every scan format is saved, hashed and linked to its blob
+@pytest.mark.parametrize('fmt, suffix', [('png', 'png'), ('jpeg', 'jpg'), ('tiff', 'tif'), ('pdf', 'pdf')])
+def test_save_scan_with_content_store(content_store, fmt, suffix):
+    req = schemas.ScanRequest(mode='Color', resolution='150', format=fmt)
+    target = swis.scan_path(f'20240101-000000_1.{suffix}', create=True)
+    img = Image.effect_noise((120, 160), 40).convert('RGB')
+
+    digest = swis.save_scan(img, req, target)
+    assert digest == hash_file(target)
+
+    assert swis.store_content(target, digest) == digest
+    blob = swis.blob_store().blob_path(digest)
+    assert blob.exists() and target.samefile(blob)
+    assert hash_file(blob) == digest
+    assert not list(Path(target.parent).glob('.*.part'))
+
+
+# Recompressed scan is linked to the blob of the WebP file, the blob of
+# the original PNG is removed with its last file
+def test_compress_scan_releases_original_blob(content_store):
+    filename = '20240101-000000_1.png'
+    target = swis.scan_path(filename, create=True)
+    Image.effect_noise((120, 160), 40).convert('RGB').save(target)
+    original = swis.store_content(target)
+    swis.scans_catalog().add(filename, None, original)
+
+    assert swis.compress_scan(filename)
+
+    compressed = swis.scan_path(filename)
+    digest = swis.scans_catalog().hash_of(filename)
+    assert compressed.name == f'{filename}.webp' and digest == hash_file(compressed)
+    blobs = [path.name for path in (content_store / '.blobs').glob('??/*')]
+    assert blobs == [digest]
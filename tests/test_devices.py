@@ -0,0 +1,162 @@
+import pytest
+
+from swis.core.devices import DEVICES_FILENAME, Device, DeviceRegistry, parse_device_list, parse_options
+from swis.core.locks import Locks
+from swis.core.schemas import ProcessResult
+
+DEVICE_LIST = (
+    'epson2:libusb:001:004\tEpson\tGT-S55\tflatbed scanner\n'
+    'net:192.168.1.5:fujitsu:fi-7160:1234\tFUJITSU\tfi-7160\tsheetfed scanner\n'
+    'broken line\n'
+)
+
+# scanimage -A of a flatbed (resolution list) and a feeder scanner (range)
+FLATBED_OPTIONS = '''All options specific to device `epson2:libusb:001:004':
+  Scan Mode:
+    --mode Lineart|Gray|Color [Lineart]
+        Selects the scan mode (e.g., lineart, monochrome, or color).
+    --resolution 75|150|300|600|1200dpi [75]
+        Sets the resolution of the scanned image.
+    --source Flatbed|Automatic Document Feeder [Flatbed]
+        Selects the scan source.
+  Geometry:
+    -l 0..215.9mm [0]
+        Top-left x position of scan area.
+    -x 0..215.9mm [215.9]
+        Width of scan-area.
+    -y 0..297.18mm [297.18]
+        Height of scan-area.
+'''
+FEEDER_OPTIONS = '''All options specific to device `net:192.168.1.5:fujitsu:fi-7160:1234':
+    --source ADF Front|ADF Back|ADF Duplex [ADF Front]
+    --mode Lineart|Halftone|Gray|Color [Lineart]
+    --resolution 50..600dpi (in steps of 1) [600]
+    -x 0..224.846mm (in steps of 0.0211639) [215.872]
+    -y 0..863.489mm (in steps of 0.0211639) [279.364]
+'''
+
+
+def test_parse_device_list():
+    devices = parse_device_list(DEVICE_LIST)
+    assert [(d.name, d.vendor, d.model, d.type) for d in devices] == [
+        ('epson2:libusb:001:004', 'Epson', 'GT-S55', 'flatbed scanner'),
+        ('net:192.168.1.5:fujitsu:fi-7160:1234', 'FUJITSU', 'fi-7160', 'sheetfed scanner'),
+    ]
+
+
+def test_parse_options():
+    flatbed, feeder = Device('flatbed'), Device('feeder')
+    parse_options(flatbed, FLATBED_OPTIONS)
+    parse_options(feeder, FEEDER_OPTIONS)
+
+    assert flatbed.modes == ['Lineart', 'Gray', 'Color']
+    assert flatbed.resolutions == [75, 150, 300, 600, 1200] and flatbed.resolution_range is None
+    assert flatbed.sources == ['Flatbed', 'Automatic Document Feeder']
+    assert (flatbed.width, flatbed.height) == (215.9, 297.18)
+    assert flatbed.feeder_source(False) == 'Automatic Document Feeder' and flatbed.feeder_source(True) is None
+
+    assert feeder.resolution_range == (50.0, 600.0) and feeder.resolutions == []
+    assert (feeder.width, feeder.height) == (224.846, 863.489)
+    assert feeder.feeder_source(True) == 'ADF Duplex' and feeder.feeder_source(False) == 'ADF Front'
+    assert feeder.options_loaded
+
+
+@pytest.mark.parametrize('mode, resolution, source, problem', [
+    ('color', '300', None, None),
+    ('Color', '301', None, 'Resolution 301 is not supported'),
+    ('Color', 'high', None, 'Invalid resolution high'),
+    ('Infrared', '300', None, 'Mode Infrared is not supported'),
+    ('Color', '300', 'ADF Duplex', 'Source ADF Duplex is not supported'),
+])
+def test_check(mode, resolution, source, problem):
+    device = Device('flatbed')
+    parse_options(device, FLATBED_OPTIONS)
+    result = device.check(mode, resolution, source)
+    assert result == problem if problem is None else result.startswith(problem)
+
+
+# Answers scanimage calls with the outputs above and records them
+class FakeScanimage:
+    def __init__(self):
+        self.calls = []
+        self.returncode = 0
+
+    def __call__(self, params:list) -> ProcessResult:
+        self.calls.append(params)
+        if self.returncode:
+            return ProcessResult(returncode=self.returncode, stdout='', stderr='no SANE')
+        if params[1].startswith('--formatted-device-list'):
+            return ProcessResult(returncode=0, stdout=DEVICE_LIST, stderr='')
+        options = FLATBED_OPTIONS if params[2].startswith('epson2') else FEEDER_OPTIONS
+        return ProcessResult(returncode=0, stdout=options, stderr='')
+
+
+@pytest.fixture
+def registry_of(tmp_path):
+    locks = Locks(str(tmp_path / '.locks'))
+    def registry_of(run, ttl=60.0):
+        return DeviceRegistry(run, ttl, lambda: locks, lambda: tmp_path / DEVICES_FILENAME)
+    return registry_of
+
+
+def test_refresh(tmp_path, registry_of):
+    run = FakeScanimage()
+    registry = registry_of(run)
+
+    registry.refresh()
+
+    assert [device.name for device in registry.list()] == ['epson2:libusb:001:004', 'net:192.168.1.5:fujitsu:fi-7160:1234']
+    assert registry.default().name == 'epson2:libusb:001:004'
+    assert registry.get('net:192.168.1.5:fujitsu:fi-7160:1234').resolution_range == (50.0, 600.0)
+    assert registry.error is None and len(run.calls) == 3
+    assert (tmp_path / DEVICES_FILENAME).is_file()
+
+
+# Fresh discovery of another worker process (shared file) is used, not repeated
+def test_refresh_uses_shared_result(registry_of):
+    run = FakeScanimage()
+    registry_of(run).refresh()
+    other_run = FakeScanimage()
+    other = registry_of(other_run)
+
+    other.refresh()
+    assert other_run.calls == []
+    assert other.get('epson2:libusb:001:004').resolutions == [75, 150, 300, 600, 1200]
+
+    other.refresh(force=True)
+    assert len(other_run.calls) == 3
+
+
+def test_refresh_after_ttl(registry_of):
+    run = FakeScanimage()
+    registry = registry_of(run, ttl=0)
+    registry.refresh()
+    registry.refresh()
+    assert len(run.calls) == 6
+
+
+# Options of a scanning device are not read, the last known ones are kept
+def test_refresh_skips_scanning_device(tmp_path, registry_of):
+    run = FakeScanimage()
+    registry = registry_of(run)
+    registry.refresh()
+    locks = Locks(str(tmp_path / '.locks'))
+
+    with locks.lock('device-epson2:libusb:001:004'):
+        registry.refresh(force=True)
+
+    assert ['scanimage', '-d', 'epson2:libusb:001:004', '--all-options'] not in run.calls[3:]
+    assert registry.get('epson2:libusb:001:004').modes == ['Lineart', 'Gray', 'Color']
+
+
+# Failed discovery is reported, known devices are kept
+def test_refresh_error(registry_of):
+    run = FakeScanimage()
+    registry = registry_of(run)
+    registry.refresh()
+    run.returncode = 1
+
+    registry.refresh(force=True)
+
+    assert registry.error == 'no SANE'
+    assert len(registry.list()) == 2
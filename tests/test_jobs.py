@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from swis.core.jobs import Job, JobQueue
+
+
+def wait_finished(*jobs:Job):
+    deadline = time.monotonic() + 10
+    while not all(job.finished_or_failed for job in jobs) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert all(job.finished_or_failed for job in jobs)
+
+
+# Records the order in which jobs start and finish; jobs block until released
+class Work:
+    def __init__(self):
+        self.events = []
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, job:Job, name:str):
+        with self._lock:
+            self.events.append(('start', name))
+        self.started.release()
+        self.release.wait(10)
+        job.check_cancelled()
+        with self._lock:
+            self.events.append(('end', name))
+        return name
+
+    def wait_started(self, count:int=1):
+        for _ in range(count):
+            assert self.started.acquire(timeout=10)
+
+
+@pytest.fixture
+def work():
+    work = Work()
+    yield work
+    work.release.set()
+
+
+# Jobs of the same key run one by one, in order of submission
+def test_jobs_of_key_run_one_by_one(work):
+    queue = JobQueue('test')
+    jobs = [queue.submit('device', work, name) for name in 'abc']
+    work.wait_started()
+    time.sleep(0.1)
+    assert [job.status for job in jobs] == [Job.RUNNING, Job.QUEUED, Job.QUEUED]
+    assert [queue.position(job) for job in jobs] == [0, 1, 2]
+    assert queue.depth() == 2
+
+    work.release.set()
+    wait_finished(*jobs)
+
+    assert work.events == [('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b'), ('start', 'c'), ('end', 'c')]
+    assert [job.result for job in jobs] == ['a', 'b', 'c']
+    assert [job.status for job in jobs] == [Job.DONE] * 3 and all(job.progress == 100.0 for job in jobs)
+
+
+# Jobs of different keys (or up to `concurrency` of one key) run in parallel
+@pytest.mark.parametrize('keys, concurrency', [(['one', 'two'], 1), (['one', 'one'], 2)])
+def test_jobs_run_in_parallel(work, keys, concurrency):
+    queue = JobQueue('test', concurrency=concurrency)
+    jobs = [queue.submit(key, work, str(index)) for index, key in enumerate(keys)]
+    work.wait_started(2)
+    assert [job.status for job in jobs] == [Job.RUNNING, Job.RUNNING]
+    assert [queue.position(job) for job in jobs] == [0, 0]
+
+    work.release.set()
+    wait_finished(*jobs)
+
+
+# Queued job is removed at once, running one stops at its next check
+def test_cancel(work):
+    queue = JobQueue('test')
+    running = queue.submit('device', work, 'running')
+    queued = queue.submit('device', work, 'queued')
+    after = queue.submit('device', work, 'after')
+    work.wait_started()
+
+    assert queue.cancel(queued) and queued.status == Job.CANCELLED and queued.finished is not None
+    assert queue.position(after) == 1
+    assert queue.cancel(running) and running.status == Job.RUNNING
+    work.release.set()
+    wait_finished(running, after)
+
+    assert running.status == Job.CANCELLED and running.result is None
+    assert after.status == Job.DONE
+    assert ('start', 'queued') not in work.events
+    assert not queue.cancel(running) and not queue.cancel(queued)
+
+
+def test_failed_job():
+    def fail(job:Job):
+        raise ValueError('no paper')
+    queue = JobQueue('test')
+    job = queue.submit('device', fail)
+    wait_finished(job)
+    assert (job.status, job.error) == (Job.FAILED, 'no paper')
+
+
+# Only the newest finished jobs over the history limit are kept, queued ones never go
+def test_prune_history(work):
+    queue = JobQueue('test', history=2)
+    finished = [queue.submit('fast', lambda job: None) for _ in range(4)]
+    wait_finished(*finished)
+    running = queue.submit('device', work, 'running')
+    queued = queue.submit('device', work, 'queued')
+
+    assert queue.list() == finished[2:] + [running, queued]
+    assert queue.get(finished[0].id) is None and queue.get(finished[3].id) is finished[3]
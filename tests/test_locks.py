@@ -0,0 +1,79 @@
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from swis.core.locks import LockBusy, Locks
+
+# Takes values of the sequence in a separate process
+NEXT_VALUES = '''
+import sys
+from swis.core.locks import Locks
+locks = Locks(sys.argv[1])
+print(' '.join(str(locks.next_value('seq')) for _ in range(50)))
+'''
+
+
+@pytest.fixture
+def locks(tmp_path):
+    return Locks(str(tmp_path / '.locks'))
+
+
+def test_lock_is_exclusive(locks):
+    with locks.lock('device-default'):
+        with pytest.raises(LockBusy):
+            with locks.lock('device-default', blocking=False):
+                pass
+        with locks.lock('device-other', blocking=False):
+            pass
+    with locks.lock('device-default', blocking=False):
+        pass
+
+
+# Lock held by another thread is waited for
+def test_lock_waits(locks):
+    order = []
+    held, release = threading.Event(), threading.Event()
+    def holder():
+        with locks.lock('device-default'):
+            held.set()
+            release.wait(10)
+            order.append('holder')
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait(10)
+    release.set()
+    with locks.lock('device-default'):
+        order.append('waiter')
+    thread.join()
+    assert order == ['holder', 'waiter']
+
+
+# Names that are not valid file names still get their own lock file
+def test_lock_path(locks):
+    assert locks.path('device-default').name == 'device-default.lock'
+    unsafe = locks.path('device-fake:0')
+    assert unsafe.name.startswith('device-fake_0-') and unsafe != locks.path('device-fake_0')
+    assert locks.path('device-a/b').parent == locks.folder
+
+
+def test_striped_lock(locks):
+    with locks.striped('thumbnails', 'a.png'):
+        with pytest.raises(LockBusy):
+            with locks.striped('thumbnails', 'a.png', blocking=False):
+                pass
+        with locks.striped('files', 'a.png', blocking=False):
+            pass
+
+
+# Worker processes never get the same value
+def test_next_value_between_processes(locks):
+    processes = [
+        subprocess.Popen([sys.executable, '-c', NEXT_VALUES, str(locks.folder)], stdout=subprocess.PIPE, text=True, cwd=Path(__file__).parents[1])
+        for _ in range(4)
+    ]
+    values = [int(value) for p in processes for value in p.communicate(timeout=60)[0].split()]
+    assert sorted(values) == list(range(1, 201))
+    assert locks.next_value('seq') == 201
@@ -0,0 +1,89 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from swis.core import metrics
+from swis.core.jobs import JobStore
+from swis.core.metrics import Counter, Gauge, Histogram, MetricsMiddleware
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    return metrics.REGISTRY
+
+
+def test_render(registry):
+    requests = Counter('test_requests_total', 'Requests', ('route',))
+    requests.inc(2, '/scans')
+    seconds = Histogram('test_seconds', 'Time', (), (0.1, 1.0))
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+
+    text = metrics.render()
+
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{route="/scans"} 2' in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2' in text
+    assert 'test_seconds_sum 0.55' in text
+    assert 'test_seconds_count 2' in text
+
+
+# Values of the other worker processes are added, gauges of shared state are not
+def test_render_adds_other_workers(registry):
+    requests = Counter('test_requests_total', 'Requests', ('route',))
+    seconds = Histogram('test_seconds', 'Time', (), (0.1, 1.0))
+    Gauge('test_queued', 'Queued', (), lambda: 3)
+    Gauge('test_files', 'Files', (), lambda: 10, aggregated=False)
+    requests.inc(2, '/scans')
+    seconds.observe(0.05)
+    other = metrics.snapshot()
+    requests.inc(1, '/search')
+
+    text = metrics.render([other])
+
+    assert 'test_requests_total{route="/scans"} 4' in text
+    assert 'test_requests_total{route="/search"} 1' in text
+    assert 'test_seconds_count 2' in text
+    assert 'test_queued 6' in text
+    assert 'test_files 10' in text
+
+
+def test_job_store_shares_metrics(tmp_path):
+    path = str(tmp_path / '.jobs.db')
+    mine, other = JobStore(path), JobStore(path)
+    other.owner = mine.owner + 1 # another worker process
+
+    other.publish_metrics('{"a": []}')
+    mine.publish_metrics('{"b": []}')
+
+    assert mine.metrics() == ['{"a": []}']
+    assert other.metrics() == ['{"b": []}']
+
+
+# Requests are counted by route template, not by path
+def test_metrics_middleware():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+    @app.get('/items/{item_id}')
+    async def item_get(item_id:int):
+        return {'id': item_id}
+    @app.post('/items')
+    async def item_post(request:Request):
+        return {'size': len(await request.body())}
+    client = TestClient(app)
+
+    client.get('/items/1')
+    client.get('/items/2')
+    client.get('/items/x')
+    client.post('/items', content=b'x' * 100)
+    client.get('/missing')
+
+    text = metrics.HTTP_SECONDS.render([]) + metrics.HTTP_REQUEST_BYTES.render([])
+    assert 'swis_http_request_seconds_count{method="GET",route="/items/{item_id}",status="200"} 2' in text
+    assert 'swis_http_request_seconds_count{method="GET",route="/items/{item_id}",status="422"} 1' in text
+    assert 'swis_http_request_seconds_count{method="POST",route="/items",status="200"} 1' in text
+    assert 'swis_http_request_bytes_total{route="/items"} 100' in text
+    assert 'route="unmatched",status="404"' in text
+    assert '/items/1' not in text
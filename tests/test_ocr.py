@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+from swis.core.ocr import OcrError, parse_tsv, recognize
+
+# tesseract ... tsv of a page with two paragraphs (empty words have conf -1)
+TSV = '\n'.join('\t'.join(map(str, row)) for row in [
+    ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height', 'conf', 'text'),
+    (1, 1, 0, 0, 0, 0, 0, 0, 1240, 1754, -1, ''),
+    (2, 1, 1, 0, 0, 0, 100, 100, 600, 80, -1, ''),
+    (3, 1, 1, 1, 0, 0, 100, 100, 600, 80, -1, ''),
+    (4, 1, 1, 1, 1, 0, 100, 100, 600, 30, -1, ''),
+    (5, 1, 1, 1, 1, 1, 100, 100, 200, 30, 96.5, 'Invoice'),
+    (5, 1, 1, 1, 1, 2, 320, 100, 80, 30, 95.1, 'no.'),
+    (5, 1, 1, 1, 1, 3, 420, 100, 40, 30, 91.0, '7'),
+    (4, 1, 1, 1, 2, 0, 100, 150, 300, 30, -1, ''),
+    (5, 1, 1, 1, 2, 1, 100, 150, 300, 30, 90.2, 'March'),
+    (5, 1, 1, 1, 2, 2, 420, 150, 10, 30, -1, ' '),
+    (2, 1, 2, 0, 0, 0, 100, 400, 500, 30, -1, ''),
+    (3, 1, 2, 1, 0, 0, 100, 400, 500, 30, -1, ''),
+    (4, 1, 2, 1, 1, 0, 100, 400, 500, 30, -1, ''),
+    (5, 1, 2, 1, 1, 1, 100, 400, 500, 30, 88.0, 'Total:'),
+]) + '\n'
+
+
+def test_parse_tsv():
+    result = parse_tsv(TSV)
+    assert result['text'] == 'Invoice no. 7\nMarch\n\nTotal:'
+    assert (result['width'], result['height']) == (1240, 1754)
+    assert result['words'][0] == [100, 100, 200, 30, 'Invoice']
+    assert [word[4] for word in result['words']] == ['Invoice', 'no.', '7', 'March', 'Total:']
+
+
+def test_parse_empty_tsv():
+    assert parse_tsv(TSV.splitlines()[0] + '\n') == {'text': '', 'width': 0, 'height': 0, 'words': []}
+
+
+# Prints the tsv above, or fails when the image is named "broken..."
+FAKE_TESSERACT = f'''#!{sys.executable}
+import sys
+if 'broken' in sys.argv[1]:
+    sys.stderr.write('Error in pixReadStream\\n')
+    sys.exit(1)
+sys.stdout.write({TSV!r})
+'''
+
+
+@pytest.fixture
+def tesseract(tmp_path, monkeypatch):
+    bin_folder = tmp_path / 'bin'
+    bin_folder.mkdir()
+    (bin_folder / 'tesseract').write_text(FAKE_TESSERACT)
+    (bin_folder / 'tesseract').chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_folder}{os.pathsep}{os.environ["PATH"]}')
+    return tmp_path
+
+
+# Result tells which content of the file was read
+def test_recognize(tesseract):
+    source = tesseract / 'scan.png'
+    source.write_bytes(b'image')
+    st = source.stat()
+
+    result = recognize(str(source), 'eng')
+
+    assert result['text'].startswith('Invoice no. 7')
+    assert (result['mtime'], result['size']) == (st.st_mtime, st.st_size)
+
+
+def test_recognize_error(tesseract):
+    (tesseract / 'broken.png').write_bytes(b'image')
+    with pytest.raises(OcrError, match='pixReadStream'):
+        recognize(str(tesseract / 'broken.png'), 'eng')
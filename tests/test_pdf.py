@@ -0,0 +1,128 @@
+import re
+import time
+import zlib
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import swis.swis as swis
+from swis.core.jobs import Job
+from swis.core.pdf import PdfError, build_pdf
+
+
+def pdf_objects(data:bytes) -> dict:
+    return {int(number): body for number, body in re.findall(rb'(\d+) 0 obj\n(.*?)\nendobj', data, re.S)}
+
+
+# Every object is where the xref table says
+def check_xref(data:bytes):
+    xref = int(re.search(rb'startxref\n(\d+)', data)[1])
+    rows = data[xref:].split(b'\n')
+    count = int(rows[1].split()[1])
+    for number, row in enumerate(rows[3:3 + count - 1], 1):
+        offset = int(row.split()[0])
+        assert data[offset:].startswith(f'{number} 0 obj'.encode())
+
+
+def test_build_pdf_round_trip(tmp_path):
+    Image.new('RGB', (300, 200), 'red').save(tmp_path / 'a.png', dpi=(150, 150))
+    Image.new('RGB', (200, 300), 'blue').save(tmp_path / 'b.jpg', dpi=(300, 300))
+    target = tmp_path / 'out.pdf'
+
+    assert build_pdf([tmp_path / 'a.png', tmp_path / 'b.jpg'], target) == []
+
+    data = target.read_bytes()
+    assert data.startswith(b'%PDF-1.4') and data.rstrip().endswith(b'%%EOF')
+    check_xref(data)
+    assert re.search(rb'/Count 2\b', data)
+    # page size follows the resolution of the image (PNG keeps it in pixels per meter)
+    boxes = [tuple(map(float, box)) for box in re.findall(rb'/MediaBox \[0 0 ([\d.]+) ([\d.]+)\]', data)]
+    assert boxes == [pytest.approx((144, 96), abs=0.05), pytest.approx((48, 72), abs=0.05)]
+    # JPEG is embedded as it is
+    assert (tmp_path / 'b.jpg').read_bytes() in data
+    assert not list(tmp_path.glob('.*.part'))
+
+
+# 16-bit gray is scaled to 8 bits, not clipped
+def test_build_pdf_scales_16_bit_images(tmp_path):
+    samples = np.arange(0, 65536, 256, dtype=np.uint16).reshape(16, 16)
+    Image.fromarray(samples).save(tmp_path / 'gray16.png')
+    target = tmp_path / 'out.pdf'
+
+    build_pdf([tmp_path / 'gray16.png'], target)
+
+    image = next(body for body in pdf_objects(target.read_bytes()).values() if b'/FlateDecode' in body)
+    assert b'/DeviceGray' in image
+    pixels = zlib.decompress(image.split(b'\nstream\n', 1)[1].rsplit(b'\nendstream', 1)[0])
+    assert list(pixels) == list(range(256))
+
+
+def test_build_pdf_rejects_pdf_pages(tmp_path):
+    (tmp_path / 'doc.pdf').write_bytes(b'%PDF-1.4\n')
+    with pytest.raises(PdfError, match='doc.pdf'):
+        build_pdf([tmp_path / 'doc.pdf'], tmp_path / 'out.pdf')
+    assert not (tmp_path / 'out.pdf').exists()
+
+
+def test_makepdf_rejects_pdf_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    response = TestClient(swis.app).post('/makepdf', json={'filenames': ['a.png', 'doc.pdf']})
+    assert response.status_code == 422
+    assert 'doc.pdf' in response.json()['detail']
+
+
+# PDF has at least one page
+@pytest.mark.parametrize('body', [{'filenames': []}, {'target': 'empty'}, {'filenames': None}])
+def test_makepdf_requires_filenames(tmp_path, monkeypatch, body):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    response = TestClient(swis.app).post('/makepdf', json=body)
+    assert response.status_code == 422
+
+
+# PDF is built by a background job, whose status is polled
+def test_makepdf_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    Image.new('RGB', (300, 200), 'red').save(tmp_path / 'a.png')
+    Image.new('RGB', (200, 300), 'blue').save(tmp_path / 'b.jpg')
+    client = TestClient(swis.app)
+
+    job = client.post('/makepdf', json={'filenames': ['a.png', 'b.jpg'], 'target': 'both'}).json()
+    assert job['pages'] == 2
+    deadline = time.monotonic() + 30
+    while job['status'] in (Job.QUEUED, Job.RUNNING) and time.monotonic() < deadline:
+        time.sleep(0.05)
+        job = client.get(f'/makepdf/jobs/{job["id"]}').json()
+
+    assert job['status'] == Job.DONE
+    assert (job['pages_done'], job['progress']) == (2, 100.0)
+    assert job['result'] == {'returncode': 0, 'detail': '', 'filename': 'both.pdf'}
+    assert re.search(rb'/Count 2\b', (tmp_path / 'both.pdf').read_bytes())
+    assert swis.scans_catalog().get('both.pdf') is not None
+    assert job['id'] in [listed['id'] for listed in client.get('/makepdf/jobs').json()['jobs']]
+    assert client.get('/makepdf/jobs/unknown').status_code == 404
+
+
+
+# Recognized words are invisible text over the page image, at the word
+# boxes scaled from pixels of the image to the page (JPEG keeps exact dpi)
+def test_build_pdf_text_layer(tmp_path):
+    Image.new('RGB', (200, 100), 'white').save(tmp_path / 'a.jpg', dpi=(72, 72))
+    Image.new('RGB', (200, 100), 'white').save(tmp_path / 'b.jpg', dpi=(72, 72))
+    words = {'width': 400, 'height': 200, 'words': [[20, 40, 160, 20, 'Zürich'], [200, 40, 80, 20, 'a(b)']]}
+    target = tmp_path / 'out.pdf'
+
+    build_pdf([tmp_path / 'a.jpg', tmp_path / 'b.jpg'], target, page_words=lambda path: words if path.name == 'a.jpg' else None)
+
+    data = target.read_bytes()
+    check_xref(data)
+    contents = [body for body in pdf_objects(data).values() if b'/Im0 Do' in body]
+    assert len(contents) == 2
+    assert b'BT 3 Tr' in contents[0] and b'BT' not in contents[1]
+    assert b'/F0 10.00 Tf 266.7 Tz 1 0 0 1 10.00 72.00 Tm (Z\xfcrich) Tj' in contents[0]
+    assert b'(a\\(b\\)) Tj' in contents[0]
+    fonts = [body for body in pdf_objects(data).values() if b'/BaseFont /Helvetica' in body]
+    assert len(fonts) == 1
+    assert data.count(b'/Font << /F0') == 1
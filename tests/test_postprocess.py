@@ -0,0 +1,42 @@
+import pytest
+from PIL import Image, ImageDraw
+
+from swis.core.postprocess import autocrop, content_box, deskew, skew_angle
+
+DPI = 100
+
+
+# White page with lines of "text" (dark bars) in the given box
+def page(box=(200, 150, 600, 650)) -> Image.Image:
+    im = Image.new('L', (800, 1000), 255)
+    draw = ImageDraw.Draw(im)
+    for top in range(box[1], box[3], 50):
+        draw.rectangle((box[0], top, box[2] - 1, top + 19), fill=0)
+    return im
+
+
+def test_content_box():
+    margin = int(DPI * 3.0 / 25.4)
+    # the last bar ends at row 620
+    assert content_box(page(), DPI) == (200 - margin, 150 - margin, 600 + margin, 620 + margin)
+    assert content_box(Image.new('L', (800, 1000), 255), DPI) is None
+
+
+def test_autocrop():
+    margin = int(DPI * 3.0 / 25.4)
+    assert autocrop(page(), DPI).size == (400 + 2 * margin, 470 + 2 * margin)
+    blank = Image.new('L', (800, 1000), 255)
+    assert autocrop(blank, DPI) is blank
+
+
+@pytest.mark.parametrize('angle', [-3.0, 2.5])
+def test_skew_angle(angle):
+    skewed = page().rotate(angle, Image.BICUBIC, fillcolor=255)
+    assert skew_angle(skewed) == pytest.approx(-angle, abs=0.25)
+
+
+def test_deskew():
+    straight = page()
+    assert deskew(straight) is straight
+    straightened = deskew(straight.rotate(3.0, Image.BICUBIC, expand=True, fillcolor=255))
+    assert skew_angle(straightened) == pytest.approx(0.0, abs=0.25)
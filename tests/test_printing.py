@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from swis.core.printing import PrintJob, PrintQueue, parse_lpstat
+from swis.core.schemas import ProcessResult
+
+LPSTAT = (
+    'office-12  alice  10240  Mon 01 Jan 2024 10:00:00 AM CET\n'
+    '\tStatus: printing page 1\n'
+    'office-14  bob  2048  Mon 01 Jan 2024 10:01:00 AM CET\n'
+)
+
+
+def test_parse_lpstat():
+    assert parse_lpstat(LPSTAT) == {'office-12', 'office-14'}
+    assert parse_lpstat('') == set()
+
+
+# Answers lp, lpstat and cancel like CUPS with the given not-completed jobs
+class FakeCups:
+    def __init__(self):
+        self.calls = []
+        self.not_completed = ''
+        self.returncode = 0
+
+    def __call__(self, params:list) -> ProcessResult:
+        self.calls.append(params)
+        if self.returncode:
+            return ProcessResult(returncode=self.returncode, stdout='', stderr='lpstat: No destinations added.')
+        return ProcessResult(returncode=0, stdout=self.not_completed, stderr='')
+
+
+@pytest.fixture
+def page(tmp_path):
+    path = tmp_path / 'page.png'
+    path.write_bytes(b'image')
+    return path
+
+
+# The same files with the same options are printed once within the window
+def test_add_deduplicates(page):
+    queue = PrintQueue(FakeCups(), dedup_window=60)
+
+    job, new = queue.add([page], ['-o', 'sides=one-sided'])
+    assert new and job.status == PrintJob.SUBMITTING
+    assert queue.add([page], ['-o', 'sides=one-sided']) == (job, False)
+    assert queue.add([page], ['-o', 'sides=two-sided-long-edge'])[1]
+
+    # changed file is printed again
+    page.write_bytes(b'other image')
+    os.utime(page, ns=(1, 1))
+    assert queue.add([page], ['-o', 'sides=one-sided'])[1]
+
+
+def test_add_after_window_or_failure(page):
+    queue = PrintQueue(FakeCups(), dedup_window=0)
+    job, _ = queue.add([page], [])
+    assert queue.add([page], [])[0] is not job
+
+    queue = PrintQueue(FakeCups(), dedup_window=60)
+    job, _ = queue.add([page], [])
+    queue.submitted(job, ProcessResult(returncode=1, stdout='', stderr='lp: Error - no default destination'))
+    assert (job.status, job.detail) == (PrintJob.FAILED, 'lp: Error - no default destination')
+    assert queue.add([page], [])[1]
+
+
+def test_submitted(page):
+    queue = PrintQueue(FakeCups(), dedup_window=60)
+    job, _ = queue.add([page], [])
+    queue.submitted(job, ProcessResult(returncode=0, stdout='request id is office-12 (1 file(s))\n', stderr=''))
+    assert (job.status, job.cups_id) == (PrintJob.PENDING, 'office-12')
+
+
+# Pending jobs are completed once CUPS does not list them as not-completed
+def test_poll(page):
+    cups = FakeCups()
+    queue = PrintQueue(cups, dedup_window=0)
+    jobs = []
+    for cups_id in ('office-12', 'office-13'):
+        job, _ = queue.add([page], [])
+        queue.submitted(job, ProcessResult(returncode=0, stdout=f'request id is {cups_id} (1 file(s))', stderr=''))
+        jobs.append(job)
+
+    cups.not_completed = LPSTAT
+    queue.poll()
+    assert [job.status for job in jobs] == [PrintJob.PENDING, PrintJob.COMPLETED]
+    assert cups.calls == [['lpstat', '-W', 'not-completed', '-o']]
+
+    cups.returncode = 1
+    queue.poll()
+    assert jobs[0].status == PrintJob.PENDING
+
+    cups.returncode = 0
+    cups.not_completed = ''
+    queue.poll()
+    assert jobs[0].status == PrintJob.COMPLETED
+    calls = len(cups.calls)
+    queue.poll() # nothing pending, lpstat is not run
+    assert len(cups.calls) == calls
+
+
+def test_cancel(page):
+    cups = FakeCups()
+    queue = PrintQueue(cups, dedup_window=60)
+    job, _ = queue.add([page], [])
+    assert not queue.cancel(job) # not submitted yet
+    queue.submitted(job, ProcessResult(returncode=0, stdout='request id is office-12 (1 file(s))', stderr=''))
+
+    assert queue.cancel(job)
+    assert job.status == PrintJob.CANCELLED and cups.calls == [['cancel', 'office-12']]
+    assert queue.add([page], [])[1] # cancelled job is not a duplicate
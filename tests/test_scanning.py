@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import swis.swis as swis
+from swis.core import schemas
+from swis.core.jobs import Job
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from harness import install_fakes # noqa: E402
+from swis.core.scanning import ScanStream, ScanStreamError
+
+
+@pytest.fixture
+def scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+# Only bilevel images are saved as G4, others keep their colors (LZW)
+@pytest.mark.parametrize('mode, compression', [('RGB', 'tiff_lzw'), ('L', 'tiff_lzw'), ('1', 'group4')])
+def test_save_tiff_scan(scans, mode, compression):
+    req = schemas.ScanRequest(mode='Color', resolution='300', format='tiff')
+    img = Image.effect_noise((160, 120), 40).convert(mode)
+    target = scans / '20240101-000000_1.tif'
+
+    swis.save_scan(img, req, target)
+
+    with Image.open(target) as im:
+        assert im.mode == mode
+        assert im.info['compression'] == compression
+        assert im.info['dpi'] == pytest.approx((300, 300))
+        assert im.tobytes() == img.tobytes()
+
+
+def pnm(img:Image.Image) -> bytes:
+    data = io.BytesIO()
+    img.save(data, 'PPM')
+    return data.getvalue()
+
+
+# Image is decoded from pieces of any size, also splitting the header
+@pytest.mark.parametrize('mode, row', [('1', 8), ('L', 61), ('RGB', 183)])
+def test_scan_stream(mode, row):
+    img = Image.effect_noise((61, 40), 40).convert(mode)
+    header, pixels = pnm(img).split(b'\n', 1)
+    data = header.replace(b' ', b'\n# scanimage\n', 1) + b'\n' + pixels
+    stream = ScanStream()
+
+    for offset in range(0, len(data), 7):
+        stream.feed(data[offset:offset + 7])
+
+    assert stream.expected == stream.received == row * 40
+    decoded, truncated = stream.close()
+    assert not truncated
+    assert decoded.mode == mode and decoded.tobytes() == img.tobytes()
+
+
+# Rows missing at the end of a short stream are white
+@pytest.mark.parametrize('mode, white', [('1', 255), ('L', 255), ('RGB', (255, 255, 255))])
+def test_scan_stream_pads_truncated(mode, white):
+    img = Image.new(mode, (20, 10), 0)
+    data = pnm(img)
+    stream = ScanStream()
+    stream.feed(data[:len(data) - len(img.tobytes()) // 2])
+
+    assert stream.truncated
+    decoded, truncated = stream.close()
+    assert truncated and decoded.size == (20, 10)
+    assert decoded.getpixel((0, 0)) == img.getpixel((0, 0)) and decoded.getpixel((19, 9)) == white
+
+
+@pytest.mark.parametrize('data', [b'', b'P6\n20', b'\x89PNG\r\n\x1a\n 20 10 255\n'])
+def test_scan_stream_errors(data):
+    stream = ScanStream()
+    with pytest.raises(ScanStreamError):
+        stream.feed(data)
+        stream.close()
+
+
+@pytest.mark.parametrize('filename, page, name', [
+    ('20240101-120000_42.png', 1, '20240101-120000_42-p001.png'),
+    ('20240101-120000_42.tif', 12, '20240101-120000_42-p012.tif'),
+    ('invoice.jpg', 123, 'invoice-p123.jpg'),
+])
+def test_batch_page_name(filename, page, name):
+    assert swis.batch_page_name(filename, page) == name
+
+
+# Writes three pages like scanimage --batch --batch-print, then the feeder is empty
+FAKE_BATCH_SCANIMAGE = f'''#!{sys.executable}
+import sys
+pattern = next(arg.split('=', 1)[1] for arg in sys.argv if arg.startswith('--batch='))
+for page in range(1, 4):
+    with open(pattern % page, 'wb') as f:
+        f.write(b'P5\\n8 4\\n255\\n' + bytes([page * 60]) * 32)
+    print(pattern % page, flush=True)
+sys.stderr.write('scanimage: sane_start: Document feeder out of documents\\n')
+sys.exit(7)
+'''
+
+
+# Pages are stored under numbered names of the batch and assembled to pdf
+def test_scan_batch(scans, tmp_path_factory, monkeypatch):
+    bin_folder = tmp_path_factory.mktemp('bin')
+    (bin_folder / 'scanimage').write_text(FAKE_BATCH_SCANIMAGE)
+    (bin_folder / 'scanimage').chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_folder}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    req = schemas.ScanRequest(mode='Gray', resolution='150', format='png', batch=True, batch_pdf=True)
+    job = Job('scan', 'default', None, ())
+
+    result = swis.scan_batch(job, req, '20240101-120000_42.png')
+
+    pages = [f'20240101-120000_42-p{page:03d}.png' for page in range(1, 4)]
+    assert (result.code, result.pages, result.filename) == (0, pages, '20240101-120000_42.pdf')
+    assert job.steps == 3
+    for page, name in enumerate(pages, 1):
+        with Image.open(swis.scan_path(name)) as im:
+            assert im.getpixel((0, 0)) == page * 60
+        assert swis.scans_catalog().get(name) is not None
+    assert swis.scan_path('20240101-120000_42.pdf').read_bytes().startswith(b'%PDF')
+    assert not list(scans.glob('.batch-*'))
+
+
+# Fake scanimage of the benchmarks (about a second per page)
+@pytest.fixture
+def scanner(scans, tmp_path_factory, monkeypatch):
+    bin_folder = tmp_path_factory.mktemp('bin')
+    install_fakes(str(bin_folder))
+    monkeypatch.setenv('PATH', f'{bin_folder}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_SCAN_SECONDS', '1')
+    monkeypatch.setenv('FAKE_SCAN_SIZE', '200x300')
+    monkeypatch.setattr(swis.settings, 'PREVIEW_INTERVAL', 0)
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    return TestClient(swis.app)
+
+
+def receive_all(ws) -> list:
+    messages = []
+    while not messages or messages[-1]['type'] == 'preview' or messages[-1]['job']['status'] in (Job.QUEUED, Job.RUNNING):
+        messages.append(ws.receive_json())
+    return messages
+
+
+def test_scan_websocket(scanner):
+    with scanner.websocket_connect('/scan/ws') as ws:
+        ws.send_json({'mode': 'Color', 'resolution': '75', 'format': 'jpg'})
+        messages = receive_all(ws)
+
+    statuses = [message['job'] for message in messages if message['type'] == 'status']
+    assert statuses[0]['status'] in (Job.QUEUED, Job.RUNNING)
+    assert statuses[-1]['status'] == Job.DONE and statuses[-1]['progress'] == 100.0
+    result = statuses[-1]['result']
+    assert result['code'] == 0 and result['filename'].endswith('.jpg')
+    with Image.open(swis.scan_path(result['filename'])) as im:
+        assert im.size == (200, 300)
+    previews = [message['image'] for message in messages if message['type'] == 'preview']
+    assert previews and all(preview.startswith('data:image/jpeg;base64,') for preview in previews)
+
+
+@pytest.mark.parametrize('req, detail', [
+    ({'mode': 'Color', 'resolution': '75', 'format': 'gif'}, 'Unknown format gif'),
+    ({'mode': 'Color', 'format': 'png'}, 'resolution'),
+    ({'mode': 'Color', 'resolution': '75', 'format': 'pdf', 'batch': True}, 'Batch pages cannot be saved as pdf'),
+])
+def test_scan_websocket_rejects_request(scanner, req, detail):
+    with scanner.websocket_connect('/scan/ws') as ws:
+        ws.send_json(req)
+        message = ws.receive_json()
+    assert (message['type'], message['status']) == ('error', 'error')
+    assert detail in message['detail']
+    assert swis.scan_queue.depth() == 0
+
+
+# Scan waiting for the device is cancelled, the connection ends with its status
+def test_scan_websocket_cancel(scanner):
+    running = scanner.post('/scan/execute', json={'mode': 'Color', 'resolution': '75', 'format': 'png'}).json()
+    with scanner.websocket_connect('/scan/ws') as ws:
+        ws.send_json({'mode': 'Color', 'resolution': '75', 'format': 'png'})
+        queued = ws.receive_json()['job']
+        assert (queued['status'], queued['position']) == (Job.QUEUED, 1)
+        assert scanner.delete(f'/scan/jobs/{queued["id"]}').json()['status'] == Job.CANCELLED
+        messages = receive_all(ws)
+    assert messages[-1]['job']['status'] == Job.CANCELLED
+
+    with scanner.websocket_connect('/scan/ws') as ws:
+        ws.send_json({'mode': 'Color', 'resolution': '75', 'format': 'png'})
+        assert receive_all(ws)[-1]['job']['status'] == Job.DONE
+    assert scanner.get(f'/scan/jobs/{running["id"]}').json()['status'] == Job.DONE
@@ -0,0 +1,78 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from swis.core.storage import ScanFiles, Storage, public_name
+
+
+@pytest.fixture
+def files(tmp_path):
+    app = FastAPI()
+    app.mount('/files', ScanFiles(Storage(str(tmp_path))))
+    return TestClient(app)
+
+
+# Catalog, job store, content store ... are in the served folder, but never served
+@pytest.mark.parametrize('path', ['.catalog.db', '.blobs/ab/abcd', '.uploads/x/data', '.20240101-000000_1.png.part'])
+def test_hidden_files_are_not_served(tmp_path, files, path):
+    hidden = tmp_path / path
+    hidden.parent.mkdir(parents=True, exist_ok=True)
+    hidden.write_bytes(b'secret')
+    (tmp_path / 'thumbs').mkdir()
+
+    assert files.get(f'/files/{path}').status_code == 404
+    assert files.get(f'/files/thumbs/../{path}').status_code == 404
+
+
+def test_scans_are_served(tmp_path, files):
+    (tmp_path / 'scan.png').write_bytes(b'image')
+    response = files.get('/files/scan.png')
+    assert response.status_code == 200 and response.content == b'image'
+
+
+@pytest.mark.parametrize('filename, shard', [
+    ('20240131-101500_7.jpg', '2024/01'),
+    ('20240131-101500_7-p001.png', '2024/01'),
+])
+def test_dated_names_are_sharded_by_date(tmp_path, filename, shard):
+    assert Storage(str(tmp_path), sharded=True).shard(filename) == shard
+
+
+# Undated names are sharded by hash of the name without its suffix
+def test_undated_names_are_sharded_by_stem(tmp_path):
+    storage = Storage(str(tmp_path), sharded=True)
+    shard = storage.shard('invoice.png')
+    assert shard.startswith('other/') and len(shard) == len('other/xx')
+    assert storage.shard('invoice.pdf') == shard
+    assert storage.target('invoice.png') == tmp_path / shard / 'invoice.png'
+
+
+def test_flat_storage(tmp_path):
+    storage = Storage(str(tmp_path))
+    assert storage.shard('20240131-101500_7.jpg') == ''
+    assert storage.path('20240131-101500_7.jpg') == tmp_path / '20240131-101500_7.jpg'
+
+
+@pytest.mark.parametrize('name, public', [
+    ('20240131-101500_7.png.webp', '20240131-101500_7.png'),
+    ('20240131-101500_7.tif.webp', '20240131-101500_7.tif'),
+    ('photo.webp', 'photo.webp'), # uploaded WebP, not recompressed
+    ('photo.jpg.webp', 'photo.jpg.webp'),
+    ('20240131-101500_7.png', '20240131-101500_7.png'),
+])
+def test_public_name(name, public):
+    assert public_name(name) == public
+
+
+# Recompressed scan is found by its flat name, in its shard or the archive
+def test_path_finds_compressed_and_archived_files(tmp_path):
+    archive = tmp_path / 'archive'
+    storage = Storage(str(tmp_path / 'scans'), str(archive), sharded=True)
+    compressed = storage.target('20240131-101500_7.png').with_name('20240131-101500_7.png.webp')
+    compressed.parent.mkdir(parents=True)
+    compressed.write_bytes(b'webp')
+    assert storage.path('20240131-101500_7.png') == compressed
+
+    assert storage.move_to_archive('20240131-101500_7.png') == archive / '2024' / '01' / compressed.name
+    assert storage.archived(storage.path('20240131-101500_7.png'))
+    assert [name for name, _ in storage.files(['.png'])] == ['20240131-101500_7.png']
@@ -0,0 +1,110 @@
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+from PIL import Image
+
+import swis.swis as swis
+from swis.core.thumbnails import ThumbnailPool, render_thumbnails, save_renditions, thumbnail_files
+
+
+@pytest.fixture
+def scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'STORAGE_SHARDS', True)
+    monkeypatch.setattr(swis.settings, 'RENDITION_SIZES', [128, 512])
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    return tmp_path
+
+
+# Thumbnails are in the same shard of the thumbs folder as the scan
+def test_thumbnails_are_sharded(scans):
+    assert swis.scan_thumbnail_files('20240131-101500_7.png') == [
+        'thumbs/2024/01/20240131-101500_7.png.thumb.jpg',
+        'thumbs/2024/01/20240131-101500_7.png.128.webp',
+        'thumbs/2024/01/20240131-101500_7.png.512.webp',
+    ]
+    assert swis.scan_thumbnail('photo.png').startswith(f'thumbs/{swis.storage().shard("photo.png")}/')
+
+
+# Thumbnails made with flat storage are moved when sharding is enabled
+def test_flat_thumbnails_are_moved_to_shards(scans):
+    filename = '20240131-101500_7.png'
+    im = Image.new('RGB', (600, 400))
+    im.save(scans / filename)
+    save_renditions(im, str(scans), filename, [128, 512], 'webp')
+    swis.scans_catalog().add(filename, f'thumbs/{filename}.thumb.jpg')
+
+    swis.reconcile_catalog()
+
+    assert swis.scans_catalog().get(filename).thumbnail == swis.scan_thumbnail(filename)
+    assert all((scans / thumbnail).is_file() for thumbnail in swis.scan_thumbnail_files(filename))
+    assert not list((scans / 'thumbs').glob('*.*'))
+
+
+# Thumbnails are rendered in worker processes, which are not forked from the server
+def test_thumbnail_pool_renders_in_worker_process(tmp_path):
+    filename = 'photo.png'
+    Image.new('RGB', (600, 400)).save(tmp_path / filename)
+    done = threading.Event()
+    results = []
+    def on_done(name, ok):
+        results.append((name, ok))
+        done.set()
+    pool = ThumbnailPool(1, 10, on_done)
+    try:
+        assert pool.submit(filename, (str(tmp_path / filename), str(tmp_path), filename, [128], 'webp'))
+        assert done.wait(60)
+    finally:
+        pool.shutdown()
+
+    assert results == [(filename, True)]
+    assert pool._executor._mp_context.get_start_method() != 'fork'
+    assert all((tmp_path / name).is_file() for name in thumbnail_files(filename, [128], 'webp'))
+
+
+# Refresh requested while the file is rendered runs the task again, the
+# result of the previous content is not reported
+def test_thumbnail_pool_renders_refreshed_file_again(tmp_path):
+    filename = 'photo.png'
+    Image.new('RGB', (600, 400)).save(tmp_path / filename)
+    args = (str(tmp_path / filename), str(tmp_path), filename, [128], 'webp')
+    done = threading.Event()
+    results = []
+    def on_done(name, ok):
+        results.append((name, ok))
+        done.set()
+    pool = ThumbnailPool(1, 10, on_done)
+    pool._running.add(filename)
+    try:
+        assert pool.submit(filename, args)
+        assert pool.depth() == 0
+        assert pool.submit(filename, args, refresh=True)
+        previous = Future()
+        previous.set_result(True)
+        pool._finished(filename, previous, 0)
+        assert results == []
+        assert done.wait(60)
+    finally:
+        pool.shutdown()
+
+    assert results == [(filename, True)]
+    assert all((tmp_path / name).is_file() for name in thumbnail_files(filename, [128], 'webp'))
+
+
+# Thumbnails have mtime of the source they were made from, so the source
+# written during rendering is rendered again
+def test_render_thumbnails_of_changed_source(tmp_path):
+    filename = 'photo.png'
+    source = tmp_path / filename
+    Image.new('RGB', (600, 400)).save(source)
+    thumbnail = tmp_path / thumbnail_files(filename, [128], 'webp')[0]
+    assert render_thumbnails(str(source), str(tmp_path), filename, [128], 'webp')
+    assert thumbnail.stat().st_mtime == source.stat().st_mtime
+
+    Image.new('RGB', (400, 600)).save(source)
+    os.utime(source, (source.stat().st_mtime + 1,) * 2)
+    assert render_thumbnails(str(source), str(tmp_path), filename, [128], 'webp')
+    with Image.open(thumbnail) as im:
+        assert im.size == (85, 128)
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import swis.swis as swis
+from swis.core.schemas import TransformRequest
+from swis.core.transform import TransformError, apply_transform, crop_box, jpegtran_commands, open_mapped
+
+
+@pytest.fixture
+def scans(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'RENDITION_SIZES', [16])
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    return tmp_path
+
+
+# Every pixel has its own value, so any misplaced pixel is noticed
+def numbered(width:int, height:int) -> Image.Image:
+    return Image.fromarray(np.arange(width * height, dtype=np.uint8).reshape(height, width))
+
+
+@pytest.mark.parametrize('crop, size, box', [
+    (None, (40, 30), None),
+    ([0, 0, 40, 30], (40, 30), None),
+    ([-5, 2, 100, 20], (40, 30), (0, 2, 40, 20)),
+])
+def test_crop_box(crop, size, box):
+    assert crop_box(TransformRequest(crop=crop), size) == box
+
+
+@pytest.mark.parametrize('crop', [[50, 0, 60, 10], [10, 10, 5, 20], [0, 0, 10]])
+def test_crop_box_errors(crop):
+    with pytest.raises(TransformError):
+        crop_box(TransformRequest(crop=crop), (40, 30))
+
+
+# Crop, then rotate clockwise, then flip
+def test_apply_transform():
+    im = numbered(4, 3)
+    pixels = np.asarray(im)
+
+    out = apply_transform(im, TransformRequest(rotate=90, flip='horizontal'), (1, 0, 4, 2))
+
+    assert np.array_equal(np.asarray(out), np.fliplr(np.rot90(pixels[0:2, 1:4], -1)))
+
+
+# Only the rows of the box are read, also for bottom-up rows (BMP)
+@pytest.mark.parametrize('fmt, suffix', [('PPM', 'pgm'), ('BMP', 'bmp'), ('TIFF', 'tif')])
+def test_open_mapped(tmp_path, fmt, suffix):
+    im = numbered(20, 12)
+    path = tmp_path / f'image.{suffix}'
+    im.save(path, fmt)
+
+    mapped = open_mapped(path, (3, 2, 17, 9))
+
+    assert mapped is not None and mapped.format == fmt
+    assert mapped.tobytes() == im.crop((3, 2, 17, 9)).tobytes()
+
+
+def test_open_mapped_compressed(tmp_path):
+    numbered(20, 12).save(tmp_path / 'image.png')
+    assert open_mapped(tmp_path / 'image.png', None) is None
+
+
+# Crop box corner must be on the MCU boundary for lossless crop
+def test_jpegtran_commands(tmp_path):
+    Image.new('RGB', (64, 64)).save(tmp_path / 'a.jpg', subsampling=2) # 4:2:0, 16x16 MCU
+    source, target = tmp_path / 'a.jpg', tmp_path / 'b.jpg'
+    with Image.open(source) as im:
+        assert jpegtran_commands(im, TransformRequest(), (8, 0, 64, 64), source, target) is None
+        commands = jpegtran_commands(im, TransformRequest(rotate=90), (16, 16, 48, 64), source, target)
+
+    assert [command[3:-3] for command in commands] == [['-crop', '32x48+16+16'], ['-perfect', '-rotate', '90']]
+    assert commands[0][-3:] == ['-outfile', f'{target}.0', str(source)]
+    assert commands[1][-3:] == ['-outfile', str(target), f'{target}.0']
+
+
+def test_transform_endpoint(scans):
+    filename = '20240101-000000_1.png'
+    im = numbered(40, 30)
+    im.save(swis.scan_path(filename, create=True))
+    swis.register_file(filename)
+    client = TestClient(swis.app)
+
+    result = client.post(f'/scans/{filename}/transform', json={'crop': [10, 5, 30, 25], 'rotate': 270}).json()
+
+    assert (result['returncode'], result['lossless']) == (0, True)
+    assert (result['scan']['width'], result['scan']['height']) == (20, 20)
+    with Image.open(swis.scan_path(filename)) as out:
+        assert out.tobytes() == im.crop((10, 5, 30, 25)).transpose(Image.Transpose.ROTATE_90).tobytes()
+    with Image.open(scans / swis.scan_thumbnail_files(filename)[1]) as rendition:
+        assert rendition.size == (16, 16)
+    assert not list(scans.glob('.*.part*'))
+
+
+# Nothing to transform leaves the file as it is (not encoded again)
+def test_transform_endpoint_identity(scans):
+    filename = '20240101-000000_1.png'
+    numbered(40, 30).save(swis.scan_path(filename, create=True))
+    data = swis.scan_path(filename).read_bytes()
+
+    result = TestClient(swis.app).post(f'/scans/{filename}/transform', json={'crop': [0, 0, 50, 50], 'rotate': 360}).json()
+
+    assert (result['returncode'], result['detail']) == (0, 'Nothing to transform')
+    assert swis.scan_path(filename).read_bytes() == data
+
+
+@pytest.mark.parametrize('filename, req, code', [
+    ('20240101-000000_1.png', {'rotate': 45}, 422),
+    ('20240101-000000_1.png', {'flip': 'diagonal'}, 422),
+    ('20240101-000000_1.pdf', {'rotate': 90}, 422),
+    ('missing.png', {'rotate': 90}, 404),
+])
+def test_transform_endpoint_errors(scans, filename, req, code):
+    numbered(40, 30).save(swis.scan_path('20240101-000000_1.png', create=True))
+    swis.scan_path('20240101-000000_1.pdf', create=True).write_bytes(b'%PDF-1.4\n')
+    assert TestClient(swis.app).post(f'/scans/{filename}/transform', json=req).status_code == code
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import io
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import swis.swis as swis
+from swis.core.jobs import BoundedExecutor
+from swis.core.uploads import BodySizeLimitMiddleware, UploadTooLarge, save_upload
+
+
+@pytest.fixture
+def executor():
+    executor = BoundedExecutor('test', 1)
+    yield executor
+    executor.shutdown()
+
+
+# Chunks are written as they are read, reads never ask for more than a chunk
+def test_save_upload_in_chunks(tmp_path, executor):
+    data = bytes(range(256)) * 40
+    reads = []
+    class Source(io.BytesIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super().read(size)
+    target = tmp_path / 'upload.bin'
+    digest = hashlib.sha256()
+
+    size = asyncio.run(save_upload(Source(data), target, len(data), 1000, executor, digest))
+
+    assert size == len(data)
+    assert target.read_bytes() == data
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert set(reads) == {1000} and len(reads) == 12
+    assert not list(tmp_path.glob('.*.part'))
+
+
+# Upload over the limit leaves neither the file nor its temporary copy
+def test_save_upload_over_limit(tmp_path, executor):
+    target = tmp_path / 'upload.bin'
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(save_upload(io.BytesIO(b'x' * 2500), target, 2000, 1000, executor))
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(BodySizeLimitMiddleware, limit=1000)
+    @app.post('/echo')
+    async def echo(request:Request):
+        return {'size': len(await request.body())}
+    return TestClient(app)
+
+
+def test_body_size_limit(client):
+    assert client.post('/echo', content=b'x' * 1000).json() == {'size': 1000}
+    response = client.post('/echo', content=b'x' * 1001)
+    assert response.status_code == 413
+
+
+# Chunked body without Content-Length is stopped by the limit too
+def test_body_size_limit_without_content_length(client):
+    def body():
+        for _ in range(5):
+            yield b'x' * 300
+    response = client.post('/echo', content=body())
+    assert response.status_code == 413
+
+
+def test_upload_too_large(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'UPLOAD_SIZE_LIMIT', 1000)
+    response = TestClient(swis.app).post('/upload', files={'file': ('photo.jpg', b'x' * 2000, 'image/jpeg')})
+    assert response.status_code == 413
+    assert not [path for path in tmp_path.rglob('*') if path.is_file() and not path.name.startswith('.')]
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(swis.settings, 'SCANS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(swis.settings, 'UPLOAD_SESSION_CHUNK_SIZE', 1000)
+    monkeypatch.setattr(swis, 'queue_thumbnail', lambda filename, priority=None, refresh=False: True)
+    return TestClient(swis.app)
+
+
+# Interrupted upload is resumed with the chunks the status reports missing
+def test_upload_session_resume(tmp_path, sessions):
+    data = bytes(range(256)) * 10
+    chunks = [data[offset:offset + 1000] for offset in range(0, len(data), 1000)]
+    session = sessions.post('/upload/sessions', json={
+        'filename': 'photo.jpg', 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()
+    }).json()
+    assert session['chunks'] == 3
+    url = f'/upload/sessions/{session["id"]}'
+    assert sessions.put(f'{url}/chunks/0', content=chunks[0]).status_code == 200
+    response = sessions.put(f'{url}/chunks/2', content=chunks[2], headers={'X-Chunk-SHA256': hashlib.sha256(b'other').hexdigest()})
+    assert response.status_code == 422
+
+    status = sessions.get(url).json()
+    assert (status['received'], status['missing']) == ([0], [1, 2])
+    assert sessions.post(f'{url}/finalize').status_code == 422
+    for index in status['missing']:
+        headers = {'X-Chunk-SHA256': hashlib.sha256(chunks[index]).hexdigest()}
+        assert sessions.put(f'{url}/chunks/{index}', content=chunks[index], headers=headers).status_code == 200
+    assert sessions.get(url).json()['missing'] == []
+
+    result = sessions.post(f'{url}/finalize').json()
+    assert (result['returncode'], result['org_filename']) == (0, 'photo.jpg')
+    assert swis.scan_path(result['filename']).read_bytes() == data
+    assert swis.scans_catalog().get_metadata(result['filename'])[0] == 'photo.jpg'
+    assert sessions.get(url).status_code == 404
+    assert sessions.post(f'{url}/finalize').status_code == 404
+
+
+# Finalize checks the checksum of the whole file
+def test_upload_session_checksum_mismatch(sessions):
+    data = b'x' * 1500
+    session = sessions.post('/upload/sessions', json={
+        'filename': 'photo.jpg', 'size': len(data), 'sha256': hashlib.sha256(b'other').hexdigest()
+    }).json()
+    url = f'/upload/sessions/{session["id"]}'
+    sessions.put(f'{url}/chunks/0', content=data[:1000])
+    sessions.put(f'{url}/chunks/1', content=data[1000:])
+
+    response = sessions.post(f'{url}/finalize')
+    assert response.status_code == 422